@@ -5,5 +5,8 @@
 #
 # SPDX-License-Identifier: GPL-2.0+
 
-from .cabarchive import CabArchive, NotSupportedError
+from .errors import NotSupportedError
+from .cabarchive import CabArchive
+from .cabreader import CabReader
+from .cabwriter import CabWriter
 from .cabfile import CabFile
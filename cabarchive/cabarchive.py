@@ -19,10 +19,7 @@ from gi.repository import Gio
 from gi.repository import GLib
 
 from .cabfile import CabFile
-
-
-class NotSupportedError(NotImplementedError):
-    pass
+from .errors import NotSupportedError
 
 
 class CabArchive(dict):
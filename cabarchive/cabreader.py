@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+import os
+import struct
+import zlib
+from typing import Dict, List, Optional, Iterator, Tuple
+
+from .cabfile import CabFile
+from .errors import NotSupportedError
+
+FMT_CFHEADER = "<4sxxxxIxxxxIxxxxBBHHHHH"
+FMT_CFHEADER_RESERVE = "<HBB"
+FMT_CFFOLDER = "<IHH"
+FMT_CFFILE = "<IIHHHH"
+FMT_CFDATA = "<IHH"
+
+CAB_FLAG_PREV_CABINET = 0x0001
+CAB_FLAG_NEXT_CABINET = 0x0002
+CAB_FLAG_RESERVE_PRESENT = 0x0004
+
+CAB_COMPRESSION_MASK = 0x000F
+CAB_COMPRESSION_NONE = 0x0000
+CAB_COMPRESSION_MSZIP = 0x0001
+
+CAB_FILE_ATTR_NAME_IS_UTF8 = 0x80
+
+
+def _checksum(buf: bytes, seed: int = 0) -> int:
+    """ The CFDATA checksum, which is a XOR of little-endian 32 bit words """
+    csum = seed
+    nwords = len(buf) // 4
+    if nwords:
+        # fold the whole buffer in half repeatedly rather than iterating
+        val = int.from_bytes(buf[: nwords * 4], "little")
+        width = 1 << (nwords - 1).bit_length()
+        while width > 1:
+            width //= 2
+            val = (val >> (width * 32)) ^ (val & ((1 << (width * 32)) - 1))
+        csum ^= val
+    tail = 0
+    for byte in buf[nwords * 4 :]:
+        tail = (tail << 8) | byte
+    return csum ^ tail
+
+
+def _read_cstring(buf, offset: int, limit: int = 0x100) -> bytes:
+    end = bytes(buf[offset : offset + limit]).find(b"\0")
+    if end == -1:
+        raise NotSupportedError("no NUL terminator found at 0x{:x}".format(offset))
+    return bytes(buf[offset : offset + end])
+
+
+class _CabFolder:
+    """ A CFFOLDER entry and the decompression progress made so far """
+
+    def __init__(self, offset: int, ndatablocks: int, compression: int):
+        self.offset = offset
+        self.ndatablocks = ndatablocks
+        self.compression = compression & CAB_COMPRESSION_MASK
+
+        # (offset of payload, compressed size, uncompressed size, checksum)
+        self.blocks: List[List[int]] = []
+
+        # only used for MSZIP folders
+        self.data = bytearray()
+        self.block_idx = 0
+
+
+class _CabMember:
+    """ A CFFILE entry """
+
+    def __init__(self, filename: str, size: int, offset: int, folder: _CabFolder):
+        self.filename = filename
+        self.size = size
+        self.offset = offset
+        self.folder = folder
+
+
+class CabReader:
+    """A read-only Microsoft Cab archive that decompresses members on demand
+
+    Only the CFHEADER, CFFOLDER, CFFILE and CFDATA headers are parsed when
+    loaded. Uncompressed members are sliced directly out of the buffer, and
+    MSZIP folders are only inflated up to the end of the requested member.
+    """
+
+    def __init__(self, buf, flattern: bool = True):
+        """ Parses the tables of a MS Cabinet archive, where buf is bytes or a mmap """
+        self._buf = buf
+        self._members: Dict[str, _CabMember] = {}
+        self._parse(flattern)
+
+    def _parse(self, flattern: bool) -> None:
+        (
+            off_files,
+            nfolders,
+            nfiles,
+            offset,
+            reserve_folder,
+            reserve_data,
+        ) = self._parse_cfheader()
+        folders = self._parse_cffolders(offset, nfolders, reserve_folder, reserve_data)
+        self._parse_cffiles(off_files, nfiles, folders, flattern)
+
+    def _parse_cfheader(self) -> Tuple[int, int, int, int, int, int]:
+
+        # CFHEADER
+        try:
+            (
+                signature,
+                size,
+                off_files,
+                _version_minor,
+                _version_major,
+                nfolders,
+                nfiles,
+                flags,
+                _set_id,
+                _idx_cabinet,
+            ) = struct.unpack_from(FMT_CFHEADER, self._buf, 0)
+        except struct.error as e:
+            raise NotSupportedError("archive too small") from e
+        if signature != b"MSCF":
+            raise NotSupportedError("data is not a MS Cabinet archive")
+        if size > len(self._buf):
+            raise NotSupportedError(
+                "archive truncated, expected 0x{:x} bytes".format(size)
+            )
+        if flags & (CAB_FLAG_PREV_CABINET | CAB_FLAG_NEXT_CABINET):
+            raise NotSupportedError("multi-cabinet archives are not supported")
+        offset = struct.calcsize(FMT_CFHEADER)
+
+        # optional reserved areas
+        reserve_folder = 0
+        reserve_data = 0
+        if flags & CAB_FLAG_RESERVE_PRESENT:
+            (reserve_header, reserve_folder, reserve_data) = struct.unpack_from(
+                FMT_CFHEADER_RESERVE, self._buf, offset
+            )
+            offset += struct.calcsize(FMT_CFHEADER_RESERVE) + reserve_header
+        return off_files, nfolders, nfiles, offset, reserve_folder, reserve_data
+
+    def _parse_cffolders(
+        self, offset: int, nfolders: int, reserve_folder: int, reserve_data: int
+    ) -> List[_CabFolder]:
+
+        # CFFOLDER
+        folders: List[_CabFolder] = []
+        for _ in range(nfolders):
+            (off_data, ndatablocks, compression) = struct.unpack_from(
+                FMT_CFFOLDER, self._buf, offset
+            )
+            folders.append(_CabFolder(off_data, ndatablocks, compression))
+            offset += struct.calcsize(FMT_CFFOLDER) + reserve_folder
+
+        # CFDATA headers, without reading any of the payload
+        for folder in folders:
+            offset = folder.offset
+            for _ in range(folder.ndatablocks):
+                (csum, size_compressed, size_uncompressed) = struct.unpack_from(
+                    FMT_CFDATA, self._buf, offset
+                )
+                offset += struct.calcsize(FMT_CFDATA) + reserve_data
+                folder.blocks.append([offset, size_compressed, size_uncompressed, csum])
+                offset += size_compressed
+        return folders
+
+    def _parse_cffiles(
+        self, offset: int, nfiles: int, folders: List[_CabFolder], flattern: bool
+    ) -> None:
+
+        # CFFILE
+        for _ in range(nfiles):
+            (size, off_folder, idx_folder, _date, _time, attribs) = struct.unpack_from(
+                FMT_CFFILE, self._buf, offset
+            )
+            offset += struct.calcsize(FMT_CFFILE)
+            raw = _read_cstring(self._buf, offset)
+            offset += len(raw) + 1
+            if idx_folder >= len(folders):
+                raise NotSupportedError(
+                    "folder index 0x{:x} not supported".format(idx_folder)
+                )
+            if attribs & CAB_FILE_ATTR_NAME_IS_UTF8:
+                fn = raw.decode("utf-8")
+            else:
+                fn = raw.decode("ascii", errors="replace")
+
+            # replace win32-style backslashes
+            fn = fn.replace("\\", "/")
+            if flattern:
+                fn = os.path.basename(fn)
+            self._members[fn] = _CabMember(fn, size, off_folder, folders[idx_folder])
+
+    def _verify_block(self, block: List[int]) -> None:
+
+        # a zero checksum means none was set, as with GCab
+        offset, size_compressed, size_uncompressed, csum = block
+        if not csum:
+            return
+        hdr = struct.pack("<HH", size_compressed, size_uncompressed)
+        payload = self._buf[offset : offset + size_compressed]
+        if _checksum(hdr, _checksum(payload)) != csum:
+            raise NotSupportedError("invalid CFDATA checksum at 0x{:x}".format(offset))
+
+        # only check each block once
+        block[3] = 0
+
+    def _read_none(self, member: _CabMember) -> bytes:
+        chunks: List[bytes] = []
+        block_start = 0
+        member_end = member.offset + member.size
+        for block in member.folder.blocks:
+            offset, _, size, _ = block
+            block_end = block_start + size
+            if block_end > member.offset and block_start < member_end:
+                self._verify_block(block)
+                lo = max(member.offset, block_start) - block_start
+                hi = min(member_end, block_end) - block_start
+                chunks.append(bytes(self._buf[offset + lo : offset + hi]))
+            if block_end >= member_end:
+                break
+            block_start = block_end
+        return b"".join(chunks)
+
+    def _read_mszip(self, member: _CabMember) -> bytes:
+
+        # each block uses the previous 32kB as the dictionary, so we have to
+        # inflate from the start of the folder, but can stop afterwards
+        folder = member.folder
+        member_end = member.offset + member.size
+        while len(folder.data) < member_end:
+            if folder.block_idx >= len(folder.blocks):
+                raise NotSupportedError("{} is truncated".format(member.filename))
+            block = folder.blocks[folder.block_idx]
+            self._verify_block(block)
+            offset, size, _, _ = block
+            if bytes(self._buf[offset : offset + 2]) != b"CK":
+                raise NotSupportedError("invalid MSZIP block signature")
+            try:
+                if folder.data:
+                    obj = zlib.decompressobj(
+                        -zlib.MAX_WBITS, zdict=bytes(folder.data[-0x8000:])
+                    )
+                else:
+                    obj = zlib.decompressobj(-zlib.MAX_WBITS)
+                folder.data += obj.decompress(self._buf[offset + 2 : offset + size])
+            except zlib.error as e:
+                raise NotSupportedError("failed to inflate MSZIP block") from e
+            folder.block_idx += 1
+        return bytes(folder.data[member.offset : member_end])
+
+    def get_size(self, fn: str) -> int:
+        """ Returns the uncompressed size without decompressing anything """
+        return self._members[fn].size
+
+    def __getitem__(self, fn: str) -> CabFile:
+        member = self._members[fn]
+        if member.folder.compression == CAB_COMPRESSION_NONE:
+            return CabFile(self._read_none(member), filename=fn)
+        if member.folder.compression == CAB_COMPRESSION_MSZIP:
+            return CabFile(self._read_mszip(member), filename=fn)
+        raise NotSupportedError(
+            "compression type 0x{:x} not supported".format(member.folder.compression)
+        )
+
+    def get(self, fn: str) -> Optional[CabFile]:
+        if fn not in self._members:
+            return None
+        return self[fn]
+
+    def __contains__(self, fn: object) -> bool:
+        return fn in self._members
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._members)
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __repr__(self) -> str:
+        return "CabReader({})".format(list(self._members))
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=too-few-public-methods
+
+import os
+import struct
+import zlib
+import hashlib
+import datetime
+import tempfile
+from typing import Dict, List, Iterator, Tuple, Sequence
+
+from .cabfile import CabFile
+from .cabreader import (
+    FMT_CFFOLDER,
+    FMT_CFFILE,
+    FMT_CFDATA,
+    CAB_COMPRESSION_NONE,
+    CAB_COMPRESSION_MSZIP,
+    CAB_FILE_ATTR_NAME_IS_UTF8,
+    _checksum,
+)
+
+FMT_CFHEADER_WRITE = "<4sIIIIIBBHHHHH"
+
+CAB_BLOCK_SIZE = 0x8000
+CAB_FILE_ATTR_ARCH = 0x20
+
+
+def _dos_datetime(dt: datetime.datetime) -> Tuple[int, int]:
+    date = ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+    time = (dt.hour << 11) | (dt.minute << 5) | (dt.second // 2)
+    return date, time
+
+
+class CabWriter:
+    """Writes a Microsoft Cab archive directly to a file in a single pass
+
+    Any requested digests are computed on the data as it is written, and the
+    file is written to a temporary name and then renamed over the destination
+    so that readers never see a partially-written archive.
+    """
+
+    def __init__(self, cabarchive: Dict[str, CabFile], compress: bool = False):
+        self._cabarchive = cabarchive
+        self._compress = compress
+        self.size: int = 0
+        self.checksums: Dict[str, str] = {}
+
+    def _iter_blocks(self) -> Iterator[bytes]:
+        """ Yields the uncompressed folder data in CAB_BLOCK_SIZE chunks """
+        chunks: List[memoryview] = []
+        chunks_sz = 0
+        for cabfile in self._cabarchive.values():
+            view = memoryview(cabfile.buf or b"")
+            while view:
+                chunk = view[: CAB_BLOCK_SIZE - chunks_sz]
+                chunks.append(chunk)
+                chunks_sz += len(chunk)
+                view = view[len(chunk) :]
+                if chunks_sz == CAB_BLOCK_SIZE:
+                    yield b"".join(chunks)
+                    chunks = []
+                    chunks_sz = 0
+        if chunks:
+            yield b"".join(chunks)
+
+    def _iter_cfdata(self) -> Iterator[Tuple[bytes, int]]:
+        """ Yields each CFDATA payload with its uncompressed size """
+        history = b""
+        for block in self._iter_blocks():
+            if not self._compress:
+                yield block, len(block)
+                continue
+
+            # each block is a complete deflate stream that may refer back
+            # to the previous block, which is exactly what MSZIP expects
+            if history:
+                obj = zlib.compressobj(
+                    zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS,
+                    zdict=history,
+                )
+            else:
+                obj = zlib.compressobj(
+                    zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS
+                )
+            yield b"CK" + obj.compress(block) + obj.flush(), len(block)
+            history = block
+
+    def _build_cffiles(self) -> bytes:
+        date, time = _dos_datetime(datetime.datetime.utcnow())
+        cffiles: List[bytes] = []
+        offset = 0
+        for fn, cabfile in self._cabarchive.items():
+            attribs = CAB_FILE_ATTR_ARCH
+            try:
+                name = fn.replace("/", "\\").encode("ascii")
+            except UnicodeEncodeError as _:
+                name = fn.replace("/", "\\").encode("utf-8")
+                attribs |= CAB_FILE_ATTR_NAME_IS_UTF8
+            size = len(cabfile.buf or b"")
+            cffiles.append(struct.pack(FMT_CFFILE, size, offset, 0, date, time, attribs))
+            cffiles.append(name + b"\0")
+            offset += size
+        return b"".join(cffiles)
+
+    def save(self, fn: str, digests: Sequence[str] = ("sha1", "sha256")) -> None:
+        """ Atomically writes the archive to fn, computing digests as it goes """
+
+        # MSZIP needs the compressed sizes before the header can be written,
+        # but the uncompressed data can be streamed straight from the members
+        cfdatas: Iterator[Tuple[bytes, int]] = self._iter_cfdata()
+        if self._compress:
+            cfdatas_list = list(cfdatas)
+            ndatablocks = len(cfdatas_list)
+            size_data = sum(len(data) for data, _ in cfdatas_list)
+            cfdatas = iter(cfdatas_list)
+        else:
+            size_data = sum(
+                len(cabfile.buf or b"") for cabfile in self._cabarchive.values()
+            )
+            ndatablocks = (size_data + CAB_BLOCK_SIZE - 1) // CAB_BLOCK_SIZE
+
+        # CFHEADER, CFFOLDER then CFFILE
+        cffiles = self._build_cffiles()
+        off_files = struct.calcsize(FMT_CFHEADER_WRITE) + struct.calcsize(FMT_CFFOLDER)
+        off_data = off_files + len(cffiles)
+        size = off_data + size_data + ndatablocks * struct.calcsize(FMT_CFDATA)
+        header = struct.pack(
+            FMT_CFHEADER_WRITE,
+            b"MSCF",
+            0,
+            size,
+            0,
+            off_files,
+            0,
+            3,  # minor
+            1,  # major
+            1,  # folders
+            len(self._cabarchive),
+            0,  # flags
+            0,  # set ID
+            0,  # cabinet index
+        )
+        folder = struct.pack(
+            FMT_CFFOLDER,
+            off_data,
+            ndatablocks,
+            CAB_COMPRESSION_MSZIP if self._compress else CAB_COMPRESSION_NONE,
+        )
+
+        # write to a temp file in the same directory so the rename is atomic
+        hashes = [hashlib.new(digest) for digest in digests]
+        dirname = os.path.dirname(os.path.abspath(fn))
+        fd, fn_tmp = tempfile.mkstemp(
+            prefix=".{}.".format(os.path.basename(fn)), suffix=".tmp", dir=dirname
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+
+                def _write(buf: bytes) -> None:
+                    f.write(buf)
+                    for csum in hashes:
+                        csum.update(buf)
+
+                _write(header + folder + cffiles)
+                for data, size_uncompressed in cfdatas:
+                    hdr = struct.pack("<HH", len(data), size_uncompressed)
+                    csum = _checksum(hdr, _checksum(data))
+                    _write(struct.pack("<I", csum) + hdr)
+                    _write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(fn_tmp, 0o644)
+            os.replace(fn_tmp, fn)
+        except BaseException:
+            os.unlink(fn_tmp)
+            raise
+
+        self.size = size
+        self.checksums = {
+            digest: csum.hexdigest() for digest, csum in zip(digests, hashes)
+        }
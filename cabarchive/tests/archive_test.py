@@ -11,11 +11,12 @@ import os
 import sys
 import unittest
 import hashlib
+import tempfile
 
 # allows us to run this from the project root
 sys.path.append(os.path.realpath("."))
 
-from cabarchive import CabArchive, CabFile, NotSupportedError
+from cabarchive import CabArchive, CabReader, CabWriter, CabFile, NotSupportedError
 
 
 class TestCabArchive(unittest.TestCase):
@@ -30,6 +31,75 @@ class TestCabArchive(unittest.TestCase):
         for fn in results:
             self.assertEqual(hashlib.sha1(cabarchive[fn].buf).hexdigest(), results[fn])
 
+    def test_reader_checksums(self):
+        with open("contrib/hughski-colorhug2-2.0.3.cab", "rb") as f:
+            cabarchive = CabReader(f.read())
+        self.assertEqual(len(cabarchive), 3)
+        self.assertEqual(cabarchive.get_size("firmware.inf"), 489)
+        self.assertIsNone(cabarchive.get("README.txt"))
+        with self.assertRaises(KeyError):
+            _ = cabarchive["README.txt"]
+        results = {
+            "firmware.bin": "c57c7de8f7029acc44a4bfad6efd6ab0a7092cc6",
+            "firmware.inf": "b0cb43bfb2f55fd15a8814c5c5c7b9f2ce2f4572",
+            "firmware.metainfo.xml": "a8fda77f8baa56917ee1201b72747612c49e855b",
+        }
+        for fn in results:
+            self.assertEqual(hashlib.sha1(cabarchive[fn].buf).hexdigest(), results[fn])
+
+    def test_reader_compressed(self):
+        cabarchive = CabArchive()
+        cabarchive["README.txt"] = CabFile(b"foofoofoofoofoofoofoofoo")
+        cabarchive["firmware.bin"] = CabFile(b"barbarbarbarbarbarbarbar" * 0x1000)
+        cabreader = CabReader(cabarchive.save(compress=True))
+        self.assertEqual(cabreader["README.txt"].buf, b"foofoofoofoofoofoofoofoo")
+        self.assertEqual(
+            cabreader["firmware.bin"].buf, b"barbarbarbarbarbarbarbar" * 0x1000
+        )
+
+    def test_reader_invalid(self):
+        with self.assertRaises(NotSupportedError):
+            with open("contrib/pylint.sh", "rb") as f:
+                _ = CabReader(f.read())
+
+    def test_reader_corrupt(self):
+        cabarchive = CabArchive()
+        cabarchive["firmware.bin"] = CabFile(b"barbarbarbarbarbarbarbar" * 0x1000)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, "firmware.cab")
+            CabWriter(cabarchive, compress=False).save(fn)
+            with open(fn, "rb") as f:
+                buf = bytearray(f.read())
+        buf[-1] ^= 0xFF
+        cabreader = CabReader(bytes(buf))
+        with self.assertRaises(NotSupportedError):
+            _ = cabreader["firmware.bin"]
+
+    def test_writer(self):
+        cabarchive = CabArchive()
+        cabarchive["README.txt"] = CabFile(b"foofoofoofoofoofoofoofoo")
+        cabarchive["firmware.bin"] = CabFile(b"barbarbarbarbarbarbarbar" * 0x1000)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for compress in [False, True]:
+                fn = os.path.join(tmpdir, "firmware.cab")
+                cabwriter = CabWriter(cabarchive, compress=compress)
+                cabwriter.save(fn, digests=["sha1", "sha256"])
+                self.assertEqual(os.listdir(tmpdir), ["firmware.cab"])
+                with open(fn, "rb") as f:
+                    buf = f.read()
+                self.assertEqual(cabwriter.size, len(buf))
+                self.assertEqual(
+                    cabwriter.checksums["sha1"], hashlib.sha1(buf).hexdigest()
+                )
+                self.assertEqual(
+                    cabwriter.checksums["sha256"], hashlib.sha256(buf).hexdigest()
+                )
+                cabarchive_new = CabArchive(buf)
+                self.assertEqual(
+                    cabarchive_new["firmware.bin"].buf,
+                    b"barbarbarbarbarbarbarbar" * 0x1000,
+                )
+
     def test_missing(self):
         with open("contrib/hughski-colorhug2-2.0.3.cab", "rb") as f:
             cabarchive = CabArchive(f.read())
@@ -10,7 +10,7 @@
 import json
 import gzip
 
-from typing import Any, Optional, Dict, List
+from typing import Any, Optional, Dict, List, Set
 
 from .jcatitem import JcatItem
 
@@ -26,24 +26,62 @@ class JcatFile:
         self.version_major = 0
         self.version_minor = 1
         self.items: List[JcatItem] = []
+        self._index_ids: Dict[str, JcatItem] = {}
+        self._index_alias_ids: Dict[str, JcatItem] = {}
+        self._index_objs: Set[int] = set()
+        self._index_cnt = 0
         if buf:
             self.load(buf)
 
-    def get_item(self, jid: str) -> JcatItem:
-        for item in self.items:
-            if item.id == jid:
-                return item
+    def _ensure_index(self) -> None:
+        """ Rebuilds the lookup tables if items were added behind our back """
+        if self._index_cnt == len(self.items):
+            return
+        self._index_ids.clear()
+        self._index_alias_ids.clear()
+        self._index_objs.clear()
         for item in self.items:
-            if jid in item.alias_ids:
-                return item
+            self._add_to_index(item)
+        self._index_cnt = len(self.items)
+
+    def _add_to_index(self, item: JcatItem) -> None:
+        item.jcatfile = self
+        self._index_objs.add(id(item))
+        if item.id:
+            self._index_ids.setdefault(item.id, item)
+        for jid in item.alias_ids:
+            self.index_alias_id(jid, item)
+
+    def index_alias_id(self, jid: str, item: JcatItem) -> None:
+        """ Makes an alias ID added to an existing item findable """
+        self._index_alias_ids.setdefault(jid, item)
+
+    def find_item(self, jid: str) -> Optional[JcatItem]:
+        """ Returns the item with the ID or alias ID, or None if not found """
+        self._ensure_index()
+        item = self._index_ids.get(jid)
+        if item and item.id == jid:
+            return item
+        item = self._index_alias_ids.get(jid)
+        if item and jid in item.alias_ids:
+            return item
+        return None
+
+    def get_item(self, jid: str) -> JcatItem:
+        item = self.find_item(jid)
+        if item:
+            return item
         item = JcatItem(jid)
-        self.items.append(item)
+        self.add_item(item)
         return item
 
     def add_item(self, item: JcatItem) -> None:
-        if item in self.items:
+        self._ensure_index()
+        if id(item) in self._index_objs:
             return
         self.items.append(item)
+        self._add_to_index(item)
+        self._index_cnt = len(self.items)
 
     def save(self) -> bytes:
         node: Dict[str, Any] = {}
@@ -63,7 +101,7 @@ class JcatFile:
             for node_c in node["Items"]:
                 item = JcatItem()
                 item.load(node_c)
-                self.items.append(item)
+                self.add_item(item)
 
     def __repr__(self) -> str:
         return "JcatFile({})".format([str(jcatitem) for jcatitem in self.items])
@@ -15,6 +15,7 @@ class JcatItem:
         self.id = jid
         self.blobs: List[JcatBlob] = []
         self.alias_ids: List[str] = []
+        self.jcatfile: Any = None
 
     def save(self) -> Dict[str, Any]:
         node: Dict[str, Any] = {}
@@ -45,6 +46,8 @@ class JcatItem:
         if jid in self.alias_ids:
             return
         self.alias_ids.append(jid)
+        if self.jcatfile:
+            self.jcatfile.index_alias_id(jid, self)
 
     def __repr__(self) -> str:
         return "JcatItem({})".format(self.id)
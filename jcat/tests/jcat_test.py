@@ -31,6 +31,21 @@ class TestJcatFile(unittest.TestCase):
             b"2577281a88fe9e2a21c7dedbf844f546158ca568f1440eef430f9b6dca499a60",
         )
 
+    def test_find_item(self):
+        jcatfile = JcatFile()
+        jcatitem = jcatfile.get_item("firmware-00001-stable.xml.gz")
+        jcatitem.add_alias_id("firmware.xml.gz")
+        self.assertEqual(jcatfile.find_item("firmware.xml.gz"), jcatitem)
+        self.assertEqual(jcatfile.get_item("firmware.xml.gz"), jcatitem)
+        self.assertIsNone(jcatfile.find_item("firmware-testing.xml.gz"))
+        jcatfile.add_item(jcatitem)
+        self.assertEqual(len(jcatfile.items), 1)
+
+        # reload
+        jcatfile = JcatFile(jcatfile.save())
+        jcatitem = jcatfile.find_item("firmware.xml.gz")
+        self.assertEqual(jcatitem.id, "firmware-00001-stable.xml.gz")
+
     def test_write(self):
         jcatfile = JcatFile()
         jcatitem = JcatItem("filename.bin")
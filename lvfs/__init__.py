@@ -124,6 +124,13 @@ app.register_blueprint(bp_hsireports, url_prefix='/lvfs/hsireports')
 def before_request_func():
     g.container_id = socket.gethostname()
 
+@app.teardown_request
+def teardown_request_func(unused_exc=None):
+    if len(ploader.timings):
+        ploader.timings.flush()
+    if len(ploader.invalidations):
+        ploader.flush_modified()
+
 @app.cli.command('initdb')
 def initdb_command():
     init_db(db)
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict
+
+from lvfs import app
+
+
+class BlobCache:
+    """ A size-bounded LRU cache of blobs keyed by checksum
+
+    There is one instance per process, shared by all the components and shards
+    loaded in any session. The total size is limited by BLOB_CACHE_SIZE bytes,
+    and blobs larger than a quarter of that are never cached.
+    """
+
+    def __init__(self) -> None:
+        self._blobs: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @property
+    def max_size(self) -> int:
+        return app.config.get('BLOB_CACHE_SIZE', 0x10000000)
+
+    def get(self, key: Optional[str]) -> Optional[bytes]:
+        if not key:
+            return None
+        with self._lock:
+            blob = self._blobs.get(key)
+            if blob is None:
+                self.misses += 1
+                return None
+            self._blobs.move_to_end(key)
+            self.hits += 1
+            return blob
+
+    def set(self, key: Optional[str], blob: bytes) -> bool:
+        """ Returns False if the blob was too large to cache """
+        if not key or blob is None:
+            return False
+        max_size = self.max_size
+        if len(blob) > max_size // 4:
+            return False
+        with self._lock:
+            old = self._blobs.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._blobs[key] = blob
+            self.size += len(blob)
+            while self.size > max_size:
+                _, old = self._blobs.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+        return True
+
+    def remove(self, key: Optional[str]) -> None:
+        if not key:
+            return
+        with self._lock:
+            old = self._blobs.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._blobs.clear()
+            self.size = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'items': len(self._blobs),
+                    'size': self.size,
+                    'max_size': self.max_size}
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+    def __repr__(self) -> str:
+        return 'BlobCache({}/{} bytes, {} hits, {} misses)'.format(self.size,
+                                                                  self.max_size,
+                                                                  self.hits,
+                                                                  self.misses)
+
+
+blob_cache = BlobCache()
@@ -48,5 +48,8 @@ class FlaskCelery(Celery):
 
 @task_postrun.connect
 def close_session(*args, **kwargs):
-    from lvfs import db
+    from lvfs import db, ploader
+    if len(ploader.invalidations):
+        ploader.flush_modified()
     db.session.remove()
+    ploader.timings.flush()
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+
+import time
+import socket
+import struct
+import threading
+from typing import Optional, List, Callable, Tuple, Any
+
+from lvfs import app
+
+
+class ClamdError(Exception):
+    pass
+
+
+class ClamdConnection:
+    """ One IDSESSION to clamd, which can run any number of commands in turn """
+
+    def __init__(self, path: str, timeout: float = 120) -> None:
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._buf = b''
+        self._cmd_id = 0
+        self.used_ts = time.monotonic()
+        try:
+            self._sock.connect(path)
+            self._sock.sendall(b'zIDSESSION\0')
+        except OSError:
+            self._sock.close()
+            raise
+
+    def _recv_reply(self) -> str:
+
+        # clamd closes the session when idle for too long
+        while b'\0' not in self._buf:
+            data = self._sock.recv(0x1000)
+            if not data:
+                raise ConnectionResetError('connection closed by clamd')
+            self._buf += data
+        reply, self._buf = self._buf.split(b'\0', 1)
+
+        # replies in a session are prefixed with the command number
+        self._cmd_id += 1
+        prefix = '{}: '.format(self._cmd_id).encode()
+        if not reply.startswith(prefix):
+            raise ClamdError('Unexpected reply: {}'.format(reply.decode(errors='replace')))
+        return reply[len(prefix):].decode(errors='replace')
+
+    def version(self) -> str:
+        self._sock.sendall(b'zVERSION\0')
+        return self._recv_reply()
+
+    def scan(self, blob, chunk_size: int = 0x10000) -> Optional[str]:
+        """ Returns the signature name if anything was found """
+
+        self._sock.sendall(b'zINSTREAM\0')
+        try:
+            with memoryview(blob) as view:
+                for offset in range(0, len(view), chunk_size):
+                    chunk = view[offset:offset + chunk_size]
+                    self._sock.sendall(struct.pack('>I', len(chunk)))
+                    self._sock.sendall(chunk)
+            self._sock.sendall(struct.pack('>I', 0))
+        except BrokenPipeError as _:
+            # clamd stops reading when the stream is too large, but still replies
+            pass
+        reply = self._recv_reply()
+
+        # e.g. 'stream: OK' or 'stream: Eicar-Signature FOUND'
+        if reply.startswith('stream: '):
+            reply = reply[8:]
+        if reply.endswith(' ERROR'):
+            raise ClamdError(reply[:-6])
+        if reply.endswith(' FOUND'):
+            return reply[:-6]
+        if reply == 'OK':
+            return None
+        raise ClamdError('Unexpected reply: {}'.format(reply))
+
+    def close(self) -> None:
+        try:
+            self._sock.sendall(b'zEND\0')
+        except OSError as _:
+            pass
+        self._sock.close()
+
+
+class ClamdClient:
+    """ A pool of sessions to a long-lived clamd listening on a UNIX socket
+
+    There is one instance per process. Blobs are sent using INSTREAM so that
+    clamd does not need to be able to read the files, and the signature
+    database is only loaded once by the daemon rather than for every scan.
+    Sessions are returned to the pool after use and closed before clamd would
+    drop them for being idle.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._path = path
+        self._pool: List[ClamdConnection] = []
+        self._lock = threading.Lock()
+        self._version: Optional[str] = None
+        self._version_ts: float = 0
+
+    @property
+    def path(self) -> str:
+        return self._path or app.config.get('CLAMD_SOCKET', '/var/run/clamd.scan/clamd.sock')
+
+    def _acquire(self) -> Tuple[ClamdConnection, bool]:
+        now = time.monotonic()
+        with self._lock:
+            while self._pool:
+                conn = self._pool.pop()
+                if now - conn.used_ts < app.config.get('CLAMD_IDLE_TIMEOUT', 20):
+                    return conn, True
+                conn.close()
+        return ClamdConnection(self.path, app.config.get('CLAMD_TIMEOUT', 120)), False
+
+    def _release(self, conn: ClamdConnection) -> None:
+        conn.used_ts = time.monotonic()
+        with self._lock:
+            if len(self._pool) < app.config.get('CLAMD_POOL_SIZE', 4):
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def _call(self, func: Callable[[ClamdConnection], Any]) -> Any:
+
+        # a pooled session may have been closed by clamd, so try a new one
+        for _ in range(2):
+            try:
+                conn, reused = self._acquire()
+            except OSError as e:
+                raise ClamdError('Failed to connect to {}: {}'.format(self.path, str(e))) from e
+            try:
+                result = func(conn)
+            except OSError as e:
+                conn.close()
+                if reused:
+                    continue
+                raise ClamdError(str(e)) from e
+            except ClamdError:
+                conn.close()
+                raise
+            self._release(conn)
+            return result
+        raise ClamdError('Failed to use session')
+
+    def version(self) -> str:
+        """ Returns the engine and signature database version, e.g. 'ClamAV 0.102.4/25950/...' """
+        now = time.monotonic()
+        if self._version and now - self._version_ts < app.config.get('CLAMD_VERSION_MAX_AGE', 3600):
+            return self._version
+        self._version = self._call(lambda conn: conn.version())
+        self._version_ts = now
+        return self._version
+
+    def scan_many(self, blobs: List[Any]) -> List[Optional[str]]:
+        """ Scans each blob in turn using one session, returning any signature names """
+        results: List[Optional[str]] = []
+
+        # resumes from the first blob without a result if the session is retried
+        def _scan_remaining(conn: ClamdConnection) -> None:
+            while len(results) < len(blobs):
+                results.append(conn.scan(blobs[len(results)]))
+
+        self._call(_scan_remaining)
+        return results
+
+    def scan(self, blob) -> Optional[str]:
+        return self.scan_many([blob])[0]
+
+    def close(self) -> None:
+        with self._lock:
+            pool = self._pool
+            self._pool = []
+        for conn in pool:
+            conn.close()
+
+
+clamd = ClamdClient()
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=wrong-import-position,too-few-public-methods
+
+import os
+import sys
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+# allows us to run this from the project root
+sys.path.append(os.path.realpath('.'))
+
+from lvfs.clamd import ClamdClient, ClamdError
+
+class FakeClamd:
+    """ Enough of clamd to test the client, flagging anything containing EICAR """
+
+    def __init__(self, path: str, stream_max_length: int = 0x100000) -> None:
+        self.stream_max_length = stream_max_length
+        self.connections = 0
+        self.scans = 0
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(5)
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError as _:
+                return
+            self.connections += 1
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _recv_exact(f, size: int) -> bytes:
+        buf = f.read(size)
+        if len(buf) != size:
+            raise EOFError
+        return buf
+
+    def _instream(self, f) -> str:
+        data = b''
+        while True:
+            size, = struct.unpack('>I', self._recv_exact(f, 4))
+            if not size:
+                break
+            data += self._recv_exact(f, size)
+            if len(data) > self.stream_max_length:
+                return 'INSTREAM size limit exceeded. ERROR'
+        self.scans += 1
+        if b'EICAR' in data:
+            return 'stream: Eicar-Signature FOUND'
+        return 'stream: OK'
+
+    def _handle(self, conn: socket.socket) -> None:
+        cmd_id = 0
+        session = False
+        with conn, conn.makefile('rb') as f:
+            while True:
+                cmd = b''
+                while not cmd.endswith(b'\0'):
+                    char = f.read(1)
+                    if not char:
+                        return
+                    cmd += char
+                if cmd == b'zIDSESSION\0':
+                    session = True
+                    continue
+                if cmd == b'zEND\0':
+                    return
+                if cmd == b'zVERSION\0':
+                    reply = 'ClamAV 0.102.4/25950/Mon Oct 19 13:21:55 2020'
+                elif cmd == b'zINSTREAM\0':
+                    try:
+                        reply = self._instream(f)
+                    except EOFError as _:
+                        return
+                else:
+                    reply = 'UNKNOWN COMMAND'
+                cmd_id += 1
+                if session:
+                    reply = '{}: {}'.format(cmd_id, reply)
+                conn.sendall(reply.encode() + b'\0')
+                if not session or reply.endswith('ERROR'):
+                    return
+
+    def close(self) -> None:
+        self._sock.close()
+
+class ClamdTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmpdir.name, 'clamd.sock')
+        self.daemon = FakeClamd(self.path)
+        self.client = ClamdClient(self.path)
+
+    def tearDown(self):
+        self.client.close()
+        self.daemon.close()
+        self._tmpdir.cleanup()
+
+    def test_scan(self):
+
+        self.assertEqual(self.client.version(), 'ClamAV 0.102.4/25950/Mon Oct 19 13:21:55 2020')
+        self.assertIsNone(self.client.scan(b'hello world'))
+        self.assertEqual(self.client.scan(b'\0' * 0x20000 + b'EICAR'), 'Eicar-Signature')
+        self.assertEqual(self.client.scan_many([b'foo', b'EICAR', b'']), [None, 'Eicar-Signature', None])
+
+        # all using one session
+        self.assertEqual(self.daemon.connections, 1)
+        self.assertEqual(self.daemon.scans, 5)
+
+        # cached
+        self.client.version()
+        self.assertEqual(self.daemon.connections, 1)
+
+    def test_errors(self):
+
+        # too large, and the session cannot be reused
+        with self.assertRaises(ClamdError):
+            self.client.scan(b'\0' * 0x200000)
+        self.assertIsNone(self.client.scan(b'hello world'))
+        self.assertEqual(self.daemon.connections, 2)
+
+        # daemon has gone away
+        self.daemon.close()
+        os.unlink(self.path)
+        self.client.close()
+        with self.assertRaises(ClamdError):
+            self.client.scan(b'hello world')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,6 +12,7 @@ import collections
 import math
 import hashlib
 import zlib
+import datetime
 from typing import Optional, List, Dict
 from distutils.version import StrictVersion
 
@@ -26,18 +27,25 @@ from sqlalchemy import (
     Boolean,
     Float,
     ForeignKey,
+    Index,
 )
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.associationproxy import association_proxy
 
-from pkgversion import vercmp
+from pkgversion import vercmp_key, vercmp_sortable
 
 from lvfs import app, db
+from lvfs.blobcache import blob_cache
 
 from lvfs.claims.models import Claim
 from lvfs.users.models import User
 from lvfs.vendors.models import VendorTag
-from lvfs.util import _split_search_string, _sanitize_keyword
+from lvfs.util import _split_search_string, _sanitize_keyword, _write_atomic
+
+
+MICROCODE_INTEL_GUID = "3f0229ad-0a00-5269-90cf-0a45d8781b72"
 
 
 class ComponentShardInfo(db.Model):
@@ -144,6 +152,19 @@ class ComponentShardClaim(db.Model):
         )
 
 
+class ComponentShardClaimGeneration(db.Model):
+    """ Bumped whenever a shard GUID or checksum claim is changed """
+
+    __tablename__ = "component_shard_claim_generations"
+
+    component_shard_claim_generation_id = Column(Integer, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+    mtime = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self) -> str:
+        return "ComponentShardClaimGeneration object %s" % self.value
+
+
 class ComponentShardAttribute(db.Model):
     __tablename__ = "component_shard_attributes"
 
@@ -163,10 +184,94 @@ class ComponentShardAttribute(db.Model):
         return "ComponentShardAttribute object %s=%s" % (self.key, self.value)
 
 
+class ComponentShardMicrocode(db.Model):
+    """ A copy of the microcode shard attributes that can be searched quickly """
+
+    __tablename__ = "component_shard_microcodes"
+    __table_args__ = (
+        Index(
+            "idx_component_shard_microcodes_cpuid_platform_version",
+            "cpuid",
+            "platform",
+            "version",
+        ),
+    )
+
+    component_shard_microcode_id = Column(Integer, primary_key=True)
+    component_shard_id = Column(
+        Integer,
+        ForeignKey("component_shards.component_shard_id"),
+        nullable=False,
+        unique=True,
+    )
+    component_id = Column(
+        Integer, ForeignKey("components.component_id"), nullable=False, index=True
+    )
+    vendor_id = Column(
+        Integer, ForeignKey("vendors.vendor_id"), nullable=False, index=True
+    )
+    cpuid = Column(Text, nullable=False)
+    platform = Column(Text, nullable=False)
+    version = Column(Text, nullable=False)
+    yyyymmdd = Column(Text, nullable=False)
+
+    shard = relationship("ComponentShard", back_populates="microcode")
+    md = relationship("Component")
+
+    def __repr__(self) -> str:
+        return "ComponentShardMicrocode object %s:%s version %s" % (
+            self.cpuid,
+            self.platform,
+            self.version,
+        )
+
+
+class ComponentShardBlob(db.Model):
+    """ The contents of a shard, stored once however many components contain it
+
+    The refcnt is the number of ComponentShard rows that point at this row, and
+    the file is only removed by _shard_blobs_gc() once nothing refers to it.
+    """
+
+    __tablename__ = "component_shard_blobs"
+
+    component_shard_blob_id = Column(Integer, primary_key=True)
+    checksum = Column(String(64), nullable=False, unique=True)  # SHA256
+    size = Column(Integer, default=0)
+    refcnt = Column(Integer, nullable=False, default=0)
+    ctime = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    @property
+    def absolute_path(self) -> str:
+        return os.path.join(
+            app.config["SHARD_DIR"], "blobs", self.checksum[:2], self.checksum
+        )
+
+    def write(self, blob: bytes) -> None:
+        """ Writes the compressed blob if it does not already exist """
+        fn = self.absolute_path
+        if os.path.exists(fn):
+            return
+        _write_atomic(fn, zlib.compress(blob))
+
+    def read(self) -> Optional[bytes]:
+        """ Reads the blob, or returns None if the file has been removed """
+        try:
+            with open(self.absolute_path, "rb") as f:
+                return zlib.decompressobj().decompress(f.read())
+        except FileNotFoundError as _:
+            return None
+
+    def __repr__(self) -> str:
+        return "ComponentShardBlob object %s(%s)" % (self.checksum, self.refcnt)
+
+
 class ComponentShard(db.Model):
 
     __tablename__ = "component_shards"
 
+    _blob: Optional[bytes] = None
+
     component_shard_id = Column(Integer, primary_key=True)
     component_id = Column(
         Integer, ForeignKey("components.component_id"), nullable=False, index=True
@@ -181,6 +286,12 @@ class ComponentShard(db.Model):
     name = Column(Text, default=None)
     size = Column(Integer, default=0)
     entropy = Column(Float, default=0.0)
+    component_shard_blob_id = Column(
+        Integer,
+        ForeignKey("component_shard_blobs.component_shard_blob_id"),
+        default=None,
+        index=True,
+    )
 
     checksums = relationship(
         "ComponentShardChecksum",
@@ -194,6 +305,7 @@ class ComponentShard(db.Model):
         cascade="all,delete,delete-orphan",
     )
     info = relationship("ComponentShardInfo")
+    shard_blob = relationship("ComponentShardBlob")
     yara_query_results = relationship(
         "YaraQueryResult", cascade="all,delete,delete-orphan"
     )
@@ -204,6 +316,12 @@ class ComponentShard(db.Model):
         back_populates="component_shard",
         cascade="all,delete,delete-orphan",
     )
+    microcode = relationship(
+        "ComponentShardMicrocode",
+        uselist=False,
+        back_populates="shard",
+        cascade="all,delete,delete-orphan",
+    )
 
     def get_attr_value(self, key: str) -> Optional[str]:
         for attr in self.attributes:
@@ -211,6 +329,23 @@ class ComponentShard(db.Model):
                 return attr.value
         return None
 
+    def ensure_microcode(self) -> None:
+        """ Adds the searchable microcode entry if this is Intel microcode """
+        if self.guid != MICROCODE_INTEL_GUID or not self.md:
+            return
+        values: Dict[str, str] = {}
+        for key in ["cpuid", "platform", "version", "yyyymmdd"]:
+            value = self.get_attr_value(key)
+            if not value:
+                return
+            values[key] = value
+        if not self.microcode:
+            self.microcode = ComponentShardMicrocode()
+        self.microcode.md = self.md
+        self.microcode.vendor_id = self.md.fw.vendor_id
+        for key, value in values.items():
+            setattr(self.microcode, key, value)
+
     @property
     def description(self) -> Optional[str]:
         if self.info.description:
@@ -224,14 +359,23 @@ class ComponentShard(db.Model):
 
     @property
     def blob(self) -> Optional[bytes]:
-        if not hasattr(self, "_blob"):
-            # restore from disk if available
-            fn = self.absolute_path
-            if not os.path.exists(fn):
-                return None
-            with open(fn, "rb") as f:
-                self._blob = zlib.decompressobj().decompress(f.read())
-        return self._blob
+        if self._blob is not None:
+            return self._blob
+
+        # shared with any other shard with the same contents
+        blob = blob_cache.get(self.checksum)
+        if blob is not None:
+            return blob
+
+        # restore from disk if available
+        fn = self.absolute_path
+        if not os.path.exists(fn):
+            return None
+        with open(fn, "rb") as f:
+            blob = zlib.decompressobj().decompress(f.read())
+        if not blob_cache.set(self.checksum, blob):
+            self._blob = blob
+        return blob
 
     @blob.setter
     def blob(self, value: bytes):
@@ -270,18 +414,73 @@ class ComponentShard(db.Model):
 
     @property
     def absolute_path(self) -> str:
+        if self.shard_blob:
+            return self.shard_blob.absolute_path
+        return self.legacy_path
+
+    @property
+    def legacy_path(self) -> str:
+        """ Where shards were written before they were deduplicated """
         return os.path.join(app.config["SHARD_DIR"], str(self.component_id), self.name)
 
-    def save(self):
-        fn = self.absolute_path
-        os.makedirs(os.path.dirname(fn), exist_ok=True)
-        with open(fn, "wb") as f:
-            f.write(zlib.compress(self._blob))
+    def save(self) -> None:
+        """ Writes the blob to the shared store and takes a reference on it """
+        if self.shard_blob:
+            return
+        if self._blob is None:
+            raise ValueError("no blob to save")
+        checksum = self.checksum or hashlib.sha256(self._blob).hexdigest()
+
+        # another worker may be adding the same contents at the same time, and
+        # _shard_blobs_gc() may delete an unreferenced row after we found it
+        for _ in range(3):
+            shard_blob = (
+                db.session.query(ComponentShardBlob)
+                .filter(ComponentShardBlob.checksum == checksum)
+                .first()
+            )
+            if not shard_blob:
+                try:
+                    with db.session.begin_nested():
+                        shard_blob = ComponentShardBlob(
+                            checksum=checksum, size=len(self._blob)
+                        )
+                        db.session.add(shard_blob)
+                except IntegrityError as _:
+                    continue
+
+            # only take the reference if the row still exists
+            if (
+                db.session.query(ComponentShardBlob)
+                .filter(
+                    ComponentShardBlob.component_shard_blob_id
+                    == shard_blob.component_shard_blob_id
+                )
+                .update({ComponentShardBlob.refcnt: ComponentShardBlob.refcnt + 1})
+            ):
+                break
+        else:
+            raise ValueError("failed to add shard blob {}".format(checksum))
+        shard_blob.write(self._blob)
+        self.shard_blob = shard_blob
 
     def __repr__(self) -> str:
         return "ComponentShard object %s" % self.component_shard_id
 
 
+@event.listens_for(ComponentShard, "after_delete")
+def _component_shard_after_delete(_mapper, connection, target):
+    """ Drops the reference on the shared blob; the file is removed later """
+    if not target.component_shard_blob_id:
+        return
+    tbl = ComponentShardBlob.__table__
+    connection.execute(
+        tbl.update()
+        .where(tbl.c.component_shard_blob_id == target.component_shard_blob_id)
+        .values(refcnt=tbl.c.refcnt - 1)
+    )
+
+
 class ComponentIssue(db.Model):
 
     __tablename__ = "component_issues"
@@ -461,10 +660,10 @@ class ComponentRef(db.Model):
     protocol = relationship("Protocol")
 
     def __lt__(self, other) -> bool:
-        return vercmp(self.version, other.version) < 0
+        return vercmp_key(self.version) < vercmp_key(other.version)
 
     def __eq__(self, other) -> bool:
-        return vercmp(self.version, other.version) == 0
+        return vercmp_key(self.version) == vercmp_key(other.version)
 
     @property
     def version_with_tag(self) -> str:
@@ -510,6 +709,7 @@ class Component(db.Model):
     filename_xml = Column(Text, nullable=False)
     release_timestamp = Column(Integer, default=0)
     version = Column(Text, nullable=False)
+    version_sort = Column(Text, default=None, index=True)
     release_installed_size = Column(Integer, default=0)
     release_download_size = Column(Integer, default=0)
     release_urgency = Column(Text, default=None)
@@ -566,11 +766,16 @@ class Component(db.Model):
         "YaraQueryResult", lazy="joined", cascade="all,delete,delete-orphan"
     )
 
+    @property
+    def version_key(self) -> tuple:
+        """ A key for sorted() that orders components by version """
+        return vercmp_key(self.version_display)
+
     def __lt__(self, other) -> bool:
-        return vercmp(self.version_display, other.version_display) < 0
+        return self.version_key < other.version_key
 
     def __eq__(self, other) -> bool:
-        return vercmp(self.version_display, other.version_display) == 0
+        return self.version_key == other.version_key
 
     def _vendor_tag_with_attr(self, attr: Optional[str] = None) -> Optional[VendorTag]:
 
@@ -642,10 +847,16 @@ class Component(db.Model):
 
     @property
     def blob(self) -> Optional[bytes]:
-        if not hasattr(self, "_blob") or not self._blob:
-            self._blob = None
-            self.fw._ensure_blobs()
-        return self._blob
+        if self._blob is not None:
+            return self._blob
+        blob = blob_cache.get(self.checksum_contents_sha256)
+        if blob is None:
+            blob = self.fw._ensure_blobs([self]).get(self.filename_contents)
+
+            # too large to cache, so keep it on the instance
+            if blob is not None and not blob_cache.set(self.checksum_contents_sha256, blob):
+                self._blob = blob
+        return blob
 
     @blob.setter
     def blob(self, value: Optional[bytes]):
@@ -813,6 +1024,10 @@ class Component(db.Model):
                 return self.verfmt._uint32_to_str(int(self.version))
         return self.version
 
+    def fix_version_sort(self) -> None:
+        """ Sets the sortable version, which needs doing when the version format changes """
+        self.version_sort = vercmp_sortable(self.version_display)
+
     @property
     def version_sections(self) -> int:
         if not self.version_display:
@@ -154,6 +154,9 @@ def route_modify(component_id):
     if 'verfmt_id' in request.form:
         if md.verfmt_id != request.form['verfmt_id']:
             md.verfmt_id = request.form['verfmt_id'] or None
+            db.session.flush()
+            db.session.expire(md, ['verfmt'])
+            md.fix_version_sort()
     if 'metadata_license_id' in request.form:
         if md.metadata_license_id != request.form['metadata_license_id']:
             md.metadata_license_id = request.form['metadata_license_id'] or None
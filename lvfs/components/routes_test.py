@@ -9,6 +9,7 @@
 
 import os
 import sys
+import hashlib
 import unittest
 
 sys.path.append(os.path.realpath('.'))
@@ -299,5 +300,21 @@ class LocalTestCase(LvfsTestCase):
         assert b'Removed device checksum' in rv.data, rv.data
         assert b'9d72ffd950d3bedcda99a197d760457e90f3d6f2a62b30b95a488511f0dfa4ad' not in rv.data, rv.data
 
+    def test_download_cached(self):
+
+        from lvfs.blobcache import blob_cache
+
+        # upload and download the component twice
+        self.login()
+        self.upload()
+        blob_cache.clear()
+        hits = blob_cache.hits
+        rv = self.app.get('/lvfs/components/1/download')
+        assert hashlib.sha1(rv.data).hexdigest() == 'c57c7de8f7029acc44a4bfad6efd6ab0a7092cc6', rv.data
+        assert len(blob_cache) == 1, blob_cache
+        rv = self.app.get('/lvfs/components/1/download')
+        assert hashlib.sha1(rv.data).hexdigest() == 'c57c7de8f7029acc44a4bfad6efd6ab0a7092cc6', rv.data
+        assert blob_cache.hits > hits, blob_cache.stats
+
 if __name__ == '__main__':
     unittest.main()
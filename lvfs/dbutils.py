@@ -153,6 +153,7 @@ def anonymize_db(db) -> None:
             md.filename_contents = 'firmware.bin'
             md.release_timestamp = 0
             md.version = _make_fake_version()
+            md.fix_version_sort()
             md.release_installed_size = random.randint(100000, 1000000)
             md.release_download_size = random.randint(200000, 1000000)
             md.screenshot_url = None
@@ -194,6 +195,8 @@ def init_db(db) -> None:
     from .licenses.models import License
     from .users.models import User, UserAction
     from .metadata.models import Remote
+    from .settings.models import SettingGeneration
+    from .components.models import ComponentShardClaimGeneration
     from .hash import _otp_hash
     if not db.session.query(Remote).filter(Remote.name == 'stable').first():
         db.session.add(Remote(name='stable', is_public=True))
@@ -247,6 +250,12 @@ def init_db(db) -> None:
                             display_name='Anonymous User',
                             vendor_id=1))
         db.session.commit()
+    if not db.session.query(SettingGeneration).first():
+        db.session.add(SettingGeneration(value=0))
+        db.session.commit()
+    if not db.session.query(ComponentShardClaimGeneration).first():
+        db.session.add(ComponentShardClaimGeneration(value=0))
+        db.session.commit()
 
 def drop_db(db) -> None:
     db.metadata.drop_all(bind=db.engine)
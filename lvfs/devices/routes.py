@@ -50,7 +50,8 @@ def route_status(vendor_id = None, category_id = None):
                         .join(Firmware)\
                         .filter((Firmware.vendor_id == vendor.vendor_id) | \
                                 (Firmware.vendor_odm_id == vendor.vendor_id))\
-                        .join(Remote).filter(Remote.name != 'deleted'):
+                        .join(Remote).filter(Remote.name != 'deleted')\
+                        .order_by(Component.version_sort.asc()):
 
         # permission check
         if not md.fw.check_acl('@view'):
@@ -80,9 +81,12 @@ def route_status(vendor_id = None, category_id = None):
             md_by_remote[md.fw.remote.key] = md
             continue
 
-        # replace with newer version
-        if md > old_md:
-            md_by_remote[md.fw.remote.key] = md
+        # replace with newer version, where the rows are already in version
+        # order unless the sortable version has not been backfilled yet
+        if not md.version_sort or not old_md.version_sort:
+            if md < old_md:
+                continue
+        md_by_remote[md.fw.remote.key] = md
 
     return render_template('device-status.html',
                            category='firmware',
@@ -116,7 +120,8 @@ def route_status_csv(vendor_id=None, category_id=None):
                         .join(Firmware)\
                         .filter((Firmware.vendor_id == vendor.vendor_id) | \
                                 (Firmware.vendor_odm_id == vendor.vendor_id))\
-                        .join(Remote).filter(Remote.name != 'deleted'):
+                        .join(Remote).filter(Remote.name != 'deleted')\
+                        .order_by(Component.version_sort.asc()):
 
         # permission check
         if not md.fw.check_acl('@view'):
@@ -142,9 +147,12 @@ def route_status_csv(vendor_id=None, category_id=None):
             md_by_remote[md.fw.remote.key] = md
             continue
 
-        # replace with newer version
-        if md > old_md:
-            md_by_remote[md.fw.remote.key] = md
+        # replace with newer version, where the rows are already in version
+        # order unless the sortable version has not been backfilled yet
+        if not md.version_sort or not old_md.version_sort:
+            if md < old_md:
+                continue
+        md_by_remote[md.fw.remote.key] = md
 
     # header
     csv: List[str] = []
@@ -8,17 +8,19 @@
 # pylint: disable=too-few-public-methods,protected-access,too-many-instance-attributes
 
 import os
+import mmap
 import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 from flask import g, url_for
 
 from sqlalchemy import Column, Integer, Text, String, DateTime, Boolean, ForeignKey
 from sqlalchemy.orm import relationship
 
-from cabarchive import CabArchive
+from cabarchive import CabArchive, CabReader, NotSupportedError
 
 from lvfs import app, db
+from lvfs.blobcache import blob_cache
 
 from lvfs.vendors.models import VendorAffiliation
 from lvfs.users.models import User
@@ -413,17 +415,37 @@ class Firmware(db.Model):
     def absolute_path(self) -> str:
         return os.path.join(app.config["DOWNLOAD_DIR"], self.filename)
 
-    def _ensure_blobs(self) -> None:
+    def _ensure_blobs(self, mds: Optional[List[Component]] = None) -> Dict[str, bytes]:
+        """ Loads the blobs of just the requested components into the blob cache """
+        if mds is None:
+            mds = self.mds
+        blobs: Dict[str, bytes] = {}
         try:
             with open(self.absolute_path, "rb") as f:
+                try:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                        cabarchive = CabReader(buf)
+                        for md in mds:
+                            cabfile = cabarchive.get(md.filename_contents)
+                            if cabfile:
+                                blobs[md.filename_contents] = cabfile.buf
+                                blob_cache.set(md.checksum_contents_sha256, cabfile.buf)
+                    return blobs
+                except (ValueError, NotSupportedError) as _:
+                    pass
+
+                # fall back to GCab for compression types we cannot inflate,
+                # and as everything is decompressed anyway cache all components
+                f.seek(0)
                 cabarchive = CabArchive(f.read())
         except FileNotFoundError as _:
-            return
+            return blobs
         for md in self.mds:
-            try:
-                md._blob = cabarchive[md.filename_contents].buf
-            except KeyError as _:
-                pass
+            cabfile = cabarchive.get(md.filename_contents)
+            if cabfile:
+                blobs[md.filename_contents] = cabfile.buf
+                blob_cache.set(md.checksum_contents_sha256, cabfile.buf)
+        return blobs
 
     def _is_vendor(self, user) -> bool:
         return self.vendor_id == user.vendor_id
@@ -184,10 +184,12 @@ def route_nuke(firmware_id):
     if os.path.exists(fw.absolute_path):
         os.remove(fw.absolute_path)
 
-    # delete shard cache if they exist
+    # delete shard cache if they exist; shared blobs are removed when unused
     for md in fw.mds:
         for shard in md.shards:
-            fn = shard.absolute_path
+            if shard.shard_blob:
+                continue
+            fn = shard.legacy_path
             if os.path.exists(fn):
                 os.remove(fn)
 
@@ -12,6 +12,7 @@ import sys
 import unittest
 import gzip
 import io
+import datetime
 
 sys.path.append(os.path.realpath('.'))
 
@@ -218,6 +219,134 @@ class LocalTestCase(LvfsTestCase):
         rv = self.app.get('/lvfs/firmware/1/problems')
         assert b'Firmware is unsigned' not in rv.data, rv.data
 
+    def test_cron_firmware_resign(self):
+
+        from lvfs import app, db
+        from lvfs.firmware.models import Firmware
+        from lvfs.firmware.utils import _sign_firmware_all
+
+        self.login()
+        self.add_namespace()
+        self.upload('embargo')
+
+        # claimed by another worker, so skipped
+        with app.test_request_context():
+            fw = db.session.query(Firmware).filter(Firmware.firmware_id == 1).one()
+            fw.regenerate_ts = datetime.datetime.utcnow()
+            db.session.commit()
+            _sign_firmware_all()
+            assert not fw.signed_timestamp
+
+            # the other worker went away
+            fw.regenerate_ts = datetime.datetime.utcnow() - datetime.timedelta(hours=3)
+            db.session.commit()
+        self.run_cron_firmware()
+
+        # re-sign everything signed before now
+        with app.test_request_context():
+            fw = db.session.query(Firmware).filter(Firmware.firmware_id == 1).one()
+            signed_timestamp = fw.signed_timestamp
+            assert signed_timestamp
+            assert not fw.regenerate_ts
+            _sign_firmware_all(datetime.datetime.utcnow())
+            assert fw.signed_timestamp > signed_timestamp
+
+    def test_sign_firmware_batch(self):
+
+        from concurrent.futures import ThreadPoolExecutor
+        from lvfs import app, db
+        from lvfs.firmware.models import Firmware
+        from lvfs.firmware.utils import _sign_firmware_batch
+
+        self.login()
+        self.add_namespace()
+        self.upload('embargo')
+
+        # signed in a worker thread with its own session
+        with app.test_request_context():
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                sizes = _sign_firmware_batch([1], executor)
+            assert list(sizes) == [1], sizes
+            assert sizes[1] > 0, sizes
+            fw = db.session.query(Firmware).filter(Firmware.firmware_id == 1).one()
+            assert fw.signed_timestamp
+            assert not fw.regenerate_ts
+
+    def test_embargo_obsoleted(self):
+
+        from flask import g
+        from lvfs import app, db
+        from lvfs.firmware.models import Firmware
+        from lvfs.metadata.models import Remote
+        from lvfs.users.models import User
+        from lvfs.firmware.utils import _delete_embargo_obsoleted_fw
+
+        # an old embargoed firmware, and something else
+        self.login()
+        self.add_namespace()
+        self.upload('embargo')
+        self.upload(filename='contrib/intelme.cab', target='private')
+        with app.test_request_context():
+            g.user = db.session.query(User).filter(User.user_id == 1).one()
+            fw = db.session.query(Firmware).filter(Firmware.firmware_id == 1).one()
+            for ev in fw.events:
+                ev.timestamp = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+            db.session.commit()
+
+            # no public version
+            _delete_embargo_obsoleted_fw()
+            assert not fw.is_deleted
+
+            # the other firmware is now a newer public version
+            fw_new = db.session.query(Firmware).filter(Firmware.firmware_id == 2).one()
+            fw_new.remote = db.session.query(Remote).filter(Remote.name == 'stable').one()
+            fw_new.mds[0].appstream_id = fw.mds[0].appstream_id
+            fw_new.mds[0].version_sort = fw.mds[0].version_sort
+            db.session.commit()
+            _delete_embargo_obsoleted_fw()
+            assert not fw.is_deleted
+            fw_new.mds[0].version_sort = fw.mds[0].version_sort + 'f'
+            db.session.commit()
+            _delete_embargo_obsoleted_fw()
+            assert fw.is_deleted
+
+    def test_purge_deleted(self):
+
+        from lvfs import app, db
+        from lvfs.firmware.models import Firmware
+        from lvfs.firmware.utils import _purge_old_deleted_firmware
+
+        self.login()
+        self.upload()
+        self.delete_firmware()
+        with app.test_request_context():
+            fw = db.session.query(Firmware).filter(Firmware.firmware_id == 1).one()
+            fn = fw.absolute_path
+            assert os.path.exists(fn)
+
+            # deleted too recently
+            assert _purge_old_deleted_firmware()['firmware'] == 0
+            for ev in fw.events:
+                ev.timestamp = datetime.datetime.utcnow() - datetime.timedelta(days=60)
+            db.session.commit()
+
+            # estimate only
+            stats = _purge_old_deleted_firmware(dry_run=True)
+            assert stats['firmware'] == 1, stats
+            assert stats['rows']['components'] == 1, stats
+            assert stats['rows']['firmware'] == 1, stats
+            assert stats['files'] >= 1, stats
+            assert os.path.exists(fn)
+
+            # purge, continuing from the cursor finds nothing more
+            stats = _purge_old_deleted_firmware()
+            assert stats['firmware'] == 1, stats
+            assert stats['rows']['firmware'] == 1, stats
+            assert stats['cursor'] == 1, stats
+            assert not os.path.exists(fn)
+            assert not db.session.query(Firmware).filter(Firmware.firmware_id == 1).first()
+            assert _purge_old_deleted_firmware(stats={'cursor': 1})['firmware'] == 0
+
     def test_user_only_view_own_firmware(self):
 
         # create User:alice, User:bob, Analyst:clara, and QA:mario
@@ -8,28 +8,42 @@
 # pylint: disable=singleton-comparison
 
 import os
+import time
 import difflib
-import hashlib
 import datetime
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Optional, Dict, List, Set
 
 from lxml import etree as ET
 from flask import render_template, g
+from sqlalchemy import func, or_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Query
 
 from jcat import JcatFile, JcatBlobSha1, JcatBlobSha256, JcatBlobKind
-from cabarchive import CabArchive, CabFile
+from cabarchive import CabArchive, CabFile, CabWriter
 
-from lvfs import db, tq, ploader
+from lvfs import app, db, tq, ploader
 
-from lvfs.components.models import Component
+from lvfs.analytics.models import AnalyticFirmware
+from lvfs.components.models import Component, ComponentShard, ComponentShardBlob
+from lvfs.components.models import ComponentShardChecksum, ComponentShardCertificate
+from lvfs.components.models import ComponentShardAttribute, ComponentShardMicrocode
+from lvfs.components.models import ComponentRequirement, ComponentIssue, ComponentClaim
+from lvfs.components.models import ComponentChecksum, ComponentGuid, ComponentKeyword, ComponentRef
 from lvfs.emails import send_email
 from lvfs.metadata.models import Remote
 from lvfs.metadata.utils import _generate_metadata_mds, _async_regenerate_remote
 from lvfs.metadata.utils import _regenerate_and_sign_metadata_remote
+from lvfs.main.models import Client
+from lvfs.queries.models import YaraQueryResult
+from lvfs.reports.models import Report, ReportAttribute
+from lvfs.tests.models import Test, TestAttribute
 from lvfs.util import _event_log
 
-from .models import Firmware, FirmwareEvent
+from .models import Firmware, FirmwareEvent, FirmwareLimit
 
 def _firmware_delete(fw: Firmware) -> None:
 
@@ -50,45 +64,46 @@ def _firmware_delete(fw: Firmware) -> None:
     # asynchronously sign
     _async_regenerate_remote.apply_async(args=(fw.remote.remote_id,), queue='metadata')
 
+def _firmware_ids_unchanged_for(duration: datetime.timedelta):
+    """ Firmware where the most recent event is older than the duration """
+    ts = datetime.datetime.utcnow() - duration
+    return db.session.query(FirmwareEvent.firmware_id)\
+                     .group_by(FirmwareEvent.firmware_id)\
+                     .having(func.max(FirmwareEvent.timestamp) < ts)
+
+def _public_version_sort_latest():
+    """ The newest sortable version in a public remote for each AppStream ID """
+    return db.session.query(Component.appstream_id,
+                            func.max(Component.version_sort).label('version_sort'))\
+                     .join(Firmware)\
+                     .join(Remote)\
+                     .filter(Remote.is_public)\
+                     .group_by(Component.appstream_id)\
+                     .subquery()
+
 def _delete_embargo_obsoleted_fw():
 
-    # all embargoed firmware
+    # embargoed for at least 6 months, i.e. since the most recent event
+    fw_ids_stale = _firmware_ids_unchanged_for(datetime.timedelta(days=30*6))
+
+    # components without a newer public version, including any where the
+    # sortable version has not been backfilled yet
+    latest = _public_version_sort_latest()
+    fw_ids_current = db.session.query(Component.firmware_id)\
+                               .outerjoin(latest, latest.c.appstream_id == Component.appstream_id)\
+                               .filter(or_(Component.version_sort == None,
+                                           latest.c.version_sort == None,
+                                           latest.c.version_sort <= Component.version_sort))
+
+    # all embargoed firmware where every component is available with a new version
     emails = defaultdict(list)
     for fw in db.session.query(Firmware)\
                         .join(Remote)\
                         .filter(Remote.name.startswith('embargo'))\
-                        .order_by(Firmware.timestamp.asc()):
-
-        # less than 6 months old
-        if fw.target_duration < datetime.timedelta(days=30*6):
-            continue
-
-        # check that all the components are available with new versions
-        all_newer = True
-        print('{} {} {}'.format(fw.target_duration, fw.remote.name, fw.version_display))
-        for md in fw.mds:
-            md_newest = None
-            for md_new in db.session.query(Component)\
-                                    .join(Firmware)\
-                                    .join(Remote)\
-                                    .filter(Remote.is_public)\
-                                    .filter(Component.appstream_id == md.appstream_id)\
-                                    .order_by(Firmware.timestamp.asc()):
-                if md_new > md or (md_newest and md_new > md_newest):
-                    md_newest = md_new
-                    break
-            if not md_newest:
-                all_newer = False
-                print('no newer version of {} {}'.format(md.appstream_id,
-                                                         md.version_display))
-                break
-            print('{} {} [{}] is newer than {} [{}]'.format(md.appstream_id,
-                                                            md_newest.version_display,
-                                                            md_newest.fw.remote.name,
-                                                            md.version_display,
-                                                            md.fw.remote.name))
-        if not all_newer:
-            continue
+                        .filter(Firmware.firmware_id.in_(fw_ids_stale))\
+                        .filter(~Firmware.firmware_id.in_(fw_ids_current))\
+                        .order_by(Firmware.timestamp.asc()).all():
+        print('{} {} {} is obsoleted'.format(fw.target_duration, fw.remote.name, fw.version_display))
 
         # delete, but not purge...
         _firmware_delete(fw)
@@ -106,31 +121,160 @@ def _delete_embargo_obsoleted_fw():
     # all done
     db.session.commit()
 
-def _purge_old_deleted_firmware():
-
-    # find all unsigned firmware
-    for firmware_id, in db.session.query(Firmware.firmware_id)\
-                                  .join(Remote).filter(Remote.name == 'deleted')\
-                                  .order_by(Firmware.timestamp.asc()):
-        fw = db.session.query(Firmware)\
-                       .filter(Firmware.firmware_id == firmware_id)\
-                       .one()
-        if fw.target_duration > datetime.timedelta(days=30):
-            print('Deleting %s as age %s' % (fw.filename, fw.target_duration))
-            if os.path.exists(fw.absolute_path):
-                os.remove(fw.absolute_path)
-            for md in fw.mds:
-                for shard in md.shards:
-                    path = shard.absolute_path
-                    if os.path.exists(path):
-                        os.remove(path)
-            db.session.delete(fw)
-            db.session.commit()
-
-@tq.task(max_retries=3, default_retry_delay=360, task_time_limit=60)
-def _async_autodelete():
-    _delete_embargo_obsoleted_fw()
-    _purge_old_deleted_firmware()
+def _purge_file(fn: str, dry_run: bool = False) -> int:
+    """ Returns the size of the file that was removed, or 0 if it did not exist """
+    try:
+        size = os.path.getsize(fn)
+        if not dry_run:
+            os.remove(fn)
+    except FileNotFoundError as _:
+        return 0
+    return size
+
+def _purge_batch_stmts(firmware_ids: List[int]) -> List[Query]:
+    """ The set-based deletes for a batch of firmware, children first """
+
+    md_ids = db.session.query(Component.component_id)\
+                       .filter(Component.firmware_id.in_(firmware_ids))
+    shard_ids = db.session.query(ComponentShard.component_shard_id)\
+                          .filter(ComponentShard.component_id.in_(md_ids))
+    test_ids = db.session.query(Test.test_id)\
+                         .filter(Test.firmware_id.in_(firmware_ids))
+    report_ids = db.session.query(Report.report_id)\
+                           .filter(Report.firmware_id.in_(firmware_ids))
+    stmts = []
+    for cls in [ComponentShardChecksum,
+                ComponentShardCertificate,
+                ComponentShardAttribute,
+                ComponentShardMicrocode]:
+        stmts.append(db.session.query(cls).filter(cls.component_shard_id.in_(shard_ids)))
+    stmts.append(db.session.query(YaraQueryResult)\
+                           .filter(or_(YaraQueryResult.component_id.in_(md_ids),
+                                       YaraQueryResult.component_shard_id.in_(shard_ids))))
+    stmts.append(db.session.query(ComponentShard).filter(ComponentShard.component_id.in_(md_ids)))
+    for cls in [ComponentRequirement,
+                ComponentIssue,
+                ComponentClaim,
+                ComponentChecksum,
+                ComponentGuid,
+                ComponentKeyword,
+                ComponentRef]:
+        stmts.append(db.session.query(cls).filter(cls.component_id.in_(md_ids)))
+    stmts.append(db.session.query(Component).filter(Component.firmware_id.in_(firmware_ids)))
+    stmts.append(db.session.query(TestAttribute).filter(TestAttribute.test_id.in_(test_ids)))
+    stmts.append(db.session.query(ReportAttribute).filter(ReportAttribute.report_id.in_(report_ids)))
+    for cls in [Test, Report, Client, AnalyticFirmware, FirmwareEvent, FirmwareLimit]:
+        stmts.append(db.session.query(cls).filter(cls.firmware_id.in_(firmware_ids)))
+    stmts.append(db.session.query(Firmware).filter(Firmware.firmware_id.in_(firmware_ids)))
+    return stmts
+
+def _purge_batch(firmware_ids: List[int],
+                 executor: ThreadPoolExecutor,
+                 stats: Dict[str, Any],
+                 dry_run: bool = False) -> None:
+
+    # the archives, and any shards written before they were deduplicated
+    fns: List[str] = []
+    for filename, in db.session.query(Firmware.filename)\
+                               .filter(Firmware.firmware_id.in_(firmware_ids)):
+        fns.append(os.path.join(app.config['DOWNLOAD_DIR'], filename))
+    for shard in db.session.query(ComponentShard)\
+                           .join(Component)\
+                           .filter(Component.firmware_id.in_(firmware_ids))\
+                           .filter(ComponentShard.component_shard_blob_id == None):
+        fns.append(shard.legacy_path)
+    for size in executor.map(lambda fn: _purge_file(fn, dry_run), fns):
+        if size:
+            stats['files'] += 1
+            stats['bytes'] += size
+
+    # just count what would be deleted
+    stmts = _purge_batch_stmts(firmware_ids)
+    if dry_run:
+        for stmt in stmts:
+            tablename = stmt.column_descriptions[0]['entity'].__tablename__
+            stats['rows'][tablename] = stats['rows'].get(tablename, 0) + stmt.count()
+        return
+
+    # bulk deletes do not run the after_delete event, so drop the references
+    # on the shared blobs here; the files are removed by _shard_blobs_gc()
+    md_ids = db.session.query(Component.component_id)\
+                       .filter(Component.firmware_id.in_(firmware_ids))
+    cnt = db.session.query(func.count(ComponentShard.component_shard_id))\
+                    .filter(ComponentShard.component_shard_blob_id == ComponentShardBlob.component_shard_blob_id)\
+                    .filter(ComponentShard.component_id.in_(md_ids))\
+                    .correlate(ComponentShardBlob)\
+                    .as_scalar()
+    blob_ids = db.session.query(ComponentShard.component_shard_blob_id)\
+                         .filter(ComponentShard.component_id.in_(md_ids))
+    db.session.query(ComponentShardBlob)\
+              .filter(ComponentShardBlob.component_shard_blob_id.in_(blob_ids))\
+              .update({ComponentShardBlob.refcnt: ComponentShardBlob.refcnt - cnt},
+                      synchronize_session=False)
+    for stmt in stmts:
+        tablename = stmt.column_descriptions[0]['entity'].__tablename__
+        stats['rows'][tablename] = stats['rows'].get(tablename, 0) + \
+                                   stmt.delete(synchronize_session=False)
+    db.session.commit()
+
+def _purge_old_deleted_firmware(dry_run: bool = False,
+                                stats: Optional[Dict[str, Any]] = None,
+                                max_workers: Optional[int] = None) -> Dict[str, Any]:
+    """ Purges firmware deleted over 30 days ago, returning the number of rows and files
+
+    Each batch is committed on its own so that locks are only held briefly, and
+    stats['cursor'] is the last firmware ID that was purged, which can be passed
+    back in to continue. The rows for each table are counted in stats['rows'].
+    When dry_run is set nothing is changed.
+    """
+
+    if stats is None:
+        stats = {}
+    for key in ['cursor', 'firmware', 'files', 'bytes']:
+        stats.setdefault(key, 0)
+    stats.setdefault('rows', {})
+    fw_ids_stale = _firmware_ids_unchanged_for(datetime.timedelta(days=30))
+    batch_size = app.config.get('PURGE_BATCH_SIZE', 50)
+    if not max_workers:
+        max_workers = app.config.get('PURGE_WORKERS', 8)
+    ts = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            firmware_ids = [firmware_id for firmware_id, in \
+                            db.session.query(Firmware.firmware_id)\
+                                      .join(Remote)\
+                                      .filter(Remote.name == 'deleted')\
+                                      .filter(Firmware.firmware_id > stats['cursor'])\
+                                      .filter(Firmware.firmware_id.in_(fw_ids_stale))\
+                                      .order_by(Firmware.firmware_id.asc())\
+                                      .limit(batch_size)]
+            if not firmware_ids:
+                break
+            _purge_batch(firmware_ids, executor, stats, dry_run=dry_run)
+            stats['firmware'] += len(firmware_ids)
+            stats['cursor'] = firmware_ids[-1]
+            print('{} {} firmware up to ID {}, {} files, {:.1f} MB in {:.0f}s'\
+                  .format('Would purge' if dry_run else 'Purged',
+                          stats['firmware'], stats['cursor'], stats['files'],
+                          stats['bytes'] / 0x100000, time.monotonic() - ts))
+
+    # log
+    if stats['firmware'] and not dry_run:
+        _event_log('Purged {} deleted firmware and {} files'.format(stats['firmware'], stats['files']))
+    return stats
+
+@tq.task(bind=True, max_retries=3, default_retry_delay=360, task_time_limit=3600)
+def _async_autodelete(self, cursor: int = 0):
+    if not cursor:
+        _delete_embargo_obsoleted_fw()
+
+    # continue from the last batch that was committed
+    stats = {'cursor': cursor}
+    try:
+        _purge_old_deleted_firmware(stats=stats)
+    except (OSError, SQLAlchemyError) as e:
+        db.session.rollback()
+        raise self.retry(exc=e, args=(stats['cursor'],))
 
 def _show_diff(blob_old: bytes, blob_new: bytes) -> None:
     fromlines = blob_old.decode().replace('\r', '').split('\n')
@@ -153,11 +297,25 @@ def _async_sign_fw(firmware_id):
     if not fw.remote.is_public:
         _regenerate_and_sign_metadata_remote(fw.remote)
 
-def _sign_fw(fw):
+def _sign_fw_claim(fw: Firmware) -> bool:
+    """ Atomically marks the firmware as being signed by this worker """
+
+    # only one conditional update can win, even across hosts
+    now = datetime.datetime.utcnow()
+    rowcount = db.session.query(Firmware)\
+                         .filter(Firmware.firmware_id == fw.firmware_id)\
+                         .filter(or_(Firmware.regenerate_ts == None,
+                                     Firmware.regenerate_ts < now - datetime.timedelta(hours=2)))\
+                         .update({Firmware.regenerate_ts: now}, synchronize_session=False)
+    db.session.commit()
+    return rowcount == 1
+
+def _sign_fw(fw: Firmware) -> int:
+    """ Returns the size of the signed archive, or 0 if it is being signed elsewhere """
 
     # already being regenerated
     if fw.is_regenerating:
-        return
+        return 0
 
     # load the .cab file
     fn = fw.absolute_path
@@ -167,9 +325,9 @@ def _sign_fw(fw):
     except IOError as e:
         raise NotImplementedError('cannot read %s' % fn) from e
 
-    # claim this
-    fw.regenerate_ts = datetime.datetime.utcnow()
-    db.session.commit()
+    # claim this, unless another worker got there first
+    if not _sign_fw_claim(fw):
+        return 0
 
     # create Jcat file
     jcatfile = JcatFile()
@@ -226,43 +384,135 @@ def _sign_fw(fw):
     # update archive with extra files
     ploader.archive_finalize(cabarchive, fw)
 
-    # overwrite old file
-    cab_data = cabarchive.save()
-    with open(fn, 'wb') as f:
-        f.write(cab_data)
+    # overwrite old file, hashing as it is written
+    cabwriter = CabWriter(cabarchive)
+    cabwriter.save(fn, digests=['sha1', 'sha256'])
 
     # inform the plugin loader
     ploader.file_modified(fn)
 
     # update the download size
     for md in fw.mds:
-        md.release_download_size = len(cab_data)
+        md.release_download_size = cabwriter.size
 
     # update the database
-    fw.checksum_signed_sha1 = hashlib.sha1(cab_data).hexdigest()
-    fw.checksum_signed_sha256 = hashlib.sha256(cab_data).hexdigest()
+    fw.checksum_signed_sha1 = cabwriter.checksums['sha1']
+    fw.checksum_signed_sha256 = cabwriter.checksums['sha256']
     fw.signed_timestamp = datetime.datetime.utcnow()
 
     # release this
     fw.regenerate_ts = None
     db.session.commit()
+    ploader.flush_modified()
 
     # log
     _event_log('Signed firmware %s' % fw.firmware_id)
+    return cabwriter.size
+
+def _sign_fw_by_id(firmware_id: int) -> int:
+    fw = db.session.query(Firmware)\
+                   .filter(Firmware.firmware_id == firmware_id)\
+                   .first()
+    if not fw or fw.is_deleted:
+        return 0
+    return _sign_fw(fw)
 
-def _sign_firmware_all():
+def _sign_fw_by_id_thread(firmware_id: int) -> int:
 
-    # find all unsigned firmware
-    fws = db.session.query(Firmware)\
-                    .filter(Firmware.signed_timestamp == None).all()
-    if not fws:
+    # each thread gets a new session from the scoped session registry
+    with app.app_context():
+        try:
+            return _sign_fw_by_id(firmware_id)
+        finally:
+            db.session.remove()
+
+def _sign_firmware_batch(firmware_ids: List[int],
+                         executor: Optional[ThreadPoolExecutor] = None) -> Dict[int, int]:
+    """ Returns the archive size of each firmware that was signed """
+
+    futures: Dict[int, Future] = {}
+    if executor:
+        for firmware_id in firmware_ids:
+            futures[firmware_id] = executor.submit(_sign_fw_by_id_thread, firmware_id)
+    sizes: Dict[int, int] = {}
+    for firmware_id in firmware_ids:
+        try:
+            if executor:
+                size = futures[firmware_id].result()
+            else:
+                size = _sign_fw_by_id(firmware_id)
+        except (IOError, NotImplementedError) as e:
+            _event_log('Failed to sign firmware %s: %s' % (firmware_id, str(e)))
+            continue
+        if size:
+            sizes[firmware_id] = size
+
+    # the firmware was committed by the other sessions
+    if executor:
+        db.session.expire_all()
+    return sizes
+
+def _sign_firmware_regenerate_remotes(firmware_ids: Set[int]) -> None:
+
+    # the metadata is regenerated once per batch rather than once per firmware,
+    # and remotes that are still being regenerated are left dirty for later
+    for r in db.session.query(Remote)\
+                       .join(Firmware)\
+                       .filter(Firmware.firmware_id.in_(firmware_ids))\
+                       .distinct():
+        r.is_dirty = True
+        if r.is_public or r.is_regenerating:
+            continue
+        _async_regenerate_remote.apply_async(args=(r.remote_id,), queue='metadata')
+    db.session.commit()
+
+def _sign_firmware_all(signed_before: Optional[datetime.datetime] = None,
+                       max_workers: Optional[int] = None) -> None:
+    """ Signs all unsigned firmware, or re-signs everything signed before a date """
+
+    # the checkpoint is the signed timestamp itself, so a re-sign that was
+    # interrupted only has to process the firmware that was not yet done
+    stmt = db.session.query(Firmware.firmware_id)
+    if signed_before:
+        stmt = stmt.filter(or_(Firmware.signed_timestamp == None,
+                               Firmware.signed_timestamp < signed_before))
+    else:
+        stmt = stmt.filter(Firmware.signed_timestamp == None)
+    firmware_ids = [firmware_id for firmware_id, in stmt.order_by(Firmware.firmware_id.asc())]
+    if not firmware_ids:
         return
 
-    # sign each firmware in each file
-    for fw in fws:
-        if fw.is_deleted:
-            continue
-        _sign_fw(fw)
+    # sqlite cannot write from more than one connection at a time
+    if not max_workers:
+        max_workers = app.config.get('SIGN_WORKERS') or os.cpu_count() or 1
+    if db.engine.name == 'sqlite':
+        max_workers = 1
+
+    # each batch is small so that only a few archives are in memory at once
+    batch_size = max_workers * 4
+    cnt: int = 0
+    size: int = 0
+    ts = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i in range(0, len(firmware_ids), batch_size):
+            sizes = _sign_firmware_batch(firmware_ids[i:i + batch_size],
+                                         executor if max_workers > 1 else None)
+            if sizes:
+                _sign_firmware_regenerate_remotes(set(sizes))
+            cnt += len(sizes)
+            size += sum(sizes.values())
+            elapsed = max(time.monotonic() - ts, 0.001)
+            print('Signed %u/%u firmware, %.1f/s, %.1f MB/s' % (cnt, len(firmware_ids),
+                                                                  cnt / elapsed,
+                                                                  size / elapsed / 0x100000))
 
-    # drop caches in other sessions
-    #db.session.expire_all()
+    # log
+    if cnt > 1:
+        _event_log('Signed %u firmware in %.0fs' % (cnt, time.monotonic() - ts))
+
+@tq.task(max_retries=3, default_retry_delay=600, task_time_limit=60 * 60 * 24, acks_late=True)
+def _async_sign_firmware_all(signed_before: Optional[float] = None):
+    if signed_before:
+        _sign_firmware_all(datetime.datetime.utcfromtimestamp(signed_before))
+    else:
+        _sign_firmware_all()
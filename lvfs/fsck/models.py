@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=too-few-public-methods
+
+import datetime
+
+from sqlalchemy import Column, Integer, Text, DateTime, ForeignKey
+from sqlalchemy.orm import relationship
+
+from lvfs import db
+
+
+class FsckReportItem(db.Model):
+
+    __tablename__ = "fsck_report_items"
+
+    fsck_report_item_id = Column(Integer, primary_key=True)
+    fsck_report_id = Column(
+        Integer, ForeignKey("fsck_reports.fsck_report_id"), nullable=False, index=True
+    )
+    filename = Column(Text, nullable=False)
+    message = Column(Text, default=None)
+
+    report = relationship("FsckReport", back_populates="items")
+
+    def __repr__(self) -> str:
+        return "FsckReportItem object %s" % self.fsck_report_item_id
+
+
+class FsckReport(db.Model):
+
+    __tablename__ = "fsck_reports"
+
+    fsck_report_id = Column(Integer, primary_key=True)
+    kind = Column(Text, nullable=False)
+    started_ts = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    ended_ts = Column(DateTime, default=None)
+    total = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+
+    items = relationship(
+        "FsckReportItem",
+        order_by="FsckReportItem.filename",
+        back_populates="report",
+        cascade="all,delete,delete-orphan",
+    )
+
+    @property
+    def color(self) -> str:
+        if not self.ended_ts:
+            return "info"
+        if self.failed:
+            return "danger"
+        return "success"
+
+    def __repr__(self) -> str:
+        return "FsckReport object %s" % self.fsck_report_id
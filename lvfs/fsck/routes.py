@@ -5,6 +5,7 @@
 #
 # SPDX-License-Identifier: GPL-2.0+
 
+import time
 from collections import defaultdict
 from typing import Dict
 
@@ -18,8 +19,15 @@ from lvfs.components.models import Component
 from lvfs.licenses.models import License
 from lvfs.users.models import User
 from lvfs.analytics.utils import _async_generate_stats
+from lvfs.firmware.utils import _async_sign_firmware_all
+from lvfs.shards.utils import _async_shard_blobs_migrate
 
-from .utils import _async_fsck_update_descriptions
+from .models import FsckReport
+from .utils import (
+    _async_fsck_update_descriptions,
+    _async_fsck_verify_checksums,
+    _async_fsck_version_sort,
+)
 
 bp_fsck = Blueprint("fsck", __name__, template_folder="templates")
 
@@ -28,7 +36,24 @@ bp_fsck = Blueprint("fsck", __name__, template_folder="templates")
 @login_required
 @admin_login_required
 def route_view():
-    return render_template("fsck.html", category="admin")
+    reports = (
+        db.session.query(FsckReport)
+        .order_by(FsckReport.fsck_report_id.desc())
+        .limit(5)
+        .all()
+    )
+    return render_template("fsck.html", category="admin", reports=reports)
+
+
+@bp_fsck.route("/verify_checksums", methods=["POST"])
+@login_required
+@admin_login_required
+def route_verify_checksums():
+
+    # asynchronously verified
+    flash("Verifying checksums of all archives and metadata", "info")
+    _async_fsck_verify_checksums.apply_async(queue="metadata")
+    return redirect(url_for("fsck.route_view"))
 
 
 @bp_fsck.route("/update_descriptions", methods=["POST"])
@@ -60,6 +85,45 @@ def route_generate_stats():
     return redirect(url_for("fsck.route_view"))
 
 
+@bp_fsck.route("/version_sort", methods=["POST"])
+@login_required
+@admin_login_required
+def route_version_sort():
+
+    # asynchronously rebuilt
+    flash("Updating sortable versions", "info")
+    _async_fsck_version_sort.apply_async(
+        args=("only_missing" in request.form,), queue="metadata"
+    )
+    return redirect(url_for("fsck.route_view"))
+
+
+@bp_fsck.route("/shard_blobs", methods=["POST"])
+@login_required
+@admin_login_required
+def route_shard_blobs():
+
+    # asynchronously moved
+    flash("Deduplicating shards", "info")
+    _async_shard_blobs_migrate.apply_async(queue="metadata")
+    return redirect(url_for("fsck.route_view"))
+
+
+@bp_fsck.route("/sign_firmware", methods=["POST"])
+@login_required
+@admin_login_required
+def route_sign_firmware():
+
+    # asynchronously signed, optionally including everything signed before now
+    if "only_unsigned" in request.form:
+        flash("Signing all unsigned firmware", "info")
+        _async_sign_firmware_all.apply_async(queue="firmware")
+    else:
+        flash("Re-signing all firmware", "info")
+        _async_sign_firmware_all.apply_async(args=(time.time(),), queue="firmware")
+    return redirect(url_for("fsck.route_view"))
+
+
 @bp_fsck.route("/lockdown", methods=["POST"])
 @login_required
 @admin_login_required
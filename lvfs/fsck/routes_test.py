@@ -24,6 +24,16 @@ class LocalTestCase(LvfsTestCase):
         rv = self.app.get("/lvfs/fsck/update_descriptions")
         assert b"Updating update descriptions" not in rv.data, rv.data.decode()
 
+    def test_sign_firmware(self):
+
+        self.login()
+        rv = self.app.post("/lvfs/fsck/sign_firmware", data=dict(
+            only_unsigned="on",
+        ), follow_redirects=True)
+        assert b"Signing all unsigned firmware" in rv.data, rv.data.decode()
+        rv = self.app.post("/lvfs/fsck/sign_firmware", follow_redirects=True)
+        assert b"Re-signing all firmware" in rv.data, rv.data.decode()
+
     def test_lockdown(self):
 
         # add a user and try to upload firmware without signing the agreement
@@ -35,6 +45,68 @@ class LocalTestCase(LvfsTestCase):
         rv = self._login("testuser@fwupd.org")
         assert b"User account is disabled" in rv.data, rv.data.decode()
 
+    def test_verify_checksums(self):
+
+        from lvfs import app, db
+        from lvfs.firmware.models import Firmware
+        from lvfs.fsck.utils import _fsck_verify_checksums
+
+        # upload a file that matches
+        self.login()
+        self.upload()
+        with app.test_request_context():
+            report = _fsck_verify_checksums(max_workers=2)
+            assert report.total == 1, report.total
+            assert report.failed == 0, report.items
+
+            # now break the database
+            fw = db.session.query(Firmware).first()
+            fw.checksum_signed_sha256 = "0" * 64
+            db.session.commit()
+            report = _fsck_verify_checksums(max_workers=2)
+            assert report.failed == 1, report.items
+        rv = self.app.get("/lvfs/fsck/")
+        assert b"File sha256 does not match" in rv.data, rv.data.decode()
+
+    def test_verify_checksums_metadata(self):
+
+        from lvfs import app
+        from lvfs.fsck.utils import _fsck_verify_checksums
+
+        # build the testing metadata for real
+        self.login()
+        self.upload()
+        self.run_cron_firmware()
+        rv = self.app.post("/lvfs/firmware/1/promote/testing", follow_redirects=True)
+        assert b">testing<" in rv.data, rv.data.decode()
+        self.run_cron_metadata(["testing"])
+
+        # the versioned and newest metadata are both checked against the Jcat file
+        with app.test_request_context():
+            report = _fsck_verify_checksums(max_workers=2)
+            assert report.total >= 3, report.total
+            assert report.failed == 0, [item.message for item in report.items]
+
+    def test_version_sort(self):
+
+        from lvfs import app, db
+        from lvfs.components.models import Component
+        from lvfs.fsck.utils import _fsck_version_sort
+
+        # set on upload
+        self.login()
+        self.upload()
+        with app.test_request_context():
+            md = db.session.query(Component).first()
+            assert md.version_sort == "2120121001213010", md.version_sort
+
+            # backfill
+            md.version_sort = None
+            db.session.commit()
+            assert _fsck_version_sort() == 1
+            md = db.session.query(Component).first()
+            assert md.version_sort == "2120121001213010", md.version_sort
+
 
 if __name__ == "__main__":
     unittest.main()
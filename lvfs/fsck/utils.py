@@ -4,10 +4,26 @@
 # Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
 #
 # SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=singleton-comparison
+
+import os
+import mmap
+import hashlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional, Iterator, Tuple, Set
+
+from cabarchive import CabReader, NotSupportedError
+from jcat import JcatFile, JcatBlobKind
 
-from lvfs import db, tq
+from lvfs import app, db, tq
 
 from lvfs.components.models import Component
+from lvfs.firmware.models import Firmware
+from lvfs.metadata.models import Remote
+
+from .models import FsckReport, FsckReportItem
 
 
 def _fsck_update_descriptions(search: str, replace: str) -> None:
@@ -23,3 +39,200 @@ def _fsck_update_descriptions(search: str, replace: str) -> None:
 @tq.task(max_retries=3, default_retry_delay=5, task_time_limit=600)
 def _async_fsck_update_descriptions(search: str, replace: str):
     _fsck_update_descriptions(search, replace)
+
+
+def _fsck_version_sort(only_missing: bool = True) -> int:
+
+    # process in batches so that the session does not hold every component
+    cnt = 0
+    component_id = 0
+    while True:
+        stmt = db.session.query(Component).filter(
+            Component.component_id > component_id
+        )
+        if only_missing:
+            stmt = stmt.filter(Component.version_sort == None)
+        mds = stmt.order_by(Component.component_id.asc()).limit(1000).all()
+        if not mds:
+            break
+        for md in mds:
+            try:
+                md.fix_version_sort()
+                cnt += 1
+            except (TypeError, ValueError) as _:
+                pass
+            component_id = md.component_id
+        db.session.commit()
+        db.session.expunge_all()
+    return cnt
+
+
+@tq.task(max_retries=3, default_retry_delay=5, task_time_limit=3600)
+def _async_fsck_version_sort(only_missing: bool = True):
+    _fsck_version_sort(only_missing)
+
+
+def _jcat_item_checksums(jcatfile: JcatFile, jid: str) -> Dict[str, str]:
+    checksums: Dict[str, str] = {}
+    jcatitem = jcatfile.find_item(jid)
+    if not jcatitem:
+        return checksums
+    for blob in jcatitem.blobs:
+        if blob.kind == JcatBlobKind.SHA1:
+            checksums["sha1"] = blob.data.decode()
+        elif blob.kind == JcatBlobKind.SHA256:
+            checksums["sha256"] = blob.data.decode()
+    return checksums
+
+
+def _fsck_verify_file(
+    fn: str,
+    checksums: Dict[str, str],
+    fn_jcat: Optional[str] = None,
+    jid: Optional[str] = None,
+) -> List[str]:
+    """ Checks one file, returning a list of problems; called from a worker thread """
+
+    problems: List[str] = []
+
+    # checksums stored in a detached Jcat file
+    if fn_jcat:
+        try:
+            with open(fn_jcat, "rb") as f:
+                jcatfile = JcatFile(f.read())
+        except (OSError, ValueError) as e:
+            return ["Failed to load {}: {}".format(os.path.basename(fn_jcat), str(e))]
+        jcat_checksums = _jcat_item_checksums(jcatfile, jid or os.path.basename(fn))
+        if not jcat_checksums:
+            problems.append("No checksums in {}".format(os.path.basename(fn_jcat)))
+        for kind, value in jcat_checksums.items():
+            if kind in checksums and checksums[kind] != value:
+                problems.append("Jcat {} does not match database".format(kind))
+            checksums[kind] = value
+
+    # hashlib releases the GIL so many of these can run at once
+    try:
+        with open(fn, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                csums = {kind: hashlib.new(kind) for kind in checksums}
+                view = memoryview(buf)
+                try:
+                    for offset in range(0, len(buf), 0x100000):
+                        for csum in csums.values():
+                            csum.update(view[offset : offset + 0x100000])
+                finally:
+                    view.release()
+                for kind, csum in csums.items():
+                    if csum.hexdigest() != checksums[kind]:
+                        problems.append("File {} does not match".format(kind))
+
+                # each archive member against the embedded Jcat file
+                if fn.endswith(".cab"):
+                    problems.extend(_fsck_verify_archive(buf))
+    except FileNotFoundError as _:
+        problems.append("File does not exist")
+    except (OSError, ValueError) as e:
+        problems.append("Failed to read: {}".format(str(e)))
+    return problems
+
+
+def _fsck_verify_archive(buf: mmap.mmap) -> List[str]:
+
+    problems: List[str] = []
+    try:
+        cabarchive = CabReader(buf)
+        cabfile = cabarchive.get("firmware.jcat")
+        if not cabfile:
+            return problems
+        jcatfile = JcatFile(cabfile.buf)
+        for jcatitem in jcatfile.items:
+            cabfile = cabarchive.get(jcatitem.id)
+            if not cabfile:
+                problems.append("No {} in archive".format(jcatitem.id))
+                continue
+            for kind, value in _jcat_item_checksums(jcatfile, jcatitem.id).items():
+                if hashlib.new(kind, cabfile.buf).hexdigest() != value:
+                    problems.append("{} {} does not match".format(jcatitem.id, kind))
+    except (NotSupportedError, ValueError) as e:
+        problems.append("Failed to parse archive: {}".format(str(e)))
+    return problems
+
+
+def _fsck_verify_checksums_jobs() -> Iterator[
+    Tuple[str, Dict[str, str], Optional[str], Optional[str]]
+]:
+
+    download_dir = app.config["DOWNLOAD_DIR"]
+
+    # firmware archives, skipping any that are being signed right now
+    for filename, sha1, sha256, regenerate_ts in (
+        db.session.query(
+            Firmware.filename,
+            Firmware.checksum_signed_sha1,
+            Firmware.checksum_signed_sha256,
+            Firmware.regenerate_ts,
+        )
+        .order_by(Firmware.firmware_id.asc())
+        .yield_per(1000)
+    ):
+        if regenerate_ts and datetime.datetime.utcnow() < regenerate_ts.replace(
+            tzinfo=None
+        ) + datetime.timedelta(hours=2):
+            continue
+        yield (
+            os.path.join(download_dir, filename),
+            {"sha1": sha1, "sha256": sha256},
+            None,
+            None,
+        )
+
+    # metadata, using the detached Jcat file
+    for r in db.session.query(Remote):
+        if r.name in ["private", "deleted"] or not r.build_cnt or r.is_regenerating:
+            continue
+        # build_cnt has already been incremented for the next build
+        fn_built = r.filename_built
+        fn_jcat = os.path.join(download_dir, r.filename_newest + ".jcat")
+        for fn in [fn_built, r.filename_newest]:
+            yield (os.path.join(download_dir, fn), {}, fn_jcat, fn_built)
+
+
+def _fsck_verify_checksums(max_workers: Optional[int] = None) -> FsckReport:
+
+    report = FsckReport(kind="checksums")
+    db.session.add(report)
+    db.session.commit()
+
+    # only keep a bounded number of files in flight
+    if not max_workers:
+        max_workers = app.config.get("FSCK_WORKERS") or os.cpu_count() or 1
+    futures: Dict[Future, str] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def _collect(done: Set[Future]) -> None:
+            for future in done:
+                fn = futures.pop(future)
+                report.total += 1
+                problems = future.result()
+                if problems:
+                    report.failed += 1
+                for problem in problems:
+                    report.items.append(
+                        FsckReportItem(filename=os.path.basename(fn), message=problem)
+                    )
+
+        for fn, checksums, fn_jcat, jid in _fsck_verify_checksums_jobs():
+            if len(futures) >= max_workers * 4:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                _collect(done)
+            futures[executor.submit(_fsck_verify_file, fn, checksums, fn_jcat, jid)] = fn
+        _collect(set(futures))
+
+    report.ended_ts = datetime.datetime.utcnow()
+    db.session.commit()
+    return report
+
+
+@tq.task(max_retries=3, default_retry_delay=5, task_time_limit=86400)
+def _async_fsck_verify_checksums():
+    _fsck_verify_checksums()
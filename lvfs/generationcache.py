@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+
+import time
+import datetime
+import threading
+from typing import Any, Optional
+
+from lvfs import app, db
+
+
+class GenerationCache:
+    """ An in-memory copy of some database rows, kept by every process
+
+    The copy is reloaded when the generation counter in the database has been
+    bumped by any other web or celery process. The counter is a table with a
+    single row, and is only polled every SETTINGS_REFRESH_INTERVAL seconds
+    unless the caller asks for it to be checked now.
+    """
+
+    def __init__(self, model: Any) -> None:
+        self._model = model
+        self._generation: Optional[int] = None
+        self._db_uri: Optional[str] = None
+        self._checked_ts: float = 0
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def _get_generation(self) -> int:
+        gen = db.session.query(self._model.value).first()
+        if not gen:
+            return 0
+        return gen[0]
+
+    def _load(self) -> None:
+        raise NotImplementedError
+
+    def _ensure_loaded(self, check: bool = False) -> None:
+
+        # the test suite creates a new database for each test
+        db_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        now = time.monotonic()
+        with self._lock:
+            if self.loaded and self._db_uri == db_uri and not check and \
+               now - self._checked_ts < app.config.get('SETTINGS_REFRESH_INTERVAL', 10):
+                return
+            generation = self._get_generation()
+            if not self.loaded or self._db_uri != db_uri or self._generation != generation:
+                self._load()
+                self.loaded = True
+            self._generation = generation
+            self._db_uri = db_uri
+            self._checked_ts = now
+
+    def refresh(self) -> None:
+        """ Reload now if any other process has bumped the generation """
+        self._ensure_loaded(check=True)
+
+    def invalidate(self) -> None:
+        """ Bump the generation so that all other processes reload """
+
+        # incremented by the database so that concurrent bumps are not lost
+        cnt = db.session.query(self._model)\
+                        .update({self._model.value: self._model.value + 1,
+                                 self._model.mtime: datetime.datetime.utcnow()},
+                                synchronize_session=False)
+        if not cnt:
+            db.session.add(self._model(value=1))
+        db.session.commit()
+        with self._lock:
+            self.loaded = False
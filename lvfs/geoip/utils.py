@@ -11,9 +11,8 @@ from typing import Dict
 from collections import defaultdict
 from io import StringIO
 
-import requests
-
 from lvfs import app, db, tq
+from lvfs.httpclient import http_client
 
 from lvfs.util import _event_log
 
@@ -76,8 +75,7 @@ def _geoip_import_data(data: str) -> None:
 def _geoip_import_url() -> None:
 
     # download URL
-    session = requests.Session()
-    rv = session.get(app.config["GEOIP_URL"])
+    rv = http_client.get(app.config["GEOIP_URL"])
     if rv.status_code != 200:
         raise NotImplementedError("failed to upload to {}: {}".format(rv.url, rv.text))
 
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=too-few-public-methods
+
+import time
+import threading
+from collections import defaultdict
+from typing import Optional, Dict, Any
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from lvfs import app, tq
+
+
+class HttpMetrics:
+    """ Counters for one host """
+
+    def __init__(self) -> None:
+        self.requests: int = 0
+        self.retries: int = 0
+        self.failures: int = 0
+        self.elapsed: float = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'requests': self.requests,
+                'retries': self.retries,
+                'failures': self.failures,
+                'elapsed': self.elapsed}
+
+
+class HttpClient:
+    """ The outbound HTTP client shared by all plugins and importers
+
+    There is one instance per process. Connections are pooled per host by one
+    transport adapter shared by the per-thread sessions, the number of requests
+    in flight is limited by HTTP_MAX_CONCURRENCY, and idempotent requests are
+    retried with exponential backoff. Requests that do not need an answer can
+    be added to the retry queue with enqueue(), which keeps trying from celery.
+    """
+
+    RETRY_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'PURGE']
+    RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+    def __init__(self, adapter: Optional[BaseAdapter] = None) -> None:
+        self._adapter = adapter
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._semaphore: Optional[threading.BoundedSemaphore] = None
+        self._metrics: Dict[str, HttpMetrics] = defaultdict(HttpMetrics)
+
+    @property
+    def adapter(self) -> BaseAdapter:
+        with self._lock:
+            if not self._adapter:
+                self._adapter = HTTPAdapter(pool_connections=app.config.get('HTTP_POOL_HOSTS', 10),
+                                            pool_maxsize=app.config.get('HTTP_MAX_CONCURRENCY', 10),
+                                            max_retries=0)
+            return self._adapter
+
+    @adapter.setter
+    def adapter(self, adapter: Optional[BaseAdapter]) -> None:
+        """ Use a different transport, e.g. for tests """
+        with self._lock:
+            if self._adapter:
+                self._adapter.close()
+            self._adapter = adapter
+            self._local = threading.local()
+
+    @property
+    def _session(self) -> requests.Session:
+
+        # sessions are not thread safe, but the connection pools are
+        session = getattr(self._local, 'session', None)
+        if not session:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self._local.session = session
+        return session
+
+    def _acquire(self) -> threading.BoundedSemaphore:
+        with self._lock:
+            if not self._semaphore:
+                self._semaphore = threading.BoundedSemaphore(app.config.get('HTTP_MAX_CONCURRENCY', 10))
+            return self._semaphore
+
+    @staticmethod
+    def _get_backoff(attempt: int, rv: Optional[requests.Response] = None) -> float:
+        if rv is not None:
+            retry_after = rv.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), app.config.get('HTTP_BACKOFF_MAX', 30))
+        return min(app.config.get('HTTP_BACKOFF', 0.5) * 2 ** attempt,
+                   app.config.get('HTTP_BACKOFF_MAX', 30))
+
+    def request(self, method: str, url: str, retries: Optional[int] = None, **kwargs) -> requests.Response:
+        """ Returns the response, raising requests.exceptions.RequestException on failure """
+
+        method = method.upper()
+        if retries is None:
+            retries = app.config.get('HTTP_RETRIES', 3) if method in self.RETRY_METHODS else 0
+        kwargs.setdefault('timeout', app.config.get('HTTP_TIMEOUT', (10, 60)))
+        metrics = self._metrics[urlparse(url).netloc]
+        for attempt in range(retries + 1):
+            rv: Optional[requests.Response] = None
+            ts = time.monotonic()
+            try:
+                with self._acquire():
+                    rv = self._session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as _:
+                if attempt == retries:
+                    metrics.failures += 1
+                    raise
+            finally:
+                metrics.requests += 1
+                metrics.elapsed += time.monotonic() - ts
+            if rv is not None:
+                if rv.status_code not in self.RETRY_STATUS_CODES or attempt == retries:
+                    if rv.status_code >= 400:
+                        metrics.failures += 1
+                    return rv
+            metrics.retries += 1
+            time.sleep(self._get_backoff(attempt, rv))
+        raise requests.exceptions.RetryError('Failed to request {}'.format(url))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    @staticmethod
+    def enqueue(method: str, url: str, **kwargs) -> None:
+        """ Keep trying in the background; kwargs must be JSON serializable """
+        _async_http_request.apply_async(args=(method, url, kwargs))
+
+    @property
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        """ Counters for each host contacted by this process """
+        return {host: metrics.to_dict() for host, metrics in self._metrics.items()}
+
+
+http_client = HttpClient()
+
+
+@tq.task(bind=True, max_retries=8, default_retry_delay=30, task_time_limit=600)
+def _async_http_request(self, method: str, url: str, kwargs: Dict[str, Any]):
+    try:
+        rv = http_client.request(method, url, retries=0, **kwargs)
+        rv.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        # exponential backoff: 30s, 60s, 120s, ...
+        raise self.retry(exc=e, countdown=30 * 2 ** self.request.retries)
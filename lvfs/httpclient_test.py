@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=wrong-import-position
+
+import os
+import sys
+import threading
+import unittest
+from typing import Dict, Set
+from collections import defaultdict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# allows us to run this from the project root
+sys.path.append(os.path.realpath('.'))
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from lvfs import app
+from lvfs.httpclient import HttpClient
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeHandler)
+        self.hits: Dict[str, int] = defaultdict(int)
+        self.clients: Set[int] = set()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self): # pylint: disable=invalid-name
+        self.server.hits[self.path] += 1
+        self.server.clients.add(self.client_address[1])
+        status = 200
+        if self.path == '/down':
+            status = 503
+        elif self.path == '/flaky' and self.server.hits[self.path] < 3:
+            status = 503
+        body = 'hits={}'.format(self.server.hits[self.path]).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self): # pylint: disable=invalid-name
+        self.do_GET()
+
+class CountingAdapter(HTTPAdapter):
+
+    def __init__(self, *args, **kwargs):
+        HTTPAdapter.__init__(self, *args, **kwargs)
+        self.sent = 0
+
+    def send(self, *args, **kwargs): # pylint: disable=arguments-differ,signature-differs
+        self.sent += 1
+        return HTTPAdapter.send(self, *args, **kwargs)
+
+class HttpClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.adapter = CountingAdapter()
+        self.client = HttpClient(self.adapter)
+        backoff_old = app.config.get('HTTP_BACKOFF')
+        app.config['HTTP_BACKOFF'] = 0.001
+        self.addCleanup(app.config.__setitem__, 'HTTP_BACKOFF', backoff_old)
+
+    def tearDown(self):
+        self.adapter.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pooled(self):
+
+        for _ in range(5):
+            rv = self.client.get(self.server.url + '/ok')
+            self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.text, 'hits=5')
+
+        # one connection, using the transport for each request
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertEqual(self.adapter.sent, 5)
+        metrics = self.client.metrics['127.0.0.1:{}'.format(self.server.server_address[1])]
+        self.assertEqual(metrics['requests'], 5)
+        self.assertEqual(metrics['retries'], 0)
+
+    def test_retries(self):
+
+        # succeeds on the third attempt
+        rv = self.client.get(self.server.url + '/flaky')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.server.hits['/flaky'], 3)
+
+        # never succeeds
+        rv = self.client.get(self.server.url + '/down', retries=2)
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(self.server.hits['/down'], 3)
+
+        # not idempotent, so not retried by default
+        rv = self.client.post(self.server.url + '/down')
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(self.server.hits['/down'], 4)
+
+        metrics = self.client.metrics['127.0.0.1:{}'.format(self.server.server_address[1])]
+        self.assertEqual(metrics['retries'], 4)
+        self.assertEqual(metrics['failures'], 2)
+
+    def test_connection_error(self):
+
+        url = self.server.url + '/ok'
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.client.get(url, retries=1)
+
+if __name__ == '__main__':
+    unittest.main()
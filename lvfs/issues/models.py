@@ -16,7 +16,7 @@ from flask import g
 from sqlalchemy import Column, Integer, Text, Boolean, ForeignKey
 from sqlalchemy.orm import relationship
 
-from pkgversion import vercmp
+from pkgversion import vercmp_key
 
 from lvfs import db
 
@@ -41,13 +41,13 @@ class IssueCondition(db.Model):
         if self.compare == "eq":
             return value == self.value
         if self.compare == "lt":
-            return vercmp(value, self.value) < 0
+            return vercmp_key(value) < vercmp_key(self.value)
         if self.compare == "le":
-            return vercmp(value, self.value) <= 0
+            return vercmp_key(value) <= vercmp_key(self.value)
         if self.compare == "gt":
-            return vercmp(value, self.value) > 0
+            return vercmp_key(value) > vercmp_key(self.value)
         if self.compare == "ge":
-            return vercmp(value, self.value) >= 0
+            return vercmp_key(value) >= vercmp_key(self.value)
         if self.compare == "glob":
             return fnmatch.fnmatch(value, self.value)
         if self.compare == "regex":
@@ -25,7 +25,7 @@ from sqlalchemy.orm import joinedload
 
 from celery.schedules import crontab
 
-from pkgversion import vercmp
+from pkgversion import vercmp_key
 
 from lvfs import app, db, lm, ploader, csrf, tq
 
@@ -66,14 +66,14 @@ def _user_agent_safe_for_requirement(user_agent: str) -> bool:
     for chunk in sections:
         toks = chunk.split('/')
         if len(toks) == 2 and toks[0] == 'fwupd':
-            return vercmp(toks[1], '0.8.0') >= 0
+            return vercmp_key(toks[1]) >= vercmp_key('0.8.0')
 
     # this is a heuristic; the logic is that it's unlikely that a distro would
     # ship a very new gnome-software and a very old fwupd
     for chunk in sections:
         toks = chunk.split('/')
         if len(toks) == 2 and toks[0] == 'gnome-software':
-            return vercmp(toks[1], '3.26.0') >= 0
+            return vercmp_key(toks[1]) >= vercmp_key('3.26.0')
 
     # is is probably okay
     return True
@@ -46,7 +46,7 @@ def _md_to_mdsync_dict(md: Component) -> dict:
 
 def _mds_to_mdsync_dict(mds: List[Component]) -> dict:
     obj = {}
-    for md in sorted(mds):
+    for md in sorted(mds, key=lambda md: md.version_key):
         if not md.fw.vendor.visible:
             continue
         obj[md.version_display] = _md_to_mdsync_dict(md)
@@ -92,15 +92,25 @@ class Remote(db.Model):
             return "00000"
         return "{:05d}".format(self.build_cnt)
 
-    @property
-    def filename(self) -> Optional[str]:
+    def _filename_for_build(self, build_str: str) -> Optional[str]:
         if self.name == "private":
             return None
         if self.name == "stable":
-            return "firmware-{}-stable.xml.gz".format(self.build_str)
+            return "firmware-{}-stable.xml.gz".format(build_str)
         if self.name == "testing":
-            return "firmware-{}-testing.xml.gz".format(self.build_str)
-        return "firmware-{}-{}.xml.gz".format(self.build_str, self.access_token)
+            return "firmware-{}-testing.xml.gz".format(build_str)
+        return "firmware-{}-{}.xml.gz".format(build_str, self.access_token)
+
+    @property
+    def filename(self) -> Optional[str]:
+        return self._filename_for_build(self.build_str)
+
+    @property
+    def filename_built(self) -> Optional[str]:
+        """ The versioned filename written by the last metadata build """
+        if not self.build_cnt:
+            return None
+        return self._filename_for_build("{:05d}".format(self.build_cnt - 1))
 
     @property
     def filename_newest(self) -> Optional[str]:
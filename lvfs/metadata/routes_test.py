@@ -58,5 +58,25 @@ class LocalTestCase(LvfsTestCase):
         rv = self.app.get('/lvfs/metadata/testgroup')
         assert b'Title=Embargoed for testgroup' in rv.data, rv.data
 
+    def test_files_modified(self):
+
+        from lvfs import app, ploader
+
+        self.login()
+        with app.test_request_context():
+
+            # each file is only queued once
+            ploader.file_modified('/tmp/firmware.xml.gz')
+            ploader.file_modified('/tmp/firmware.xml.gz.jcat')
+            ploader.file_modified('/tmp/firmware.xml.gz')
+            assert ploader.invalidations.take() == ['/tmp/firmware.xml.gz',
+                                                    '/tmp/firmware.xml.gz.jcat']
+            assert not ploader.invalidations.take()
+
+            # no enabled plugin wants to know, so nothing is scheduled
+            ploader.file_modified('/tmp/firmware.xml.gz')
+            assert ploader.flush_modified() == 0
+            assert not len(ploader.invalidations)
+
 if __name__ == '__main__':
     unittest.main()
@@ -436,7 +436,12 @@ def _generate_metadata_kind(fws: List[Firmware],
     # process each component in version order, but only include the latest 5
     # releases to keep the metadata size sane
     for appstream_id in sorted(components):
-        mds = sorted(components[appstream_id], reverse=True)[:5]
+        mds = components[appstream_id]
+        if all(md.version_sort for md in mds):
+            mds = sorted(mds, key=lambda md: md.version_sort, reverse=True)[:5]
+        else:
+            # the sortable version has not been backfilled yet
+            mds = sorted(mds, key=lambda md: md.version_key, reverse=True)[:5]
         component = _generate_metadata_mds(mds,
                                            firmware_baseuri=firmware_baseuri,
                                            local=local,
@@ -550,7 +555,7 @@ def _regenerate_and_sign_metadata_remote(r: Remote):
         f.write(jcatfile.save())
     invalid_fns.append(fn_xmlgz_jcat)
 
-    # do this all at once right at the end of all the I/O
+    # queued, and sent in one batch once the database has been updated
     for fn in invalid_fns:
         print('Invalidating {}'.format(fn))
         ploader.file_modified(fn)
@@ -584,6 +589,7 @@ def _regenerate_and_sign_metadata_remote(r: Remote):
     # release this
     r.regenerate_ts = None
     db.session.commit()
+    ploader.flush_modified()
 
 def _regenerate_and_sign_metadata():
     for r in db.session.query(Remote):
@@ -602,3 +608,11 @@ def _async_regenerate_remote(remote_id):
 @tq.task(max_retries=3, default_retry_delay=10, task_time_limit=60)
 def _async_regenerate_remote_all():
     _regenerate_and_sign_metadata()
+
+@tq.task(bind=True, max_retries=6, default_retry_delay=30, task_time_limit=600)
+def _async_files_modified(self, fns: List[str], plugin_ids: Optional[List[str]] = None):
+
+    # only retry the plugins that failed, backing off each time
+    failed = ploader.files_modified(fns, plugin_ids)
+    if failed:
+        raise self.retry(args=(fns, failed), countdown=30 * 2 ** self.request.retries)
@@ -9,7 +9,14 @@
 
 import os
 import sys
-from typing import List, Optional, Dict, Any
+import time
+import socket
+import resource
+import datetime
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Optional, Dict, Any, Set, Iterator
 
 from cabarchive import CabArchive, CabFile
 from jcat import JcatBlob
@@ -19,6 +26,22 @@ from .firmware.models import Firmware
 from .settings.models import Setting
 from .tests.models import Test
 
+# the vfuncs a plugin can implement, which are never called if not overridden
+HOOKS = [
+    'file_modified',
+    'files_modified',
+    'metadata_sign',
+    'archive_sign',
+    'archive_copy',
+    'archive_finalize',
+    'ensure_test_for_fw',
+    'oauth_logout',
+    'require_test_for_fw',
+    'run_test_on_fw',
+    'require_test_for_md',
+    'run_test_on_md',
+]
+
 class PluginError(Exception):
     pass
 
@@ -61,13 +84,14 @@ class PluginBase:
     def __init__(self, plugin_id: Optional[str] = None):
         self.id = plugin_id
         self.priority = 0
-        self._setting_kvs: Dict[str, str] = {}
         self.name = 'Noname Plugin'
         self.summary = 'Plugin did not set summary'
         self.order_after: List[str] = []
 
     def file_modified(self, fn: str) -> None:
         raise NotImplementedError
+    def files_modified(self, fns: List[str]) -> None:
+        raise NotImplementedError
     def metadata_sign(self, blob: bytes) -> JcatBlob:
         raise NotImplementedError
     def archive_sign(self, blob: bytes) -> bytes:
@@ -89,18 +113,21 @@ class PluginBase:
     def run_test_on_md(self, test: Test, md: Component) -> bool:
         raise NotImplementedError
 
+    def implements(self, hook: str) -> bool:
+        """ Returns True if the plugin overrides the hook vfunc """
+        return getattr(type(self), hook) is not getattr(PluginBase, hook)
+
     def settings(self) -> List[Setting]:
         return []
 
     def get_setting(self, key: str, required: bool = False) -> str:
-        from .util import _get_settings
-        if self.id and not self._setting_kvs:
-            self._setting_kvs = _get_settings(self.id.replace('-', '_'))
-        if key not in self._setting_kvs:
+        from .settings.utils import settings_store
+        value = settings_store.get(key)
+        if value is None:
             raise PluginError('No key %s' % key)
-        if required and not self._setting_kvs[key]:
+        if required and not value:
             raise PluginError('No value set for key %s' % key)
-        return self._setting_kvs[key]
+        return value
 
     def get_setting_bool(self, key: str) -> bool:
         if self.get_setting(key) == 'enabled':
@@ -136,12 +163,106 @@ class PluginGeneral(PluginBase):
         s.append(PluginSettingInteger('default_failure_percentage', 'Report failures threshold for demotion', 70))
         return s
 
+class PluginTimings:
+    """ Hook timings for this process, written to the database in batches
+
+    Nothing is written while a hook is running as the caller may be in the
+    middle of a transaction; flush() is called when each request or task
+    completes. If nobody flushes then only the most recent items are kept.
+    """
+
+    def __init__(self, maxlen: int = 10000):
+        self._items: deque = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._serial = 0
+        self._serial_exclusive = 0
+
+    def start(self) -> int:
+        """ Marks a hook as running, returning a serial to pass to stop() """
+        with self._lock:
+            self._active += 1
+            self._serial += 1
+            if self._active == 1:
+                self._serial_exclusive = self._serial
+            return self._serial
+
+    def stop(self, serial: int) -> bool:
+        """ Returns True if no other hook ran at any point since start() """
+        with self._lock:
+            self._active -= 1
+            return self._serial == serial == self._serial_exclusive
+
+    def add(self, plugin_id: str, hook: str,
+            wall: float, cpu: float,
+            children: Optional[float], rss: Optional[int]) -> None:
+        with self._lock:
+            self._items.append({'plugin_id': plugin_id,
+                                'hook': hook,
+                                'ctime': datetime.datetime.utcnow(),
+                                'container_id': socket.gethostname(),
+                                'wall': wall,
+                                'cpu': cpu,
+                                'children': children,
+                                'rss': rss})
+
+    def flush(self) -> int:
+        from sqlalchemy.exc import SQLAlchemyError
+        from lvfs import db
+        from .settings.models import PluginTiming
+        with self._lock:
+            items = list(self._items)
+            self._items.clear()
+        if not items:
+            return 0
+
+        # use a new connection so that the caller session is not affected
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(PluginTiming.__table__.insert(), items)
+        except SQLAlchemyError as e:
+            print('Failed to save plugin timings: {}'.format(str(e)))
+            return 0
+        return len(items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+class InvalidationQueue:
+    """ Files modified by this process that the plugins have not been told about
+
+    Each path is only queued once, however many times it is written. The
+    plugins are told in one batch from a task when flush() is called after the
+    database commit, and also when each request or task completes.
+    """
+
+    def __init__(self) -> None:
+        self._fns: Dict[str, None] = {}
+        self._lock = threading.Lock()
+
+    def add(self, fn: str) -> None:
+        with self._lock:
+            self._fns[fn] = None
+
+    def take(self) -> List[str]:
+        with self._lock:
+            fns = list(self._fns)
+            self._fns.clear()
+        return fns
+
+    def __len__(self) -> int:
+        return len(self._fns)
+
 class Pluginloader:
 
     def __init__(self, dirname: str = '.'):
         self._dirname = dirname
         self._plugins: List[PluginBase] = []
+        self._dispatch: Dict[str, List[PluginBase]] = {}
+        self._dispatch_serial: Optional[int] = None
         self.loaded = False
+        self.timings = PluginTimings()
+        self.invalidations = InvalidationQueue()
 
     def load_plugins(self) -> None:
 
@@ -163,17 +284,20 @@ class Pluginloader:
                 plugins[f].id = f
         sys.path.pop(0)
 
-        # depsolve
-        for plugin_name in plugins:
-            plugin = plugins[plugin_name]
-            for name in plugin.order_after:
-                if name not in plugins:
-                    continue
-                plugin2 = plugins[name]
-                if not plugin2:
-                    continue
-                if plugin2.priority <= plugin.priority:
-                    plugin.priority = plugin2.priority + 1
+        # depsolve, repeating until stable so that chains are handled
+        plugins_by_id = {plugin.id: plugin for plugin in plugins.values()}
+        for _ in range(len(plugins_by_id)):
+            changed = False
+            for plugin in plugins_by_id.values():
+                for plugin_id in plugin.order_after:
+                    plugin2 = plugins_by_id.get(plugin_id)
+                    if not plugin2:
+                        continue
+                    if plugin2.priority >= plugin.priority:
+                        plugin.priority = plugin2.priority + 1
+                        changed = True
+            if not changed:
+                break
 
         # sort by priority
         for plugin in list(plugins.values()):
@@ -199,110 +323,173 @@ class Pluginloader:
             self.load_plugins()
         return self._plugins
 
-    # a file has been modified
-    def file_modified(self, fn: str) -> None:
+    def get_dependencies(self, plugin_id: str) -> Set[str]:
+        """ Returns the IDs of all the plugins that must run before this one """
+        plugin_ids: Set[str] = set()
+        plugin = self.get_by_id(plugin_id)
+        if not plugin:
+            return plugin_ids
+        todo = list(plugin.order_after)
+        while todo:
+            plugin_id = todo.pop()
+            if plugin_id in plugin_ids:
+                continue
+            plugin_ids.add(plugin_id)
+            plugin = self.get_by_id(plugin_id)
+            if plugin:
+                todo.extend(plugin.order_after)
+        return plugin_ids
+
+    @contextmanager
+    def measure(self, plugin: PluginBase, hook: str) -> Iterator[None]:
+        """ Records the resources used by the plugin for the duration of the block
+
+        The child time and peak RSS are process-wide, and so are only recorded
+        when no other hook was measured at the same time in another thread.
+        """
+        serial = self.timings.start()
+        ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall = time.monotonic()
+        cpu = time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+        try:
+            yield
+        finally:
+            ru_self2 = resource.getrusage(resource.RUSAGE_SELF)
+            ru_children2 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            exclusive = self.timings.stop(serial)
+            children: Optional[float] = None
+            rss: Optional[int] = None
+            if exclusive:
+                children = ru_children2.ru_utime + ru_children2.ru_stime - \
+                           ru_children.ru_utime - ru_children.ru_stime
+                rss = (ru_self2.ru_maxrss - ru_self.ru_maxrss) * 1024
+            self.timings.add(plugin.id, hook,
+                             wall=time.monotonic() - wall,
+                             cpu=time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID) - cpu,
+                             children=children,
+                             rss=rss)
+
+    def _ensure_dispatch(self) -> None:
+        from .settings.utils import settings_store
         if not self.loaded:
             self.load_plugins()
-        for plugin in self._plugins:
-            if not plugin.enabled:
+
+        # only rebuilt when the settings have been reloaded
+        serial = settings_store.serial
+        if self._dispatch_serial == serial:
+            return
+        self._dispatch = {}
+        for hook in HOOKS:
+            self._dispatch[hook] = [plugin for plugin in self._plugins
+                                    if plugin.implements(hook) and plugin.enabled]
+        self._dispatch_serial = serial
+
+    def get_for_hook(self, hook: str) -> List[PluginBase]:
+        """ Returns the enabled plugins that implement the hook, in priority order """
+        self._ensure_dispatch()
+        return self._dispatch[hook]
+
+    # a file has been modified, although the plugins are only told when flushed
+    def file_modified(self, fn: str) -> None:
+        self.invalidations.add(fn)
+
+    def files_modified(self, fns: List[str], plugin_ids: Optional[List[str]] = None) -> List[str]:
+        """ Tells each plugin about the modified files, returning the IDs of any that failed """
+        failed: List[str] = []
+        plugins = list(self.get_for_hook('files_modified'))
+        for plugin in self.get_for_hook('file_modified'):
+            if plugin not in plugins:
+                plugins.append(plugin)
+        for plugin in plugins:
+            if plugin_ids is not None and plugin.id not in plugin_ids:
                 continue
             try:
-                plugin.file_modified(fn)
+                if plugin.implements('files_modified'):
+                    with self.measure(plugin, 'files_modified'):
+                        plugin.files_modified(fns)
+                else:
+                    for fn in fns:
+                        with self.measure(plugin, 'file_modified'):
+                            plugin.file_modified(fn)
             except PluginError as e:
                 from .util import _event_log
-                _event_log('Plugin %s failed for FileModifed(%s): %s' % (plugin.id, fn, str(e)))
-            except NotImplementedError as _:
-                pass
+                _event_log('Plugin %s failed for FilesModified(%s): %s' % (plugin.id, ','.join(fns), str(e)))
+                failed.append(plugin.id)
+        return failed
+
+    def flush_modified(self) -> int:
+        """ Sends the queued files to a task, so that slow plugins do not block the caller """
+        fns = self.invalidations.take()
+        if not fns:
+            return 0
+        if not self.get_for_hook('files_modified') and not self.get_for_hook('file_modified'):
+            return 0
+        from .metadata.utils import _async_files_modified
+        _async_files_modified.apply_async(args=(fns,))
+        return len(fns)
 
     # metadata is being built
     def metadata_sign(self, blob: bytes) -> List[JcatBlob]:
-        if not self.loaded:
-            self.load_plugins()
         blobs: List[JcatBlob] = []
-        for plugin in self._plugins:
-            if not plugin.enabled:
-                continue
+        for plugin in self.get_for_hook('metadata_sign'):
             try:
-                blobs.append(plugin.metadata_sign(blob))
+                with self.measure(plugin, 'metadata_sign'):
+                    blobs.append(plugin.metadata_sign(blob))
             except PluginError as e:
                 from .util import _event_log
                 _event_log('Plugin %s failed for MetadataSign(): %s' % (plugin.id, str(e)))
-            except NotImplementedError as _:
-                pass
         return blobs
 
     # an archive is being built
     def archive_sign(self, blob: bytes) -> List[bytes]:
-        if not self.loaded:
-            self.load_plugins()
         blobs: List[bytes] = []
-        for plugin in self._plugins:
-            if not plugin.enabled:
-                continue
+        for plugin in self.get_for_hook('archive_sign'):
             try:
-                blobs.append(plugin.archive_sign(blob))
+                with self.measure(plugin, 'archive_sign'):
+                    blobs.append(plugin.archive_sign(blob))
             except PluginError as e:
                 from .util import _event_log
                 _event_log('Plugin %s failed for ArchiveSign(): %s' % (plugin.id, str(e)))
-            except NotImplementedError as _:
-                pass
         return blobs
 
     # an archive is being built
     def archive_copy(self, cabarchive: CabArchive, cabfile: CabFile) -> None:
-        if not self.loaded:
-            self.load_plugins()
-        for plugin in self._plugins:
-            if not plugin.enabled:
-                continue
+        for plugin in self.get_for_hook('archive_copy'):
             try:
-                plugin.archive_copy(cabarchive, cabfile)
+                with self.measure(plugin, 'archive_copy'):
+                    plugin.archive_copy(cabarchive, cabfile)
             except PluginError as e:
                 from .util import _event_log
                 _event_log('Plugin %s failed for archive_copy(): %s' % (plugin.id, str(e)))
-            except NotImplementedError as _:
-                pass
 
     # an archive is being built
     def archive_finalize(self, cabarchive: CabArchive, fw: Firmware) -> None:
-        if not self.loaded:
-            self.load_plugins()
-        for plugin in self._plugins:
-            if not plugin.enabled:
-                continue
+        for plugin in self.get_for_hook('archive_finalize'):
             try:
-                plugin.archive_finalize(cabarchive, fw)
+                with self.measure(plugin, 'archive_finalize'):
+                    plugin.archive_finalize(cabarchive, fw)
             except PluginError as e:
                 from .util import _event_log
                 _event_log('Plugin %s failed for ArchiveFinalize(): %s' % (plugin.id, str(e)))
-            except NotImplementedError as _:
-                pass
 
     # ensure an test is added for the firmware
     def ensure_test_for_fw(self, fw: Firmware) -> None:
-        if not self.loaded:
-            self.load_plugins()
-        for plugin in self._plugins:
-            if not plugin.enabled:
-                continue
+        for plugin in self.get_for_hook('ensure_test_for_fw'):
 
             # allow plugins to set conditionals on ensuring
             ensure_test = False
-            has_test_fw = False
-            has_test_md = False
-            try:
-                if plugin.require_test_for_fw(fw):
-                    ensure_test = True
-                has_test_fw = True
-            except NotImplementedError as _:
-                pass
-            try:
-                for md in fw.mds:
-                    if plugin.require_test_for_md(md):
+            has_test_fw = plugin.implements('require_test_for_fw')
+            has_test_md = plugin.implements('require_test_for_md')
+            if has_test_fw:
+                with self.measure(plugin, 'require_test_for_fw'):
+                    if plugin.require_test_for_fw(fw):
                         ensure_test = True
-                has_test_md = True
-            except NotImplementedError as _:
-                pass
+            if has_test_md:
+                with self.measure(plugin, 'require_test_for_md'):
+                    for md in fw.mds:
+                        if plugin.require_test_for_md(md):
+                            ensure_test = True
 
             # any tests without either vfunc are assumed to always run
             if not has_test_md and not has_test_fw:
@@ -310,24 +497,18 @@ class Pluginloader:
             if not ensure_test:
                 continue
             try:
-                plugin.ensure_test_for_fw(fw)
+                with self.measure(plugin, 'ensure_test_for_fw'):
+                    plugin.ensure_test_for_fw(fw)
             except PluginError as e:
                 from .util import _event_log
                 _event_log('Plugin %s failed for ensure_test_for_fw(): %s' % (plugin.id, str(e)))
-            except NotImplementedError as _:
-                pass
 
     # log out of all oauth providers
     def oauth_logout(self) -> None:
-        if not self.loaded:
-            self.load_plugins()
-        for plugin in self._plugins:
-            if not plugin.enabled:
-                continue
+        for plugin in self.get_for_hook('oauth_logout'):
             try:
-                plugin.oauth_logout()
+                with self.measure(plugin, 'oauth_logout'):
+                    plugin.oauth_logout()
             except PluginError as e:
                 from .util import _event_log
                 _event_log('Plugin %s failed for oauth_logout(): %s' % (plugin.id, str(e)))
-            except NotImplementedError as _:
-                pass
@@ -59,12 +59,24 @@ class YaraQuery(db.Model):
     ctime = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
     started_ts = Column(DateTime, default=None)
     ended_ts = Column(DateTime, default=None)
+    checkpoint_component_id = Column(Integer, default=0)
+    checkpoint_ts = Column(DateTime, default=None)
 
     user = relationship("User", foreign_keys=[user_id])
     results = relationship(
         "YaraQueryResult", lazy="joined", cascade="all,delete,delete-orphan"
     )
 
+    def retry(self) -> None:
+        self.started_ts = None
+        self.ended_ts = None
+        self.checkpoint_component_id = 0
+        self.checkpoint_ts = None
+        self.found = 0
+        self.total = 0
+        for result in self.results:
+            db.session.delete(result)
+
     @property
     def color(self) -> str:
         if self.found and self.total:
@@ -8,13 +8,19 @@
 from flask import Blueprint, request, flash, url_for, redirect, render_template, g
 from flask_login import login_required
 
-from lvfs import db
+from lvfs import db, tq
 
 from .models import YaraQuery
-from .utils import _async_query_run
+from .utils import _async_query_run, _async_query_run_all
 
 bp_queries = Blueprint('queries', __name__, template_folder='templates')
 
+@tq.on_after_finalize.connect
+def setup_periodic_tasks(sender, **_):
+
+    # also resumes queries where the worker went away part way through
+    sender.add_periodic_task(3600.0, _async_query_run_all.s(), options={'queue': 'yara'})
+
 @bp_queries.route('/')
 @login_required
 def route_list():
@@ -78,8 +84,7 @@ def route_retry(yara_query_id):
         return redirect(url_for('main.route_dashboard'))
 
     # renew
-    query.started_ts = None
-    query.ended_ts = None
+    query.retry()
     db.session.commit()
 
     # asynchronously run
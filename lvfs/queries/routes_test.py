@@ -9,6 +9,7 @@
 
 import os
 import sys
+import datetime
 import unittest
 
 sys.path.append(os.path.realpath('.'))
@@ -64,5 +65,52 @@ rule AMITestKey
         rv = self.app.get('/lvfs/queries/1', follow_redirects=True)
         assert b'No YARA query found' in rv.data, rv.data.decode()
 
+    def test_yara_query_resume(self):
+
+        from lvfs import app, db
+        from lvfs.firmware.models import Firmware
+        from lvfs.metadata.models import Remote
+        from lvfs.queries.models import YaraQuery
+        from lvfs.queries.utils import _query_run, _query_run_all
+
+        self.login()
+        self.upload()
+        with app.test_request_context():
+            fw = db.session.query(Firmware).first()
+            fw.remote = db.session.query(Remote).filter(Remote.name == 'stable').one()
+            query = YaraQuery(value='rule AnyBlob { condition: true }', user_id=1)
+            db.session.add(query)
+            db.session.commit()
+
+            # matched against the component blob
+            _query_run(query, max_workers=2)
+            assert query.ended_ts
+            assert query.found == 1, query.found
+            assert query.checkpoint_component_id == fw.mds[0].component_id
+
+            # the worker went away after the last checkpoint
+            query.ended_ts = None
+            query.checkpoint_ts = datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+            db.session.commit()
+            _query_run_all()
+            assert query.ended_ts
+            assert query.found == 1, query.found
+
+            # still running somewhere else, so nothing is claimed twice
+            query.ended_ts = None
+            query.checkpoint_ts = datetime.datetime.utcnow()
+            db.session.commit()
+            _query_run_all()
+            _query_run(query)
+            assert not query.ended_ts
+            assert query.found == 1, query.found
+            assert len(query.results) == 1, query.results
+
+            # start again from scratch
+            query.retry()
+            db.session.commit()
+            _query_run(query)
+            assert query.found == 1, query.found
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,11 +7,17 @@
 #
 # pylint: disable=singleton-comparison
 
+import os
+import zlib
 import datetime
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Optional, Tuple
 
 import yara
 
-from lvfs import db, tq
+from sqlalchemy import and_, or_
+
+from lvfs import app, db, tq
 
 from lvfs.components.models import Component, ComponentShard
 from lvfs.firmware.models import Firmware
@@ -19,7 +25,7 @@ from lvfs.metadata.models import Remote
 
 from .models import YaraQuery, YaraQueryResult
 
-@tq.task(max_retries=3, default_retry_delay=60, task_time_limit=6000)
+@tq.task(max_retries=3, default_retry_delay=60, task_time_limit=6000, acks_late=True)
 def _async_query_run(yara_query_id):
     query = db.session.query(YaraQuery)\
                       .filter(YaraQuery.yara_query_id == yara_query_id)\
@@ -28,10 +34,8 @@ def _async_query_run(yara_query_id):
         return
     _query_run(query)
 
-def _query_run_shard(query: YaraQuery, md: Component, shard: ComponentShard):
-    if not shard.blob:
-        return
-    matches = query.rules.match(data=shard.blob)
+def _query_format_matches(matches) -> List[str]:
+    msgs: List[str] = []
     for match in matches:
         msg = match.rule
         for string in match.strings:
@@ -40,59 +44,130 @@ def _query_run_shard(query: YaraQuery, md: Component, shard: ComponentShard):
                     msg += ': found {}'.format(string[2].decode())
                 except UnicodeDecodeError as _:
                     pass
-        query.results.append(YaraQueryResult(md=md, shard=shard, result=msg))
+        msgs.append(msg)
+    return msgs
 
-    # unallocate the cached blob as it's no longer needed
-    shard.blob = None
+def _query_match(rules, fn: Optional[str] = None, blob: Optional[bytes] = None) -> List[str]:
+    """ Matches one blob, or compressed shard file; called from a worker thread """
+    if fn:
+        try:
+            with open(fn, 'rb') as f:
+                blob = zlib.decompressobj().decompress(f.read())
+        except (FileNotFoundError, zlib.error) as _:
+            return []
+    if not blob:
+        return []
+    # yara releases the GIL while scanning
+    return _query_format_matches(rules.match(data=blob))
 
-def _query_run_component(query: YaraQuery, md: Component):
-    if not md.blob:
-        return
-    matches = query.rules.match(data=md.blob)
-    for match in matches:
-        msg = match.rule
-        for string in match.strings:
-            if len(string) == 3:
-                try:
-                    msg += ': found {}'.format(string[2].decode())
-                except UnicodeDecodeError as _:
-                    pass
-        query.results.append(YaraQueryResult(md=md, result=msg))
+def _query_run_batch(query: YaraQuery,
+                     component_ids: List[int],
+                     executor: ThreadPoolExecutor,
+                     msgs_by_checksum: Dict[str, List[str]]) -> None:
+
+    # scan each unique blob once, even if it is included in many components
+    futures: Dict[str, Future] = {}
+    todo: List[Tuple[Component, Optional[ComponentShard], str]] = []
+    for component_id in component_ids:
+        md = db.session.query(Component)\
+                       .filter(Component.component_id == component_id)\
+                       .one()
+        for shard in md.shards:
+            checksum = shard.checksum or 'shard:{}'.format(shard.component_shard_id)
+            if checksum not in msgs_by_checksum and checksum not in futures:
+                futures[checksum] = executor.submit(_query_match, query.rules, fn=shard.absolute_path)
+            todo.append((md, shard, checksum))
+        checksum = md.checksum_contents_sha256 or 'md:{}'.format(md.component_id)
+        if checksum not in msgs_by_checksum and checksum not in futures:
+            futures[checksum] = executor.submit(_query_match, query.rules, blob=md.blob)
+        todo.append((md, None, checksum))
+        query.total += len(md.shards)
+    for checksum, future in futures.items():
+        msgs_by_checksum[checksum] = future.result()
 
-    # unallocate the cached blob as it's no longer needed
-    md.blob = None
+    # results are added in the same order as when run serially
+    for md, shard, checksum in todo:
+        for msg in msgs_by_checksum[checksum]:
+            query.results.append(YaraQueryResult(md=md, shard=shard, result=msg))
 
-def _query_run(query: YaraQuery):
-    print('processing query {}: {}...'.format(query.yara_query_id, query.title))
+def _query_claimable(now: datetime.datetime):
+    """ Queries that have never started, or where the worker has gone away """
+    return or_(YaraQuery.started_ts == None,
+               and_(YaraQuery.ended_ts == None,
+                    YaraQuery.checkpoint_ts < now - datetime.timedelta(hours=1)))
+
+def _query_claim(query: YaraQuery) -> bool:
+    """ Atomically marks the query as started by this worker, returning False if it lost """
+    now = datetime.datetime.utcnow()
+    cnt = db.session.query(YaraQuery)\
+                    .filter(YaraQuery.yara_query_id == query.yara_query_id)\
+                    .filter(_query_claimable(now))\
+                    .update({YaraQuery.started_ts: now,
+                             YaraQuery.checkpoint_ts: now},
+                            synchronize_session=False)
+    db.session.commit()
+    return cnt == 1
+
+def _query_run(query: YaraQuery, max_workers: Optional[int] = None):
     try:
         query.rules = yara.compile(source=query.value)
     except yara.SyntaxError as e:
         query.error = 'Failed to compile rules: {}'.format(str(e))
         db.session.commit()
         return
-    query.started_ts = datetime.datetime.utcnow()
-    db.session.commit()
+
+    # another worker is already running this query
+    resume = bool(query.started_ts and query.checkpoint_component_id)
+    if not _query_claim(query):
+        print('skipping query {}: {} as already running'.format(query.yara_query_id,
+                                                                query.title))
+        return
+
+    # continue from the last batch if the worker went away
+    if resume:
+        print('resuming query {}: {} from component {}...'.format(query.yara_query_id,
+                                                                 query.title,
+                                                                 query.checkpoint_component_id))
+    else:
+        print('processing query {}: {}...'.format(query.yara_query_id, query.title))
+        query.checkpoint_component_id = 0
+        db.session.commit()
+
+    # everything that is in stable now, in a stable order
     component_ids = [x[0] for x in db.session.query(Component.component_id)\
                                              .join(Firmware)\
                                              .join(Remote)\
-                                             .filter(Remote.name == 'stable').all()]
-    for component_id in component_ids:
-        md = db.session.query(Component)\
-                       .filter(Component.component_id == component_id)\
-                       .one()
-        for shard in md.shards:
-            _query_run_shard(query, md, shard)
-        _query_run_component(query, md)
-        query.total += len(md.shards)
+                                             .filter(Remote.name == 'stable')\
+                                             .filter(Component.component_id > query.checkpoint_component_id)\
+                                             .order_by(Component.component_id.asc()).all()]
+
+    # each batch is committed with the checkpoint so that progress is visible,
+    # and is small so that only a few component blobs are in memory at once
+    if not max_workers:
+        max_workers = app.config.get('YARA_WORKERS') or os.cpu_count() or 1
+    batch_size = max_workers * 4
+    msgs_by_checksum: Dict[str, List[str]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i in range(0, len(component_ids), batch_size):
+            batch = component_ids[i:i + batch_size]
+            _query_run_batch(query, batch, executor, msgs_by_checksum)
+            query.found = len(query.results)
+            query.checkpoint_component_id = batch[-1]
+            query.checkpoint_ts = datetime.datetime.utcnow()
+            db.session.commit()
     query.found = len(query.results)
     query.ended_ts = datetime.datetime.utcnow()
     db.session.commit()
 
 def _query_run_all():
 
-    # get all pending queries
+    # get all pending queries, and any where the worker has gone away
     pending = db.session.query(YaraQuery).\
-                    filter(YaraQuery.started_ts == None).\
-                    filter(YaraQuery.error == None)
+                    filter(_query_claimable(datetime.datetime.utcnow())).\
+                    filter(YaraQuery.error == None).all()
     for query in pending:
         _query_run(query)
+
+@tq.task(max_retries=3, default_retry_delay=60, task_time_limit=6000, acks_late=True)
+def _async_query_run_all():
+    _query_run_all()
@@ -7,7 +7,9 @@
 #
 # pylint: disable=too-few-public-methods
 
-from sqlalchemy import Column, Integer, Text
+import datetime
+
+from sqlalchemy import Column, Integer, Text, DateTime, Float
 
 from lvfs import db
 
@@ -22,3 +24,35 @@ class Setting(db.Model):
 
     def __repr__(self) -> str:
         return "Setting object %s" % self.key
+
+
+class SettingGeneration(db.Model):
+
+    __tablename__ = "setting_generations"
+
+    setting_generation_id = Column(Integer, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+    mtime = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self) -> str:
+        return "SettingGeneration object %s" % self.value
+
+
+class PluginTiming(db.Model):
+
+    __tablename__ = "plugin_timings"
+
+    plugin_timing_id = Column(Integer, primary_key=True)
+    plugin_id = Column(Text, nullable=False, index=True)
+    hook = Column(Text, nullable=False)
+    ctime = Column(
+        DateTime, nullable=False, default=datetime.datetime.utcnow, index=True
+    )
+    container_id = Column(Text, default=None)
+    wall = Column(Float, default=0)  # seconds
+    cpu = Column(Float, default=0)  # seconds, for the calling thread only
+    children = Column(Float, default=0)  # seconds, process-wide, or NULL if threaded
+    rss = Column(Integer, default=0)  # bytes added to the process peak RSS, or NULL if threaded
+
+    def __repr__(self) -> str:
+        return "PluginTiming object %s:%s" % (self.plugin_id, self.hook)
@@ -13,7 +13,7 @@ from typing import Dict, List
 from flask import Blueprint, render_template, request, url_for, redirect, flash
 from flask_login import login_required
 
-from lvfs import app, db, ploader
+from lvfs import app, db, ploader, tq
 
 from lvfs.firmware.models import Firmware
 from lvfs.pluginloader import PluginBase
@@ -21,9 +21,17 @@ from lvfs.tests.models import Test
 from lvfs.util import _event_log, _get_settings, admin_login_required
 
 from .models import Setting
+from .utils import settings_store, _plugin_timings_summary, _async_plugin_timings_prune
 
 bp_settings = Blueprint('settings', __name__, template_folder='templates')
 
+@tq.on_after_finalize.connect
+def setup_periodic_tasks(sender, **_):
+    sender.add_periodic_task(
+        86400.0,
+        _async_plugin_timings_prune.s(),
+    )
+
 def _convert_tests_for_plugin(plugin: PluginBase) -> Dict[str, List[Test]]:
     tests_by_type: Dict[str, List[Test]] = defaultdict(list)
     for test in db.session.query(Test).join(Firmware).\
@@ -43,6 +51,19 @@ def _convert_tests_for_plugin(plugin: PluginBase) -> Dict[str, List[Test]]:
             tests_by_type['failed'].append(test)
     return tests_by_type
 
+@bp_settings.route('/timings')
+@bp_settings.route('/timings/<plugin_id>')
+@login_required
+@admin_login_required
+def route_timings(plugin_id=None):
+    """
+    Shows how long each plugin hook has taken recently
+    """
+    return render_template('settings-timings.html',
+                           category='settings',
+                           plugin_id=plugin_id,
+                           timings=_plugin_timings_summary(plugin_id))
+
 @bp_settings.route('/')
 @bp_settings.route('/<plugin_id>')
 @login_required
@@ -98,6 +119,7 @@ def route_create():
             if s.key not in settings:
                 db.session.add(Setting(key=s.key, value=s.default))
     db.session.commit()
+    settings_store.invalidate()
     return redirect(url_for('settings.route_view'))
 
 def _textarea_string_to_text(value_unsafe: str) -> str:
@@ -130,5 +152,6 @@ def route_modify(plugin_id='general'):
         setting.value = _textarea_string_to_text(request.form[key])
         _event_log('Changed server settings %s to %s' % (key, setting.value))
     db.session.commit()
+    settings_store.invalidate()
     flash('Updated settings', 'info')
     return redirect(url_for('settings.route_view', plugin_id=plugin_id), 302)
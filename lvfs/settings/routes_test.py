@@ -45,5 +45,69 @@ class LocalTestCase(LvfsTestCase):
         ), follow_redirects=True)
         assert b'value="enabled" checked/>' in rv.data, rv.data
 
+    def test_settings_cached(self):
+
+        from lvfs import app, db, ploader
+        from lvfs.settings.models import SettingGeneration
+
+        # the plugin sees the default value
+        self.login()
+        with app.test_request_context():
+            plugin = ploader.get_by_id('wu-copy')
+            assert plugin.get_setting_bool('wu_copy_inf')
+
+        # the change is visible without waiting for the refresh interval
+        rv = self.app.post('/lvfs/settings/modify/wu-copy', data=dict(
+            wu_copy_inf='disabled',
+        ), follow_redirects=True)
+        assert b'Updated settings' in rv.data, rv.data
+        with app.test_request_context():
+            assert not plugin.get_setting_bool('wu_copy_inf')
+            assert plugin.get_setting_bool('wu_copy_cat')
+
+            # the seeded row was bumped rather than another row being added
+            gens = db.session.query(SettingGeneration).all()
+            assert len(gens) == 1, gens
+            assert gens[0].value > 0, gens
+
+    def test_plugin_dispatch(self):
+
+        from lvfs import app, ploader
+
+        # only plugins implementing the vfunc are used
+        self.login()
+        with app.test_request_context():
+            plugin = ploader.get_by_id('wu-copy')
+            assert plugin in ploader.get_for_hook('archive_copy')
+            assert plugin not in ploader.get_for_hook('archive_sign')
+
+        # disabled plugins are removed when the settings change
+        rv = self.app.post('/lvfs/settings/modify/wu-copy', data=dict(
+            wu_copy_enable='disabled',
+        ), follow_redirects=True)
+        assert b'Updated settings' in rv.data, rv.data
+        with app.test_request_context():
+            assert plugin not in ploader.get_for_hook('archive_copy')
+
+    def test_settings_timings(self):
+
+        from lvfs import app, ploader
+
+        # uploading adds the tests, and then runs them
+        self.login()
+        self.upload()
+        with app.test_request_context():
+            ploader.timings.flush()
+        rv = self.app.get('/lvfs/settings/timings')
+        assert b'Plugin Timings' in rv.data, rv.data
+        assert b'ensure_test_for_fw' in rv.data, rv.data
+        assert b'run_test_on_md' in rv.data, rv.data
+        assert b'>guids</a>' in rv.data, rv.data
+
+        # just one plugin
+        rv = self.app.get('/lvfs/settings/timings/blocklist')
+        assert b'run_test_on_md' in rv.data, rv.data
+        assert b'>guids</a>' not in rv.data, rv.data
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+
+import datetime
+from typing import Optional, Dict, List, Any
+
+from sqlalchemy import func
+
+from lvfs import app, db, tq
+from lvfs.generationcache import GenerationCache
+
+from .models import Setting, SettingGeneration, PluginTiming
+
+
+class SettingsStore(GenerationCache):
+    """ An in-memory copy of the settings table """
+
+    def __init__(self) -> None:
+        GenerationCache.__init__(self, SettingGeneration)
+        self._kvs: Dict[str, str] = {}
+        self._serial: int = 0
+
+    def _load(self) -> None:
+        kvs: Dict[str, str] = {}
+        for key, value in db.session.query(Setting.key, Setting.value):
+            kvs[key] = value
+        self._kvs = kvs
+        self._serial += 1
+
+    @property
+    def serial(self) -> int:
+        """ A number that changes every time the settings are reloaded """
+        self._ensure_loaded()
+        return self._serial
+
+    def get_all(self, prefix: Optional[str] = None) -> Dict[str, str]:
+        self._ensure_loaded()
+        if not prefix:
+            return dict(self._kvs)
+        return {key: value for key, value in self._kvs.items() if key.startswith(prefix)}
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        self._ensure_loaded()
+        return self._kvs.get(key, default)
+
+    def get_bool(self, key: str) -> bool:
+        return self.get(key) == 'enabled'
+
+    def get_int(self, key: str, default: int = 0) -> int:
+        value = self.get(key)
+        if not value:
+            return default
+        return int(value)
+
+    def get_list(self, key: str) -> List[str]:
+        value = self.get(key)
+        if not value:
+            return []
+        return value.split(',')
+
+
+settings_store = SettingsStore()
+
+
+def _plugin_timings_summary(plugin_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """ Returns the hook timings for the last few days, slowest first """
+
+    since = datetime.datetime.utcnow() - \
+            datetime.timedelta(days=app.config.get('PLUGIN_TIMINGS_MAX_AGE', 7))
+    stmt = db.session.query(PluginTiming.plugin_id,
+                            PluginTiming.hook,
+                            func.count(PluginTiming.plugin_timing_id),
+                            func.sum(PluginTiming.wall),
+                            func.max(PluginTiming.wall),
+                            func.sum(PluginTiming.cpu),
+                            func.sum(PluginTiming.children),
+                            func.max(PluginTiming.rss))\
+                     .filter(PluginTiming.ctime > since)
+    if plugin_id:
+        stmt = stmt.filter(PluginTiming.plugin_id == plugin_id)
+    summary: List[Dict[str, Any]] = []
+    for plugin_id_, hook, cnt, wall, wall_max, cpu, children, rss in \
+            stmt.group_by(PluginTiming.plugin_id, PluginTiming.hook):
+        summary.append({'plugin_id': plugin_id_,
+                        'hook': hook,
+                        'cnt': cnt,
+                        'wall': wall or 0,
+                        'wall_avg': (wall or 0) / cnt,
+                        'wall_max': wall_max or 0,
+                        'cpu': cpu or 0,
+                        'children': children or 0,
+                        'rss': rss or 0})
+    summary.sort(key=lambda item: item['wall'], reverse=True)
+    return summary
+
+
+def _plugin_timings_prune() -> int:
+    since = datetime.datetime.utcnow() - \
+            datetime.timedelta(days=app.config.get('PLUGIN_TIMINGS_MAX_AGE', 7))
+    cnt = db.session.query(PluginTiming)\
+                    .filter(PluginTiming.ctime < since)\
+                    .delete(synchronize_session=False)
+    db.session.commit()
+    return cnt
+
+
+@tq.task(max_retries=3, default_retry_delay=60, task_time_limit=600)
+def _async_plugin_timings_prune():
+    _plugin_timings_prune()
@@ -20,7 +20,7 @@ from lvfs.components.models import ComponentShard, ComponentShardInfo, Component
 from lvfs.claims.models import Claim
 from lvfs.util import admin_login_required
 
-from .utils import _async_regenerate_shard_infos
+from .utils import _async_regenerate_shard_infos, _async_shard_blobs_gc, shard_claims
 
 bp_shards = Blueprint('shards', __name__, template_folder='templates')
 
@@ -30,6 +30,10 @@ def setup_periodic_tasks(sender, **_):
         crontab(hour=3, minute=0),
         _async_regenerate_shard_infos.s(),
     )
+    sender.add_periodic_task(
+        crontab(hour=4, minute=0),
+        _async_shard_blobs_gc.s(),
+    )
 
 @bp_shards.route('/')
 @login_required
@@ -87,6 +91,7 @@ def route_modify(component_shard_info_id):
         if key in request.form:
             setattr(shard, key, request.form[key] or None)
     db.session.commit()
+    shard_claims.invalidate()
 
     # success
     flash('Modified shard', 'info')
@@ -210,6 +215,7 @@ def route_shard_claim_delete(component_shard_info_id, component_shard_claim_id):
         return redirect(url_for('shards.route_list'))
     db.session.delete(shard_claim)
     db.session.commit()
+    shard_claims.invalidate()
     flash('Deleted shard claim', 'info')
     return redirect(url_for('shards.route_claims',
                             component_shard_info_id=component_shard_info_id))
@@ -239,6 +245,7 @@ def route_shard_claim_create(component_shard_info_id):
                                 claim_id=request.form['claim_id'])
     db.session.add(claim)
     db.session.commit()
+    shard_claims.invalidate()
     flash('Added claim', 'info')
     return redirect(url_for('shards.route_claims',
                             component_shard_info_id=component_shard_info_id))
@@ -5,7 +5,7 @@
 #
 # SPDX-License-Identifier: GPL-2.0+
 #
-# pylint: disable=wrong-import-position,singleton-comparison
+# pylint: disable=wrong-import-position,singleton-comparison,protected-access
 
 import os
 import sys
@@ -137,5 +137,241 @@ class LocalTestCase(LvfsTestCase):
         rv = self.app.get('/lvfs/shards/', follow_redirects=True)
         assert b'ACME' in rv.data, rv.data.decode()
 
+    def test_shard_blobs(self):
+
+        import hashlib
+        import tempfile
+        import zlib
+        from lvfs import app, db
+        from lvfs.components.models import Component, ComponentShard, ComponentShardBlob
+        from lvfs.shards.utils import _shard_blobs_gc, _shard_blobs_migrate
+
+        self.login()
+        self.upload()
+        shard_dir_old = app.config['SHARD_DIR']
+        with app.test_request_context(), tempfile.TemporaryDirectory() as shard_dir:
+            app.config['SHARD_DIR'] = shard_dir
+            self.addCleanup(app.config.__setitem__, 'SHARD_DIR', shard_dir_old)
+            md = db.session.query(Component).first()
+
+            # the same contents twice are only stored once
+            for name in ['DxeCore', 'DxeCoreCopy']:
+                shard = ComponentShard(name=name, guid='d9d114ef-f40b-4d48-aaa0-a3dc99c9f5bd')
+                shard.set_blob(b'hello world')
+                md.shards.append(shard)
+                shard.save()
+            db.session.commit()
+            shard_blob = db.session.query(ComponentShardBlob).one()
+            assert shard_blob.refcnt == 2, shard_blob
+            assert os.path.exists(shard_blob.absolute_path)
+            assert md.shards[0].absolute_path == md.shards[1].absolute_path
+            assert md.shards[0].blob == b'hello world'
+
+            # still used by the other shard
+            db.session.delete(md.shards[0])
+            db.session.commit()
+            db.session.refresh(shard_blob)
+            assert shard_blob.refcnt == 1, shard_blob
+            assert _shard_blobs_gc() == 0
+
+            # unused, so removed
+            fn = shard_blob.absolute_path
+            db.session.delete(md.shards[0])
+            db.session.commit()
+            assert _shard_blobs_gc() == 1
+            assert not os.path.exists(fn)
+            assert not db.session.query(ComponentShardBlob).all()
+
+            # an unreferenced row is reused, and then not collected
+            checksum = hashlib.sha256(b'hello world').hexdigest()
+            db.session.add(ComponentShardBlob(checksum=checksum, size=11))
+            db.session.commit()
+            shard = ComponentShard(name='DxeCore', guid='d9d114ef-f40b-4d48-aaa0-a3dc99c9f5bd')
+            shard.set_blob(b'hello world')
+            md.shards.append(shard)
+            shard.save()
+            db.session.commit()
+            assert shard.shard_blob.refcnt == 1, shard.shard_blob
+            assert _shard_blobs_gc() == 0
+            assert os.path.exists(shard.absolute_path)
+            db.session.delete(shard)
+            db.session.commit()
+            assert _shard_blobs_gc() == 1
+
+            # written before deduplication
+            shard = ComponentShard(name='PeiCore', guid='d9d114ef-f40b-4d48-aaa0-a3dc99c9f5bd')
+            shard.set_blob(b'legacy')
+            md.shards.append(shard)
+            db.session.commit()
+            os.makedirs(os.path.dirname(shard.legacy_path))
+            with open(shard.legacy_path, 'wb') as f:
+                f.write(zlib.compress(b'legacy'))
+            assert _shard_blobs_migrate() == 1
+            assert not os.path.exists(shard.legacy_path)
+            assert shard.shard_blob.refcnt == 1
+            assert os.path.exists(shard.absolute_path)
+
+    def test_shard_caches(self):
+
+        import tempfile
+        from lvfs import app, db, ploader
+        from lvfs.components.models import ComponentShard, ComponentShardAttribute
+        from lvfs.shards.utils import _shard_caches_prune
+        from lvfs.util import _write_atomic
+
+        shard_dir_old = app.config['SHARD_DIR']
+        with app.test_request_context(), tempfile.TemporaryDirectory() as shard_dir:
+            app.config['SHARD_DIR'] = shard_dir
+            self.addCleanup(app.config.__setitem__, 'SHARD_DIR', shard_dir_old)
+
+            # the extracted shards refer to the contents in the shard store
+            plugin = ploader.get_by_id('uefi-extract')
+            shards = []
+            for name, blob in [('DxeCore', b'hello world'), ('PeiCore', b'')]:
+                shard = ComponentShard(name=name, guid='d9d114ef-f40b-4d48-aaa0-a3dc99c9f5bd')
+                shard.set_blob(blob)
+                shard.attributes.append(ComponentShardAttribute(key='foo', value=name))
+                shards.append(shard)
+            fn = plugin._get_cache_fn(shards[0].checksum, '0.28.0')
+            plugin._save_cached_shards(fn, shards)
+            with open(fn, 'rb') as f:
+                assert b'hello world' not in f.read()
+
+            # not in the shard store yet
+            assert plugin._load_cached_shards(fn) is None
+            for shard in shards:
+                shard.save()
+            db.session.commit()
+            shards = plugin._load_cached_shards(fn)
+            assert [shard.name for shard in shards] == ['DxeCore', 'PeiCore'], shards
+            assert shards[0].blob == b'hello world', shards[0].blob
+            assert shards[1].blob == b'', shards[1].blob
+            assert shards[1].attributes[0].value == 'PeiCore'
+
+            # removed from the shard store
+            checksum = shards[0].checksum
+            os.unlink(os.path.join(shard_dir, 'blobs', checksum[:2], checksum))
+            assert plugin._load_cached_shards(fn) is None
+
+            # used recently, so kept
+            assert _shard_caches_prune() == 0
+            assert os.path.exists(fn)
+
+            # not used for a while, so removed along with the version directory
+            os.utime(fn, (0, 0))
+            assert _shard_caches_prune() == 1
+            assert os.listdir(os.path.join(shard_dir, 'uefi-extract')) == []
+
+            # results for an old version of pefile
+            fn = os.path.join(shard_dir, 'pecheck', '1-2019.1.1', 'ab', 'abcd.json')
+            _write_atomic(fn, b'{}')
+            os.utime(fn, (0, 0))
+            assert _shard_caches_prune() == 1
+            assert os.listdir(os.path.join(shard_dir, 'pecheck')) == []
+
+    def test_shard_microcode(self):
+
+        from lvfs import app, db
+        from lvfs.components.models import Component, ComponentShard, \
+                ComponentShardAttribute, ComponentShardMicrocode, MICROCODE_INTEL_GUID
+
+        self.login()
+        self.upload()
+        with app.test_request_context():
+            md = db.session.query(Component).first()
+
+            # not microcode
+            shard = ComponentShard(name='DxeCore', guid='d9d114ef-f40b-4d48-aaa0-a3dc99c9f5bd')
+            md.shards.append(shard)
+            shard.ensure_microcode()
+            assert not shard.microcode
+
+            # missing the version
+            shard = ComponentShard(name='com.intel.Microcode', guid=MICROCODE_INTEL_GUID)
+            for key, value in [('cpuid', '000806E9'), ('platform', '000000C0'), ('yyyymmdd', '20200101')]:
+                shard.attributes.append(ComponentShardAttribute(key=key, value=value))
+            md.shards.append(shard)
+            shard.ensure_microcode()
+            assert not shard.microcode
+
+            # indexed
+            shard.attributes.append(ComponentShardAttribute(key='version', value='000000C6'))
+            shard.ensure_microcode()
+            db.session.commit()
+            mc = db.session.query(ComponentShardMicrocode)\
+                           .filter(ComponentShardMicrocode.cpuid == '000806E9')\
+                           .filter(ComponentShardMicrocode.platform == '000000C0')\
+                           .one()
+            assert mc.shard == shard, mc
+            assert mc.md == md, mc
+            assert mc.vendor_id == md.fw.vendor_id, mc
+            assert mc.version == '000000C6', mc
+
+            # removed with the shard
+            db.session.delete(shard)
+            db.session.commit()
+            assert not db.session.query(ComponentShardMicrocode).all()
+
+    def test_shard_claim_index(self):
+
+        from lvfs import app, db
+        from lvfs.claims.models import Claim
+        from lvfs.components.models import Component, ComponentShard, \
+                ComponentShardInfo, ComponentShardClaim, ComponentShardChecksum, \
+                ComponentShardClaimGeneration
+        from lvfs.shards.utils import _regenerate_shard_infos, shard_claims
+
+        self.login()
+        self.upload()
+        with app.test_request_context():
+            md = db.session.query(Component).first()
+            for name in ['DxeCore', 'PeiCore', 'PeiCoreCopy']:
+                shard = ComponentShard(name=name, guid='d9d114ef-f40b-4d48-aaa0-a3dc99c9f5bd')
+                if name == 'DxeCore':
+                    shard.guid = '12345678-1234-5678-1234-567812345678'
+                shard.checksums.append(ComponentShardChecksum(kind='SHA256', value=name))
+                md.shards.append(shard)
+            db.session.commit()
+
+            # one info per GUID, with the number of shards
+            _regenerate_shard_infos()
+            infos = {info.guid: info for info in db.session.query(ComponentShardInfo)}
+            assert len(infos) == 2, infos
+            assert infos['d9d114ef-f40b-4d48-aaa0-a3dc99c9f5bd'].cnt == 2
+            assert infos['12345678-1234-5678-1234-567812345678'].cnt == 1
+            for shard in md.shards:
+                db.session.refresh(shard)
+                assert shard.info == infos[shard.guid], shard
+
+            # no claims
+            assert not shard_claims.get_claims(md.shards[0])
+
+            # claims by GUID and by checksum
+            claim1 = Claim(kind='foo', summary='foo')
+            claim2 = Claim(kind='bar', summary='bar')
+            db.session.add(claim1)
+            db.session.add(claim2)
+            infos['12345678-1234-5678-1234-567812345678'].claim = claim1
+            db.session.add(ComponentShardClaim(info=infos['d9d114ef-f40b-4d48-aaa0-a3dc99c9f5bd'],
+                                               checksum='PeiCoreCopy',
+                                               claim=claim2))
+            db.session.commit()
+            shard_claims.invalidate()
+            claims = {shard.name: shard_claims.get_claims(shard) for shard in md.shards}
+            assert claims['DxeCore'] == [claim1], claims
+            assert claims['PeiCore'] == [], claims
+            assert claims['PeiCoreCopy'] == [claim2], claims
+            gen = db.session.query(ComponentShardClaimGeneration).one()
+            assert gen.value > 0, gen
+
+            # changed by another process
+            db.session.query(ComponentShardClaim).delete()
+            db.session.query(ComponentShardClaimGeneration)\
+                      .update({ComponentShardClaimGeneration.value: gen.value + 1})
+            db.session.commit()
+            shard = [shard for shard in md.shards if shard.name == 'PeiCoreCopy'][0]
+            shard_claims.refresh()
+            assert shard_claims.get_claims(shard) == []
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,51 +7,199 @@
 #
 # pylint: disable=singleton-comparison
 
-from typing import Dict
+import os
+import zlib
+import time
+from typing import Any, Dict, List, Optional
 
-from lvfs import db, tq
+from sqlalchemy import func
 
-from lvfs.components.models import ComponentShard, ComponentShardInfo
+from lvfs import app, db, tq
+from lvfs.generationcache import GenerationCache
 
-def _generate_stats_shard_info(info: ComponentShardInfo):
+from lvfs.claims.models import Claim
+from lvfs.components.models import ComponentShard, ComponentShardInfo, ComponentShardBlob, \
+        ComponentShardClaim, ComponentShardClaimGeneration
 
-    cnt = db.session.query(ComponentShard.component_shard_id)\
-                    .filter(ComponentShard.guid == info.guid)\
-                    .count()
-    if info.cnt != cnt:
-        print('fixing ComponentShardInfo %i: %i -> %i' % (info.component_shard_info_id, info.cnt, cnt))
-        info.cnt = cnt
+class ShardClaimIndex(GenerationCache):
+    """ An in-memory map of shard GUID and checksum to claim """
+
+    def __init__(self) -> None:
+        GenerationCache.__init__(self, ComponentShardClaimGeneration)
+        self._claim_ids_by_guid: Dict[str, int] = {}
+        self._claim_ids_by_csum: Dict[str, int] = {}
+
+    def _load(self) -> None:
+        claim_ids_by_guid: Dict[str, int] = {}
+        claim_ids_by_csum: Dict[str, int] = {}
+        for guid, claim_id in db.session.query(ComponentShardInfo.guid,
+                                               ComponentShardInfo.claim_id)\
+                                        .filter(ComponentShardInfo.claim_id != None):
+            claim_ids_by_guid[guid] = claim_id
+        for checksum, claim_id in db.session.query(ComponentShardClaim.checksum,
+                                                   ComponentShardClaim.claim_id)\
+                                            .filter(ComponentShardClaim.claim_id != None)\
+                                            .filter(ComponentShardClaim.checksum != None):
+            claim_ids_by_csum[checksum] = claim_id
+        self._claim_ids_by_guid = claim_ids_by_guid
+        self._claim_ids_by_csum = claim_ids_by_csum
+
+    def get_claims(self, shard: ComponentShard) -> List[Claim]:
+        """ Returns the claims that match either the shard GUID or checksum """
+        self._ensure_loaded()
+        claim_ids: List[int] = []
+        for claim_id in [self._claim_ids_by_guid.get(shard.guid),
+                         self._claim_ids_by_csum.get(shard.checksum)]:
+            if claim_id and claim_id not in claim_ids:
+                claim_ids.append(claim_id)
+        claims: List[Claim] = []
+        for claim_id in claim_ids:
+            claim = db.session.query(Claim).get(claim_id)
+            if claim:
+                claims.append(claim)
+        return claims
+
+
+shard_claims = ShardClaimIndex()
 
 def _regenerate_shard_infos():
 
-    # Set ComponentShardInfo in ComponentShard if GUID matches
-    infos: Dict[str, ComponentShardInfo] = {}
-    for info in db.session.query(ComponentShardInfo):
-        infos[info.guid] = info
-    for component_shard_id, in db.session.query(ComponentShard.component_shard_id)\
-                                         .filter(ComponentShard.component_shard_info_id == None):
-        shard = db.session.query(ComponentShard)\
-                          .filter(ComponentShard.component_shard_id == component_shard_id).one()
-        shard.info = infos.get(shard.guid)
-        if shard.info:
-            print('fixing shard {} with {}'.format(component_shard_id, shard.guid))
-        else:
-            print('creating ComponentShardInfo for {}'.format(shard.guid))
-            info = ComponentShardInfo(guid=shard.guid)
-            db.session.add(info)
-            shard.info = info
-            infos[shard.guid] = shard.info
-        db.session.commit()
+    # create a ComponentShardInfo for any GUID that does not have one
+    guids = [guid for guid, in db.session.query(ComponentShard.guid)\
+                                         .filter(ComponentShard.component_shard_info_id == None)\
+                                         .filter(ComponentShard.guid != None)\
+                                         .filter(~ComponentShard.guid.in_(
+                                             db.session.query(ComponentShardInfo.guid)\
+                                                       .filter(ComponentShardInfo.guid != None)))\
+                                         .distinct()]
+    if guids:
+        print('creating {} ComponentShardInfo objects'.format(len(guids)))
+        db.session.bulk_insert_mappings(ComponentShardInfo,
+                                        [{'guid': guid, 'cnt': 0} for guid in guids])
+
+    # set ComponentShardInfo in ComponentShard if GUID matches
+    info_id = db.session.query(func.min(ComponentShardInfo.component_shard_info_id))\
+                        .filter(ComponentShardInfo.guid == ComponentShard.guid)\
+                        .correlate(ComponentShard)\
+                        .as_scalar()
+    cnt = db.session.query(ComponentShard)\
+                    .filter(ComponentShard.component_shard_info_id == None)\
+                    .filter(ComponentShard.guid != None)\
+                    .update({ComponentShard.component_shard_info_id: info_id},
+                            synchronize_session=False)
+    if cnt:
+        print('fixing {} shards'.format(cnt))
 
-    # update ComponentShardInfo.cnt
-    for info_id, in db.session.query(ComponentShardInfo.component_shard_info_id)\
-                              .order_by(ComponentShardInfo.component_shard_info_id.asc()):
-        info = db.session.query(ComponentShardInfo)\
-                         .filter(ComponentShardInfo.component_shard_info_id == info_id)\
-                         .one()
-        _generate_stats_shard_info(info)
+    # update ComponentShardInfo.cnt using one grouped query
+    cnts: Dict[Optional[str], int] = {}
+    for guid, cnt in db.session.query(ComponentShard.guid,
+                                      func.count(ComponentShard.component_shard_id))\
+                               .group_by(ComponentShard.guid):
+        cnts[guid] = cnt
+    mappings: List[Dict[str, Any]] = []
+    for info_id, guid, cnt_old in db.session.query(ComponentShardInfo.component_shard_info_id,
+                                                   ComponentShardInfo.guid,
+                                                   ComponentShardInfo.cnt):
+        cnt = cnts.get(guid, 0)
+        if cnt_old != cnt:
+            print('fixing ComponentShardInfo %i: %i -> %i' % (info_id, cnt_old or 0, cnt))
+            mappings.append({'component_shard_info_id': info_id, 'cnt': cnt})
+    db.session.bulk_update_mappings(ComponentShardInfo, mappings)
     db.session.commit()
 
 @tq.task(max_retries=3, default_retry_delay=60, task_time_limit=600)
 def _async_regenerate_shard_infos():
     _regenerate_shard_infos()
+
+def _shard_blobs_gc() -> int:
+
+    # delete the row first so a concurrent save() cannot reuse the file, and
+    # only commit once the file has gone so that a new row does not find it
+    cnt = 0
+    for shard_blob_id, in db.session.query(ComponentShardBlob.component_shard_blob_id)\
+                                    .filter(ComponentShardBlob.refcnt <= 0)\
+                                    .all():
+        shard_blob = db.session.query(ComponentShardBlob)\
+                               .filter(ComponentShardBlob.component_shard_blob_id == shard_blob_id)\
+                               .filter(ComponentShardBlob.refcnt <= 0)\
+                               .with_for_update(skip_locked=True)\
+                               .first()
+        if not shard_blob:
+            continue
+        fn = shard_blob.absolute_path
+        db.session.delete(shard_blob)
+        db.session.flush()
+        if os.path.exists(fn):
+            os.remove(fn)
+        db.session.commit()
+        cnt += 1
+    return cnt
+
+# results cached by plugins and keyed by the payload checksum, where nothing
+# holds a reference so entries are removed once they have not been used for a while
+SHARD_CACHE_DIRS = ['uefi-extract', 'pecheck', 'blocklist']
+
+def _shard_caches_prune(max_age: Optional[int] = None) -> int:
+
+    # directories for old tool versions and rules are removed once they are empty
+    if max_age is None:
+        max_age = app.config.get('SHARD_CACHE_MAX_AGE', 30)
+    mtime_min = time.time() - max_age * 86400
+    cnt = 0
+    for dirname in SHARD_CACHE_DIRS:
+        path = os.path.join(app.config['SHARD_DIR'], dirname)
+        for root, _, fns in os.walk(path, topdown=False):
+            for fn in fns:
+                fn = os.path.join(root, fn)
+                try:
+                    if os.path.getmtime(fn) < mtime_min:
+                        os.remove(fn)
+                        cnt += 1
+                except FileNotFoundError as _:
+                    pass
+            if root != path:
+                try:
+                    os.rmdir(root)
+                except OSError as _:
+                    pass
+    return cnt
+
+@tq.task(max_retries=3, default_retry_delay=60, task_time_limit=600)
+def _async_shard_blobs_gc():
+    _shard_blobs_gc()
+    _shard_caches_prune()
+
+def _shard_blobs_migrate() -> int:
+
+    # move shards written to SHARD_DIR/<component_id>/<name> into the shared store
+    cnt = 0
+    for component_shard_id, in db.session.query(ComponentShard.component_shard_id)\
+                                         .filter(ComponentShard.component_shard_blob_id == None)\
+                                         .order_by(ComponentShard.component_shard_id.asc())\
+                                         .all():
+        shard = db.session.query(ComponentShard)\
+                          .filter(ComponentShard.component_shard_id == component_shard_id)\
+                          .one()
+        fn = shard.legacy_path
+        if not os.path.exists(fn):
+            continue
+        with open(fn, 'rb') as f:
+            try:
+                shard.blob = zlib.decompressobj().decompress(f.read())
+            except zlib.error as e:
+                print('failed to decompress {}: {}'.format(fn, str(e)))
+                continue
+        shard.save()
+        db.session.commit()
+        os.remove(fn)
+        try:
+            os.rmdir(os.path.dirname(fn))
+        except OSError as _:
+            pass
+        cnt += 1
+    return cnt
+
+@tq.task(max_retries=3, default_retry_delay=60, task_time_limit=86400)
+def _async_shard_blobs_migrate():
+    _shard_blobs_migrate()
+    _shard_blobs_gc()
@@ -52,6 +52,8 @@ class Test(db.Model):
     waived_ts = Column(DateTime, default=None)
     waived_user_id = Column(Integer, ForeignKey("users.user_id"), nullable=True)
     max_age = Column(Integer, default=0)
+    lease_ts = Column(DateTime, default=None)
+    attempts = Column(Integer, default=0)
 
     waived_user = relationship("User", foreign_keys=[waived_user_id])
     attributes = relationship(
@@ -82,6 +84,8 @@ class Test(db.Model):
         self.started_ts = None
         self.ended_ts = None
         self.waived_ts = None
+        self.lease_ts = None
+        self.attempts = 0
         for attr in self.attributes:
             db.session.delete(attr)
 
@@ -5,7 +5,7 @@
 #
 # SPDX-License-Identifier: GPL-2.0+
 #
-# pylint: disable=wrong-import-position,singleton-comparison
+# pylint: disable=wrong-import-position,singleton-comparison,no-self-use
 
 import os
 import sys
@@ -33,5 +33,104 @@ class LocalTestCase(LvfsTestCase):
         rv = self.app.get('/lvfs/tests/')
         assert 'check firmware for problems' in rv.data.decode('utf-8'), rv.data.decode()
 
+    def test_dependencies(self):
+
+        from lvfs import ploader
+        from lvfs.tests.models import Test
+        from lvfs.tests.utils import _test_dependencies
+
+        # shard consumers wait for shard producers
+        assert 'uefi-extract' in ploader.get_dependencies('pecheck')
+        assert 'intelme' in ploader.get_dependencies('pecheck')
+        assert ploader.get_by_id('pecheck').priority > ploader.get_by_id('uefi-extract').priority
+        assert not ploader.get_dependencies('uefi-extract')
+
+        # but only for the same firmware
+        tests = [Test(test_id=1, firmware_id=1, plugin_id='uefi-extract'),
+                 Test(test_id=2, firmware_id=1, plugin_id='pecheck'),
+                 Test(test_id=3, firmware_id=2, plugin_id='pecheck'),
+                 Test(test_id=4, firmware_id=1, plugin_id='clamav')]
+        deps = _test_dependencies(tests)
+        assert deps == {1: set(), 2: {1}, 3: set(), 4: set()}, deps
+
+    def test_claim(self):
+
+        import datetime
+        from lvfs import app, db
+        from lvfs.tests.models import Test
+        from lvfs.tests.utils import _test_claim, _test_expire_leases
+
+        self.login()
+        self.upload()
+        rv = self.app.post('/lvfs/tests/retry/3', follow_redirects=True)
+        assert 'Test blocklist will be re-run soon' in rv.data.decode('utf-8'), rv.data.decode()
+
+        with app.test_request_context():
+
+            # only one worker can win
+            tests = _test_claim(test_id=3)
+            assert len(tests) == 1, tests
+            assert tests[0].attempts == 1
+            assert tests[0].is_running
+            assert not _test_claim(test_id=3)
+
+            # the worker went away, so somebody else picks it up
+            for attempt in [2, 3]:
+                tests[0].lease_ts = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+                db.session.commit()
+                assert not _test_expire_leases()
+                tests = _test_claim(test_id=3)
+                assert len(tests) == 1, tests
+                assert tests[0].attempts == attempt
+
+            # out of retries
+            tests[0].lease_ts = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+            db.session.commit()
+            assert not _test_claim(test_id=3)
+            assert _test_expire_leases() == 1
+            test = db.session.query(Test).filter(Test.test_id == 3).one()
+            assert test.ended_ts
+            assert not test.success
+
+    def test_claim_dependencies(self):
+
+        import datetime
+        from lvfs import app, db
+        from lvfs.firmware.models import Firmware
+        from lvfs.tests.models import Test
+        from lvfs.tests.utils import _test_claim
+
+        self.login()
+        self.upload()
+        with app.test_request_context():
+
+            # the shard consumer has to wait for the producer
+            fw = db.session.query(Firmware).filter(Firmware.firmware_id == 1).one()
+            test_producer = Test(plugin_id='uefi-extract')
+            fw.tests.append(test_producer)
+            test_consumer = fw.find_test_by_plugin_id('blocklist')
+            test_consumer.retry()
+            db.session.commit()
+            assert not _test_claim(test_id=test_consumer.test_id)
+
+            # unless they are claimed together
+            tests = _test_claim(firmware_id=1)
+            assert {test.plugin_id for test in tests} == {'uefi-extract', 'blocklist'}, tests
+
+            # or the producer is still running somewhere else
+            test_producer = db.session.query(Test)\
+                                      .filter(Test.plugin_id == 'uefi-extract')\
+                                      .one()
+            test_consumer = db.session.query(Test)\
+                                      .filter(Test.plugin_id == 'blocklist')\
+                                      .one()
+            test_consumer.retry()
+            db.session.commit()
+            assert not _test_claim()
+            test_producer.ended_ts = datetime.datetime.utcnow()
+            db.session.commit()
+            tests = _test_claim()
+            assert [test.plugin_id for test in tests] == ['blocklist'], tests
+
 if __name__ == '__main__':
     unittest.main()
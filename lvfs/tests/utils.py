@@ -9,12 +9,16 @@
 
 import socket
 import datetime
-from typing import List, Optional
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Optional, Dict, Set
 
-from lvfs import db, ploader, tq
+from sqlalchemy import and_, or_
+
+from lvfs import app, db, ploader, tq
 
 from lvfs.firmware.models import Firmware
-from lvfs.tests.models import Test
+from lvfs.tests.models import Test, TestAttribute
 from lvfs.util import _event_log
 
 def _test_priority_sort_func(test: Test) -> int:
@@ -23,97 +27,257 @@ def _test_priority_sort_func(test: Test) -> int:
         return 0
     return plugin.priority
 
-def _test_run_all(tests: Optional[List[Test]] = None) -> None:
+def _test_lease_duration() -> datetime.timedelta:
+    return datetime.timedelta(seconds=app.config.get('TEST_LEASE_TIME', 7200))
 
-    # make a list of the first few tests that need running
-    if not tests:
-        tests = db.session.query(Test)\
-                          .filter(Test.started_ts == None)\
-                          .order_by(Test.scheduled_ts)\
-                          .limit(50).all()
-        if not tests:
-            return
+def _test_claimable(now: datetime.datetime):
+    """ Tests that have never started, or where the worker has gone away """
+    return and_(Test.attempts < app.config.get('TEST_MAX_ATTEMPTS', 3),
+                or_(Test.started_ts == None,
+                    and_(Test.ended_ts == None, Test.lease_ts < now)))
 
-    # mark all the tests as started
-    for test in tests:
-        print('Marking test {} started for firmware {}...'.format(test.plugin_id, test.fw.firmware_id))
-        test.started_ts = datetime.datetime.utcnow()
+def _test_claim(firmware_id: Optional[int] = None,
+                test_id: Optional[int] = None,
+                limit: Optional[int] = None) -> List[Test]:
+    """ Atomically marks tests as started by this worker, returning the ones it won
+
+    All the claimable tests for each firmware are claimed together, and limit is
+    the number of firmware. Tests that depend on another test for the same firmware
+    that has not ended, and that is not being claimed at the same time, are left
+    for later so that shard consumers never run before the shard producers.
+    """
+
+    now = datetime.datetime.utcnow()
+    stmt = db.session.query(Test.firmware_id).filter(_test_claimable(now))
+    if firmware_id:
+        stmt = stmt.filter(Test.firmware_id == firmware_id)
+    if test_id:
+        stmt = stmt.filter(Test.test_id == test_id)
+    stmt_fw = db.session.query(Firmware.firmware_id)\
+                        .filter(Firmware.firmware_id.in_(stmt))\
+                        .order_by(Firmware.firmware_id)
+    if limit:
+        stmt_fw = stmt_fw.limit(limit)
+
+    # firmware locked by other workers is skipped rather than waited for
+    if db.engine.name == 'postgresql':
+        stmt_fw = stmt_fw.with_for_update(skip_locked=True)
+    firmware_ids = [fw_id for fw_id, in stmt_fw]
+    if not firmware_ids:
+        db.session.commit()
+        return []
+    stmt = db.session.query(Test.test_id)\
+                     .filter(Test.firmware_id.in_(firmware_ids))\
+                     .filter(_test_claimable(now))
+    if test_id:
+        stmt = stmt.filter(Test.test_id == test_id)
+    claim_ids: Set[int] = {claim_id for claim_id, in stmt}
+
+    # dropping a producer can block its consumers in turn
+    deps = _test_dependencies(db.session.query(Test)\
+                                        .filter(Test.firmware_id.in_(firmware_ids))\
+                                        .filter(Test.ended_ts == None)\
+                                        .all())
+    while True:
+        blocked = {claim_id for claim_id in claim_ids
+                   if deps.get(claim_id, set()) - claim_ids}
+        if not blocked:
+            break
+        claim_ids -= blocked
+
+    values = {Test.started_ts: now,
+              Test.ended_ts: None,
+              Test.lease_ts: now + _test_lease_duration(),
+              Test.attempts: Test.attempts + 1,
+              Test.container_id: socket.gethostname()}
+
+    # the firmware rows are locked, so nobody else can claim these tests
+    test_ids: List[int] = []
+    if db.engine.name == 'postgresql':
+        test_ids = sorted(claim_ids)
+        if test_ids:
+            db.session.query(Test)\
+                      .filter(Test.test_id.in_(test_ids))\
+                      .update(values, synchronize_session=False)
+
+    # no row locks, so only keep the rows where our conditional update won
+    else:
+        for claim_id in sorted(claim_ids):
+            if db.session.query(Test)\
+                         .filter(Test.test_id == claim_id)\
+                         .filter(_test_claimable(now))\
+                         .update(values, synchronize_session=False):
+                test_ids.append(claim_id)
+    if not test_ids:
+        db.session.commit()
+        return []
+
+    # results from a worker that crashed part way through are incomplete
+    db.session.query(TestAttribute)\
+              .filter(TestAttribute.test_id.in_(test_ids))\
+              .delete(synchronize_session=False)
     db.session.commit()
+    return db.session.query(Test)\
+                     .filter(Test.test_id.in_(test_ids))\
+                     .order_by(Test.scheduled_ts)\
+                     .all()
 
-    # process each test
-    for test in sorted(tests, key=_test_priority_sort_func):
-        plugin = ploader.get_by_id(test.plugin_id)
-        if not plugin:
-            _event_log('No plugin %s' % test.plugin_id)
-            test.ended_ts = datetime.datetime.utcnow()
-            continue
-        try:
-            test.container_id = socket.gethostname()
-            print(
-                "Running test {} for firmware {} on {}".format(
-                    test.plugin_id,
-                    test.fw.firmware_id,
-                    test.container_id,
-                )
+def _test_expire_leases() -> int:
+    """ Fails any tests where the workers have gone away too many times """
+
+    cnt = 0
+    for test in db.session.query(Test)\
+                          .filter(Test.started_ts != None)\
+                          .filter(Test.ended_ts == None)\
+                          .filter(Test.lease_ts < datetime.datetime.utcnow())\
+                          .filter(Test.attempts >= app.config.get('TEST_MAX_ATTEMPTS', 3)):
+        test.ended_ts = datetime.datetime.utcnow()
+        test.add_fail('Test did not complete',
+                      'Gave up after {} attempts'.format(test.attempts))
+        cnt += 1
+    db.session.commit()
+    return cnt
+
+def _test_run(test: Test) -> None:
+    plugin = ploader.get_by_id(test.plugin_id)
+    if not plugin:
+        _event_log('No plugin %s' % test.plugin_id)
+        test.ended_ts = datetime.datetime.utcnow()
+        return
+    try:
+        # the batch may have been claimed some time ago
+        test.lease_ts = datetime.datetime.utcnow() + _test_lease_duration()
+        db.session.commit()
+        test.container_id = socket.gethostname()
+        print(
+            "Running test {} for firmware {} on {}".format(
+                test.plugin_id,
+                test.fw.firmware_id,
+                test.container_id,
             )
-            try:
-                if not plugin.require_test_for_fw(test.fw):
-                    continue
-            except NotImplementedError as _:
-                pass
-            try:
+        )
+        if plugin.implements('require_test_for_fw'):
+            with ploader.measure(plugin, 'require_test_for_fw'):
+                required = plugin.require_test_for_fw(test.fw)
+            if not required:
+                test.ended_ts = datetime.datetime.utcnow()
+                return
+        if plugin.implements('run_test_on_fw'):
+            with ploader.measure(plugin, 'run_test_on_fw'):
                 plugin.run_test_on_fw(test, test.fw)
-            except NotImplementedError as _:
-                pass
+        if plugin.implements('run_test_on_md'):
             for md in test.fw.mds:
-                try:
-                    if not plugin.require_test_for_md(md):
+                if plugin.implements('require_test_for_md'):
+                    with ploader.measure(plugin, 'require_test_for_md'):
+                        required = plugin.require_test_for_md(md)
+                    if not required:
                         continue
-                except NotImplementedError as _:
-                    pass
-                try:
+                with ploader.measure(plugin, 'run_test_on_md'):
                     plugin.run_test_on_md(test, md)
-                except NotImplementedError as _:
-                    pass
-            test.ended_ts = datetime.datetime.utcnow()
-            # don't leave a failed task running
-            db.session.commit()
-        except Exception as e: # pylint: disable=broad-except
-            test.ended_ts = datetime.datetime.utcnow()
-            test.add_fail('An exception occurred', str(e))
+        test.ended_ts = datetime.datetime.utcnow()
+        # don't leave a failed task running
+        db.session.commit()
+    except Exception as e: # pylint: disable=broad-except
+        test.ended_ts = datetime.datetime.utcnow()
+        test.add_fail('An exception occurred', str(e))
+
+def _test_run_by_id(test_id: int) -> None:
+
+    # each thread gets a new session from the scoped session registry
+    with app.app_context():
+        try:
+            test = db.session.query(Test).filter(Test.test_id == test_id).first()
+            if test:
+                _test_run(test)
+                db.session.commit()
+        finally:
+            db.session.remove()
+
+def _test_dependencies(tests: List[Test]) -> Dict[int, Set[int]]:
+    """ Returns the test IDs that each test has to wait for """
+
+    # shard consumers have to wait for the shard producers for the same firmware
+    deps: Dict[int, Set[int]] = {}
+    tests_by_fw: Dict[int, List[Test]] = defaultdict(list)
+    for test in tests:
+        tests_by_fw[test.firmware_id].append(test)
+    for test in tests:
+        plugin_ids = ploader.get_dependencies(test.plugin_id)
+        deps[test.test_id] = {test2.test_id for test2 in tests_by_fw[test.firmware_id]
+                              if test2.plugin_id in plugin_ids}
+    return deps
+
+def _test_run_parallel(tests: List[Test], max_workers: int) -> None:
+
+    deps = _test_dependencies(tests)
+    dependents: Dict[int, List[int]] = defaultdict(list)
+    for test_id, test_ids in deps.items():
+        for test_id_dep in test_ids:
+            dependents[test_id_dep].append(test_id)
+
+    # start everything that is ready, highest priority first
+    ready = [test.test_id for test in sorted(tests, key=_test_priority_sort_func)
+             if not deps[test.test_id]]
+    futures: Dict[Future, int] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while ready or futures:
+            for test_id in ready:
+                futures[executor.submit(_test_run_by_id, test_id)] = test_id
+            ready = []
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                test_id = futures.pop(future)
+                if future.exception():
+                    _event_log('Failed to run test %s: %s' % (test_id, str(future.exception())))
+                for test_id_dep in dependents[test_id]:
+                    deps[test_id_dep].discard(test_id)
+                    if not deps[test_id_dep]:
+                        ready.append(test_id_dep)
+
+    # the results were committed by the other sessions
+    db.session.expire_all()
+
+def _test_run_all(tests: Optional[List[Test]] = None) -> None:
+
+    # claim the first few tests that need running
+    if tests is None:
+        tests = _test_claim(limit=10)
+    if not tests:
+        return
+
+    # sqlite cannot write from more than one connection at a time
+    max_workers = app.config.get('TEST_WORKERS', 1)
+    if db.engine.name == 'sqlite':
+        max_workers = 1
+    if max_workers > 1 and len(tests) > 1:
+        _test_run_parallel(tests, max_workers)
+        return
+
+    # process each test
+    for test in sorted(tests, key=_test_priority_sort_func):
+        _test_run(test)
 
     # all done
     db.session.commit()
 
 @tq.task(max_retries=3, default_retry_delay=600, task_time_limit=3600)
 def _async_test_run_all():
-    tests = db.session.query(Test)\
-                      .filter(Test.started_ts == None)\
-                      .all()
-    if not tests:
-        return
-    _test_run_all(tests)
+    _test_expire_leases()
+
+    # claim a few firmware at a time so that other workers can take a share
+    while True:
+        tests = _test_claim(limit=10)
+        if not tests:
+            break
+        _test_run_all(tests)
 
 @tq.task(max_retries=3, default_retry_delay=5, task_time_limit=600)
 def _async_test_run(test_id):
-    tests = db.session.query(Test)\
-                      .filter(Test.started_ts == None)\
-                      .filter(Test.test_id == test_id)\
-                      .all()
-    if not tests:
-        return
-    _test_run_all(tests)
+    _test_run_all(_test_claim(test_id=test_id))
 
 @tq.task(max_retries=3, default_retry_delay=60, task_time_limit=600)
 def _async_test_run_for_firmware(firmware_id):
-    tests = db.session.query(Test)\
-                      .filter(Test.started_ts == None)\
-                      .filter(Test.firmware_id == firmware_id)\
-                      .order_by(Test.scheduled_ts)\
-                      .all()
-    if not tests:
-        return
-    _test_run_all(tests)
+    _test_run_all(_test_claim(firmware_id=firmware_id))
 
 @tq.task(max_retries=3, default_retry_delay=60, task_time_limit=60 * 60)
 def _async_test_ensure():
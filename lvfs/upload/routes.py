@@ -8,13 +8,14 @@
 # pylint: disable=too-many-locals
 
 import os
-import hashlib
 from typing import List, Optional
 
 from flask import Blueprint, request, flash, url_for, redirect, render_template, g
 from flask_login import login_required
 from sqlalchemy import or_
 
+from cabarchive import CabWriter
+
 from lvfs import app, db, ploader, csrf
 
 from lvfs.agreements.models import Agreement
@@ -189,9 +190,8 @@ def _upload_firmware():
     if not os.path.exists(download_dir):
         os.mkdir(download_dir)
     fn = os.path.join(download_dir, ufile.fw.filename)
-    cab_data = ufile.cabarchive_repacked.save(compress=True)
-    with open(fn, 'wb') as f:
-        f.write(cab_data)
+    cabwriter = CabWriter(ufile.cabarchive_repacked, compress=True)
+    cabwriter.save(fn, digests=['sha1', 'sha256'])
 
     # create parent firmware object
     settings = _get_settings()
@@ -202,8 +202,8 @@ def _upload_firmware():
     fw.user = g.user
     fw.addr = _get_client_address()
     fw.remote = remote
-    fw.checksum_signed_sha1 = hashlib.sha1(cab_data).hexdigest()
-    fw.checksum_signed_sha256 = hashlib.sha256(cab_data).hexdigest()
+    fw.checksum_signed_sha1 = cabwriter.checksums['sha1']
+    fw.checksum_signed_sha256 = cabwriter.checksums['sha256']
     fw.is_dirty = True
     fw.failure_minimum = settings['default_failure_minimum']
     fw.failure_percentage = settings['default_failure_percentage']
@@ -231,6 +231,9 @@ def _upload_firmware():
                 flash('Component {} does not have required LVFS::VersionFormat'.\
                       format(md.appstream_id), 'warning')
 
+        # allow ordering by version in the database
+        md.fix_version_sort()
+
     # add to database
     fw.events.append(FirmwareEvent(remote_id=remote.remote_id, user_id=g.user.user_id))
     db.session.add(fw)
@@ -7,8 +7,10 @@
 #
 # pylint: disable=wrong-import-position
 
+import os
 import socket
 import json
+import tempfile
 import calendar
 import datetime
 import string
@@ -183,15 +185,21 @@ def _xml_from_markdown(markdown: str) -> Optional[ET.Element]:
 
 def _get_settings(prefix: Optional[str] = None) -> Dict[str, str]:
     """ return a dict of all the settings """
-    from lvfs import db
-    from lvfs.settings.models import Setting
-    settings = {}
-    stmt = db.session.query(Setting)
-    if prefix:
-        stmt = stmt.filter(Setting.key.startswith(prefix))
-    for setting in stmt:
-        settings[setting.key] = setting.value
-    return settings
+    from lvfs.settings.utils import settings_store
+    return settings_store.get_all(prefix)
+
+def _write_atomic(fn: str, blob: bytes) -> None:
+    """ Writes a file so that other workers never see it partially written """
+    dirname = os.path.dirname(fn)
+    os.makedirs(dirname, exist_ok=True)
+    fd, fn_tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(blob)
+        os.replace(fn_tmp, fn)
+    except BaseException:
+        os.unlink(fn_tmp)
+        raise
 
 def _get_sanitized_basename(basename: str) -> str:
     basename_sane = basename.encode('ascii', 'ignore').decode('utf-8')
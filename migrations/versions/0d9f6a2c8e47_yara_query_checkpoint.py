@@ -0,0 +1,28 @@
+"""
+
+Revision ID: 0d9f6a2c8e47
+Revises: 5b8e0c3f2a71
+Create Date: 2026-10-18 20:31:45.118263
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0d9f6a2c8e47'
+down_revision = '5b8e0c3f2a71'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('yara_query', sa.Column('checkpoint_component_id', sa.Integer(), nullable=True))
+    op.add_column('yara_query', sa.Column('checkpoint_ts', sa.DateTime(), nullable=True))
+
+    # queries left running by workers from before the upgrade can be reclaimed
+    op.execute('UPDATE yara_query SET checkpoint_ts = started_ts '
+               'WHERE started_ts IS NOT NULL AND ended_ts IS NULL')
+
+
+def downgrade():
+    op.drop_column('yara_query', 'checkpoint_ts')
+    op.drop_column('yara_query', 'checkpoint_component_id')
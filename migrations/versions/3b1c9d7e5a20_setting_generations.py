@@ -0,0 +1,30 @@
+"""
+
+Revision ID: 3b1c9d7e5a20
+Revises: 7d2c4321b2ab
+Create Date: 2026-10-18 09:12:41.318806
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b1c9d7e5a20'
+down_revision = '7d2c4321b2ab'
+
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    tbl = op.create_table('setting_generations',
+    sa.Column('setting_generation_id', sa.Integer(), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.Column('mtime', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('setting_generation_id')
+    )
+    op.bulk_insert(tbl, [{'value': 0, 'mtime': datetime.datetime.utcnow()}])
+
+
+def downgrade():
+    op.drop_table('setting_generations')
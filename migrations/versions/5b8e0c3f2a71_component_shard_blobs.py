@@ -0,0 +1,36 @@
+"""
+
+Revision ID: 5b8e0c3f2a71
+Revises: a4c2e9d17f35
+Create Date: 2026-10-18 19:12:04.552190
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e0c3f2a71'
+down_revision = 'a4c2e9d17f35'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('component_shard_blobs',
+    sa.Column('component_shard_blob_id', sa.Integer(), nullable=False),
+    sa.Column('checksum', sa.String(length=64), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=True),
+    sa.Column('refcnt', sa.Integer(), nullable=False),
+    sa.Column('ctime', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('component_shard_blob_id'),
+    sa.UniqueConstraint('checksum')
+    )
+    op.add_column('component_shards', sa.Column('component_shard_blob_id', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_component_shards_component_shard_blob_id'), 'component_shards', ['component_shard_blob_id'], unique=False)
+    op.create_foreign_key('component_shards_component_shard_blob_id_fkey', 'component_shards', 'component_shard_blobs', ['component_shard_blob_id'], ['component_shard_blob_id'])
+
+
+def downgrade():
+    op.drop_constraint('component_shards_component_shard_blob_id_fkey', 'component_shards', type_='foreignkey')
+    op.drop_index(op.f('ix_component_shards_component_shard_blob_id'), table_name='component_shards')
+    op.drop_column('component_shards', 'component_shard_blob_id')
+    op.drop_table('component_shard_blobs')
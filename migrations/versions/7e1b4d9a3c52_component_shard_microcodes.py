@@ -0,0 +1,66 @@
+"""
+
+Revision ID: 7e1b4d9a3c52
+Revises: 0d9f6a2c8e47
+Create Date: 2026-10-18 21:12:07.402915
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7e1b4d9a3c52'
+down_revision = '0d9f6a2c8e47'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('component_shard_microcodes',
+    sa.Column('component_shard_microcode_id', sa.Integer(), nullable=False),
+    sa.Column('component_shard_id', sa.Integer(), nullable=False),
+    sa.Column('component_id', sa.Integer(), nullable=False),
+    sa.Column('vendor_id', sa.Integer(), nullable=False),
+    sa.Column('cpuid', sa.Text(), nullable=False),
+    sa.Column('platform', sa.Text(), nullable=False),
+    sa.Column('version', sa.Text(), nullable=False),
+    sa.Column('yyyymmdd', sa.Text(), nullable=False),
+    sa.ForeignKeyConstraint(['component_shard_id'], ['component_shards.component_shard_id'], ),
+    sa.ForeignKeyConstraint(['component_id'], ['components.component_id'], ),
+    sa.ForeignKeyConstraint(['vendor_id'], ['vendors.vendor_id'], ),
+    sa.PrimaryKeyConstraint('component_shard_microcode_id'),
+    sa.UniqueConstraint('component_shard_id')
+    )
+    op.create_index(op.f('ix_component_shard_microcodes_component_id'), 'component_shard_microcodes', ['component_id'], unique=False)
+    op.create_index(op.f('ix_component_shard_microcodes_vendor_id'), 'component_shard_microcodes', ['vendor_id'], unique=False)
+    op.create_index('idx_component_shard_microcodes_cpuid_platform_version', 'component_shard_microcodes', ['cpuid', 'platform', 'version'], unique=False)
+
+    # copy the existing Intel microcode shard attributes
+    op.execute("""
+        INSERT INTO component_shard_microcodes
+            (component_shard_id, component_id, vendor_id, cpuid, platform, version, yyyymmdd)
+        SELECT s.component_shard_id, s.component_id, f.vendor_id,
+               a_cpuid.value, a_platform.value, a_version.value, a_yyyymmdd.value
+        FROM component_shards s
+        JOIN components c ON c.component_id = s.component_id
+        JOIN firmware f ON f.firmware_id = c.firmware_id
+        JOIN component_shard_attributes a_cpuid ON a_cpuid.component_shard_id = s.component_shard_id
+            AND a_cpuid.key = 'cpuid'
+        JOIN component_shard_attributes a_platform ON a_platform.component_shard_id = s.component_shard_id
+            AND a_platform.key = 'platform'
+        JOIN component_shard_attributes a_version ON a_version.component_shard_id = s.component_shard_id
+            AND a_version.key = 'version'
+        JOIN component_shard_attributes a_yyyymmdd ON a_yyyymmdd.component_shard_id = s.component_shard_id
+            AND a_yyyymmdd.key = 'yyyymmdd'
+        WHERE s.guid = '3f0229ad-0a00-5269-90cf-0a45d8781b72'
+            AND a_cpuid.value IS NOT NULL
+            AND a_platform.value IS NOT NULL
+            AND a_version.value IS NOT NULL
+            AND a_yyyymmdd.value IS NOT NULL
+    """)
+
+
+def downgrade():
+    op.drop_index('idx_component_shard_microcodes_cpuid_platform_version', table_name='component_shard_microcodes')
+    op.drop_index(op.f('ix_component_shard_microcodes_vendor_id'), table_name='component_shard_microcodes')
+    op.drop_index(op.f('ix_component_shard_microcodes_component_id'), table_name='component_shard_microcodes')
+    op.drop_table('component_shard_microcodes')
@@ -0,0 +1,50 @@
+"""
+
+Revision ID: 8f4d2e6b9a13
+Revises: c5e8a1f0d2b4
+Create Date: 2026-10-18 15:41:09.112734
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f4d2e6b9a13'
+down_revision = 'c5e8a1f0d2b4'
+
+from alembic import op
+import sqlalchemy as sa
+
+from pkgversion import vercmp_sortable
+from lvfs.verfmts.models import Verfmt
+
+
+def upgrade():
+    op.add_column('components', sa.Column('version_sort', sa.Text(), nullable=True))
+    op.create_index(op.f('ix_components_version_sort'), 'components', ['version_sort'], unique=False)
+
+    # backfill using the displayed version, as Component.fix_version_sort() does
+    bind = op.get_bind()
+    verfmts = {}
+    values = []
+    for component_id, version, verfmt_value in bind.execute(sa.text("""
+        SELECT c.component_id, c.version, v.value
+        FROM components c
+        LEFT OUTER JOIN verfmts v ON v.verfmt_id = c.verfmt_id
+    """)):
+        version_display = version
+        if verfmt_value and version.isdigit():
+            if verfmt_value not in verfmts:
+                verfmts[verfmt_value] = Verfmt(value=verfmt_value)
+            version_display = verfmts[verfmt_value].version_display(version)
+        try:
+            values.append({'component_id': component_id,
+                           'version_sort': vercmp_sortable(version_display)})
+        except (TypeError, ValueError) as _:
+            pass
+    if values:
+        bind.execute(sa.text('UPDATE components SET version_sort = :version_sort '
+                             'WHERE component_id = :component_id'), values)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_components_version_sort'), table_name='components')
+    op.drop_column('components', 'version_sort')
@@ -0,0 +1,37 @@
+"""
+
+Revision ID: a4c2e9d17f35
+Revises: e3a7b5c1f964
+Create Date: 2026-10-18 18:20:37.901226
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4c2e9d17f35'
+down_revision = 'e3a7b5c1f964'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('plugin_timings',
+    sa.Column('plugin_timing_id', sa.Integer(), nullable=False),
+    sa.Column('plugin_id', sa.Text(), nullable=False),
+    sa.Column('hook', sa.Text(), nullable=False),
+    sa.Column('ctime', sa.DateTime(), nullable=False),
+    sa.Column('container_id', sa.Text(), nullable=True),
+    sa.Column('wall', sa.Float(), nullable=True),
+    sa.Column('cpu', sa.Float(), nullable=True),
+    sa.Column('children', sa.Float(), nullable=True),
+    sa.Column('rss', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('plugin_timing_id')
+    )
+    op.create_index(op.f('ix_plugin_timings_plugin_id'), 'plugin_timings', ['plugin_id'], unique=False)
+    op.create_index(op.f('ix_plugin_timings_ctime'), 'plugin_timings', ['ctime'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_plugin_timings_ctime'), table_name='plugin_timings')
+    op.drop_index(op.f('ix_plugin_timings_plugin_id'), table_name='plugin_timings')
+    op.drop_table('plugin_timings')
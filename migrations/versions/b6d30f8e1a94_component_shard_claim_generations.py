@@ -0,0 +1,30 @@
+"""
+
+Revision ID: b6d30f8e1a94
+Revises: 7e1b4d9a3c52
+Create Date: 2026-10-18 21:48:33.670251
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b6d30f8e1a94'
+down_revision = '7e1b4d9a3c52'
+
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    tbl = op.create_table('component_shard_claim_generations',
+    sa.Column('component_shard_claim_generation_id', sa.Integer(), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.Column('mtime', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('component_shard_claim_generation_id')
+    )
+    op.bulk_insert(tbl, [{'value': 0, 'mtime': datetime.datetime.utcnow()}])
+
+
+def downgrade():
+    op.drop_table('component_shard_claim_generations')
@@ -0,0 +1,41 @@
+"""
+
+Revision ID: c5e8a1f0d2b4
+Revises: 3b1c9d7e5a20
+Create Date: 2026-10-18 13:02:17.540912
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8a1f0d2b4'
+down_revision = '3b1c9d7e5a20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('fsck_reports',
+    sa.Column('fsck_report_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.Text(), nullable=False),
+    sa.Column('started_ts', sa.DateTime(), nullable=False),
+    sa.Column('ended_ts', sa.DateTime(), nullable=True),
+    sa.Column('total', sa.Integer(), nullable=True),
+    sa.Column('failed', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('fsck_report_id')
+    )
+    op.create_table('fsck_report_items',
+    sa.Column('fsck_report_item_id', sa.Integer(), nullable=False),
+    sa.Column('fsck_report_id', sa.Integer(), nullable=False),
+    sa.Column('filename', sa.Text(), nullable=False),
+    sa.Column('message', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['fsck_report_id'], ['fsck_reports.fsck_report_id'], ),
+    sa.PrimaryKeyConstraint('fsck_report_item_id')
+    )
+    op.create_index(op.f('ix_fsck_report_items_fsck_report_id'), 'fsck_report_items', ['fsck_report_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_fsck_report_items_fsck_report_id'), table_name='fsck_report_items')
+    op.drop_table('fsck_report_items')
+    op.drop_table('fsck_reports')
@@ -0,0 +1,29 @@
+"""
+
+Revision ID: e3a7b5c1f964
+Revises: 8f4d2e6b9a13
+Create Date: 2026-10-18 17:02:51.402318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e3a7b5c1f964'
+down_revision = '8f4d2e6b9a13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('tests', sa.Column('lease_ts', sa.DateTime(), nullable=True))
+    op.add_column('tests', sa.Column('attempts', sa.Integer(), nullable=True))
+    op.execute('UPDATE tests SET attempts = 0')
+
+    # tests left running by workers from before the upgrade can be reclaimed
+    op.execute('UPDATE tests SET lease_ts = started_ts '
+               'WHERE started_ts IS NOT NULL AND ended_ts IS NULL')
+
+
+def downgrade():
+    op.drop_column('tests', 'attempts')
+    op.drop_column('tests', 'lease_ts')
@@ -14,7 +14,7 @@ import unittest
 # allows us to run this from the project root
 sys.path.append(os.path.realpath("."))
 
-from pkgversion import vercmp
+from pkgversion import vercmp, vercmp_key, vercmp_sortable
 
 
 class TestpkgVersion(unittest.TestCase):
@@ -74,6 +74,49 @@ class TestpkgVersion(unittest.TestCase):
         with self.assertRaises(TypeError):
             assert vercmp(None, None) is None
 
+    def test_vercmp_key(self):
+
+        versions = [
+            "1.2.3",
+            "0x123",
+            "1.2.4",
+            "4.01",
+            "4.10",
+            "1.2.3.1",
+            "1.2.3a",
+            "1.2.3b",
+            "alpha",
+            "beta",
+            "1.2a.3",
+            "1.2b.3",
+            "1.2.3~rc1",
+            "1.2.3~rc2",
+            "1",
+            "1.0",
+        ]
+        for version_a in versions:
+            for version_b in versions:
+                rc = vercmp(version_a, version_b)
+                key_a = vercmp_key(version_a)
+                key_b = vercmp_key(version_b)
+                self.assertEqual(rc < 0, key_a < key_b, (version_a, version_b))
+                self.assertEqual(rc == 0, key_a == key_b, (version_a, version_b))
+        self.assertEqual(vercmp_key("0x123"), vercmp_key("291"))
+        self.assertEqual(
+            sorted(["1.2.3", "1.2.3~rc1", "1.2.10", "1.2.3a"], key=vercmp_key),
+            ["1.2.3~rc1", "1.2.3", "1.2.3a", "1.2.10"],
+        )
+        with self.assertRaises(TypeError):
+            vercmp_key(None)
+
+    def test_vercmp_sortable(self):
+
+        versions = ["1.2.10", "1.2.3~rc1", "1.2", "1.2.3a", "0x10", "1.2.3", "15"]
+        self.assertEqual(
+            sorted(versions, key=vercmp_sortable), sorted(versions, key=vercmp_key)
+        )
+        self.assertEqual(vercmp_sortable("2.0.3"), "2120121001213010")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -5,6 +5,7 @@
 #
 # SPDX-License-Identifier: GPL-2.0+
 
+import functools
 from itertools import zip_longest
 from typing import Tuple
 
@@ -82,3 +83,64 @@ def vercmp(version_a: str, version_b: str) -> int:
 
     # we really shouldn't get here
     return 0
+
+
+def _vercmp_char_key(char: str) -> int:
+    """ Matches _vercmp_char, where 0 is the tilde and 1 is the end of the string """
+    if char == "~":
+        return 0
+    return ord(char) + 2
+
+
+@functools.lru_cache(maxsize=0x10000)
+def vercmp_key(version: str) -> tuple:
+    """Parses a version into a key that sorts like vercmp()
+
+    This allows using sorted(..., key=vercmp_key) rather than reparsing both
+    versions for every comparison. The results are cached as the same small
+    set of version strings tends to be used over and over again.
+
+    Versions with empty sections like "1..2" are not consistently ordered by
+    vercmp() and are sorted before any other value here instead.
+    """
+
+    # sanity check
+    if not version:
+        raise TypeError("Version cannot be None")
+
+    # convert from hex
+    if version.startswith("0x"):
+        version = str(int(version[2:], 16))
+
+    # a missing section sorts before an empty one, which sorts before any value
+    sections = []
+    for section in version.split("."):
+        if not section:
+            sections.append((0,))
+            continue
+        num, str_part = _strtoll(section)
+        sections.append((1, num, tuple(_vercmp_char_key(c) for c in str_part) + (1,)))
+    return tuple(sections)
+
+
+def vercmp_sortable(version: str) -> str:
+    """Returns a string of hex digits that sorts like vercmp_key()
+
+    This is suitable for storing in the database so that ORDER BY can be used.
+    Sections are prefixed with '1' if empty and '2' otherwise, and the string
+    is terminated with '0' so that missing sections sort first. Numbers are
+    prefixed with the number of hex digits, and characters use two digits.
+    """
+    parts = []
+    for section in vercmp_key(version):
+        if len(section) == 1:
+            parts.append("1")
+            continue
+        _, num, chars = section
+        num_hex = "{:x}".format(num)
+        if len(num_hex) > 0xF:
+            num_hex = "f" * 0xF
+        parts.append("2{:x}{}".format(len(num_hex), num_hex))
+        parts.append("".join("{:02x}".format(min(char, 0xFF)) for char in chars))
+    parts.append("0")
+    return "".join(parts)
@@ -9,50 +9,67 @@
 
 import os
 import glob
-from typing import Dict, List
+import json
+import hashlib
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple, Any
 
 import yara
 
-from lvfs import db
+from lvfs import app, db
 from lvfs.pluginloader import PluginBase, PluginError
 from lvfs.pluginloader import PluginSettingBool, PluginSettingTextList
 from lvfs.tests.models import Test
 from lvfs.claims.models import Claim
 from lvfs.components.models import Component
+from lvfs.util import _write_atomic
 
-def _run_on_blob(self, test: Test, md: Component, title: str, blob: bytes) -> None:
-    matches = self.rules.match(data=blob)
-    for match in matches:
+def _match_blob(rules, blob: bytes) -> List[Dict[str, Any]]:
+    """ Returns the parts of each match that are used, so that they can be cached """
+    verdicts: List[Dict[str, Any]] = []
+    for match in rules.match(data=blob):
+        found: List[str] = []
+        for string in match.strings:
+            if len(string) == 3:
+                try:
+                    found.append(string[2].decode())
+                except UnicodeDecodeError as _:
+                    pass
+        verdicts.append({'rule': match.rule, 'meta': match.meta, 'found': found})
+    return verdicts
+
+def _add_verdicts(test: Test, md: Component, title: str, verdicts: List[Dict[str, Any]]) -> None:
+    for verdict in verdicts:
+        meta = verdict['meta']
 
         # do what we can
         description = None
-        if 'description' in match.meta:
-            description = match.meta['description'].replace('\0', '')
-
-        if 'fail' not in match.meta or match.meta['fail']:
-            msg = '{} YARA test failed'.format(match.rule)
-            for string in match.strings:
-                if len(string) == 3:
-                    try:
-                        msg += ': found {}'.format(string[2].decode())
-                    except UnicodeDecodeError as _:
-                        pass
+        if 'description' in meta:
+            description = meta['description'].replace('\0', '')
+
+        if 'fail' not in meta or meta['fail']:
+            msg = '{} YARA test failed'.format(verdict['rule'])
+            for found in verdict['found']:
+                msg += ': found {}'.format(found)
             if description:
                 msg += ': {}'.format(description)
             test.add_fail(title, msg)
-        elif 'claim' in match.meta:
+        elif 'claim' in meta:
             claim = db.session.query(Claim)\
-                              .filter(Claim.kind == match.meta['claim'])\
+                              .filter(Claim.kind == meta['claim'])\
                               .first()
             if not claim:
-                test.add_fail('YARA', 'Failed to find claim: {}'.format(match.meta['claim']))
+                test.add_fail('YARA', 'Failed to find claim: {}'.format(meta['claim']))
                 continue
             md.add_claim(claim)
 
 class Plugin(PluginBase):
     def __init__(self):
         PluginBase.__init__(self)
-        self.rules = None
+        self._rules: Optional[Tuple[Any, str]] = None
+        self._rules_stat: Optional[List[Tuple[str, int, int]]] = None
+        self._rules_lock = threading.Lock()
         self.name = 'Blocklist'
         self.summary = 'Use YARA to check firmware for problems'
         self.order_after = ['uefi-extract', 'intelme']
@@ -64,6 +81,102 @@ class Plugin(PluginBase):
                                        ['plugins/blocklist/rules']))
         return s
 
+    @staticmethod
+    def _get_cache_dir() -> str:
+        return os.path.join(app.config['SHARD_DIR'], 'blocklist')
+
+    def _ensure_rules(self) -> Optional[Tuple[Any, str]]:
+        """ Returns the compiled rules and their hash, or None if there are no rules """
+
+        # one instance is shared by all the test worker threads
+        with self._rules_lock:
+            return self._ensure_rules_locked()
+
+    def _ensure_rules_locked(self) -> Optional[Tuple[Any, str]]:
+
+        # only rehash the rules when any of the files have changed
+        fns: List[str] = []
+        for value in self.get_setting('blocklist_dirs', required=True).split(','):
+            fns.extend(glob.glob(os.path.join(value, '*.yar')))
+        rules_stat: List[Tuple[str, int, int]] = []
+        for fn in sorted(fns):
+            st = os.stat(fn)
+            rules_stat.append((fn, st.st_mtime_ns, st.st_size))
+        if self._rules and rules_stat == self._rules_stat:
+            return self._rules
+        if not fns:
+            self._rules = None
+            return None
+
+        # the compiled rules depend on the contents and the YARA version
+        csum = hashlib.sha256(yara.YARA_VERSION.encode())
+        filepaths: Dict[str, str] = {}
+        for fn, _, _ in rules_stat:
+            filepaths[os.path.basename(fn)] = fn
+            csum.update(os.path.basename(fn).encode() + b'\0')
+            with open(fn, 'rb') as f:
+                csum.update(hashlib.sha256(f.read()).digest())
+        rules_hash = csum.hexdigest()
+
+        # compiled by whichever worker saw the change first
+        rules = None
+        fn_compiled = os.path.join(self._get_cache_dir(), rules_hash + '.yarac')
+        if os.path.exists(fn_compiled):
+            try:
+                rules = yara.load(filepath=fn_compiled)
+                os.utime(fn_compiled)
+            except yara.Error as e:
+                print('failed to load {}: {}'.format(fn_compiled, str(e)))
+        if not rules:
+            try:
+                rules = yara.compile(filepaths=filepaths)
+            except yara.SyntaxError as e:
+                raise PluginError('Failed to compile rules: {}'.format(str(e))) from e
+            fn_tmp: Optional[str] = None
+            try:
+                os.makedirs(self._get_cache_dir(), exist_ok=True)
+                fd, fn_tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self._get_cache_dir())
+                os.close(fd)
+                rules.save(fn_tmp)
+                os.replace(fn_tmp, fn_compiled)
+            except (OSError, yara.Error) as e:
+                print('failed to save {}: {}'.format(fn_compiled, str(e)))
+                if fn_tmp and os.path.exists(fn_tmp):
+                    os.unlink(fn_tmp)
+
+        # both replaced at once so other threads never see a mismatched pair
+        self._rules = (rules, rules_hash)
+        self._rules_stat = rules_stat
+        return self._rules
+
+    def _get_verdict_fn(self, rules_hash: str, checksum: str) -> str:
+        return os.path.join(self._get_cache_dir(), rules_hash, checksum[:2], checksum + '.json')
+
+    def _get_verdicts(self, rules: Tuple[Any, str],
+                      checksum: Optional[str], blob_cb) -> List[Dict[str, Any]]:
+
+        # identical content was already scanned with the same rules
+        fn: Optional[str] = None
+        if checksum:
+            fn = self._get_verdict_fn(rules[1], checksum)
+            try:
+                with open(fn, 'rb') as f:
+                    verdicts = json.loads(f.read())
+                os.utime(fn)
+                return verdicts
+            except (FileNotFoundError, ValueError) as _:
+                pass
+        blob = blob_cb()
+        if not blob:
+            return []
+        verdicts = _match_blob(rules[0], blob)
+        if fn:
+            try:
+                _write_atomic(fn, json.dumps(verdicts).encode())
+            except OSError as e:
+                print('failed to save {}: {}'.format(fn, str(e)))
+        return verdicts
+
     def ensure_test_for_fw(self, fw):
 
         # add if not already exists
@@ -74,29 +187,22 @@ class Plugin(PluginBase):
 
     def run_test_on_md(self, test, md):
 
-        # compile the list of rules
-        if not self.rules:
-            fns: List[str] = []
-            for value in self.get_setting('blocklist_dirs', required=True).split(','):
-                fns.extend(glob.glob(os.path.join(value, '*.yar')))
-            if not fns:
-                test.add_pass('No YARA rules to use')
-                return
-            filepaths: Dict[str, str] = {}
-            for fn in fns:
-                filepaths[os.path.basename(fn)] = fn
-            try:
-                self.rules = yara.compile(filepaths=filepaths)
-            except yara.SyntaxError as e:
-                test.add_fail('YARA', 'Failed to compile rules: {}'.format(str(e)))
-                return
+        # load the precompiled list of rules
+        try:
+            rules = self._ensure_rules()
+        except PluginError as e:
+            test.add_fail('YARA', str(e))
+            return
+        if not rules:
+            test.add_pass('No YARA rules to use')
+            return
 
         # run analysis on the component and any shards
-        if md.blob:
-            _run_on_blob(self, test, md, md.filename_contents, md.blob)
+        _add_verdicts(test, md, md.filename_contents,
+                      self._get_verdicts(rules, md.checksum_contents_sha256, lambda: md.blob))
         for shard in md.shards:
-            if shard.blob:
-                _run_on_blob(self, test, md, shard.name, shard.blob)
+            _add_verdicts(test, md, shard.name,
+                          self._get_verdicts(rules, shard.checksum, lambda: shard.blob)) # pylint: disable=cell-var-from-loop
 
 # run with PYTHONPATH=. ./env/bin/python3 plugins/blocklist/__init__.py
 if __name__ == '__main__':
@@ -15,6 +15,7 @@ import requests
 from PIL import Image, UnidentifiedImageError
 
 from lvfs import app
+from lvfs.httpclient import http_client
 from lvfs.pluginloader import PluginBase, PluginError, PluginSettingBool
 from lvfs.tests.models import Test
 from lvfs.util import _get_settings
@@ -47,7 +48,7 @@ class Plugin(PluginBase):
 
         # download
         try:
-            r = requests.get(url)
+            r = http_client.get(url)
             r.raise_for_status()
         except requests.exceptions.RequestException as e:
             test.add_fail('Download', str(e))
@@ -10,12 +10,13 @@
 import os
 import fnmatch
 import json
-from typing import Dict
+from typing import Dict, List
 
 import requests
 
+from lvfs.httpclient import http_client
 from lvfs.pluginloader import PluginBase, PluginError
-from lvfs.pluginloader import PluginSettingText, PluginSettingBool, PluginSettingTextList
+from lvfs.pluginloader import PluginSettingText, PluginSettingBool, PluginSettingTextList, PluginSettingInteger
 
 def _basename_matches_globs(basename, globs):
     for glob in globs:
@@ -36,24 +37,34 @@ class Plugin(PluginBase):
         s.append(PluginSettingText('cdn_purge_accesskey', 'Accesskey', ''))
         s.append(PluginSettingTextList('cdn_purge_files', 'File Whitelist', ['*.xml.gz', '*.xml.gz.*', '*.jcat']))
         s.append(PluginSettingText('cdn_purge_method', 'Request method', 'GET'))
+        s.append(PluginSettingText('cdn_purge_batch_uri', 'Batch purge URI, e.g. https://api.cloudflare.com/client/v4/zones/ZONE/purge_cache', ''))
+        s.append(PluginSettingText('cdn_purge_batch_token', 'Batch purge API token, sent as a bearer token', ''))
+        s.append(PluginSettingText('cdn_purge_batch_prefix', 'Batch purge file prefix', 'https://lvfs.b-cdn.net/downloads/'))
+        s.append(PluginSettingInteger('cdn_purge_batch_size', 'Batch purge maximum files per request', 30))
         return s
 
-    def file_modified(self, fn):
-
-        # is the file in the whitelist
-        fns = self.get_setting('cdn_purge_files', required=True)
-        basename = os.path.basename(fn)
-        if not _basename_matches_globs(basename, fns.split(',')):
-            print('%s not in %s' % (basename, fns))
-            return
-
-        # purge
-        url = self.get_setting('cdn_purge_uri', required=True) + basename
+    def _get_headers(self) -> Dict[str, str]:
         headers: Dict[str, str] = {}
         accesskey = self.get_setting('cdn_purge_accesskey')
         if accesskey:
             headers['AccessKey'] = accesskey
-        r = requests.request(self.get_setting('cdn_purge_method', required=True), url, headers=headers)
+        return headers
+
+    def _get_batch_headers(self) -> Dict[str, str]:
+        headers: Dict[str, str] = {}
+        token = self.get_setting('cdn_purge_batch_token')
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+        return headers
+
+    def _purge_basename(self, basename: str) -> None:
+
+        url = self.get_setting('cdn_purge_uri', required=True) + basename
+        try:
+            r = http_client.request(self.get_setting('cdn_purge_method', required=True), url,
+                                    headers=self._get_headers())
+        except requests.exceptions.RequestException as e:
+            raise PluginError('Failed to purge metadata on CDN: %s' % str(e)) from e
         if r.text:
             try:
                 response = json.loads(r.text)
@@ -62,3 +73,47 @@ class Plugin(PluginBase):
             except ValueError as e:
                 # BunnyCDN doesn't sent a JSON blob
                 raise PluginError('Failed to purge metadata on CDN: %s' % r.text) from e
+
+    def _purge_basenames_batch(self, basenames: List[str]) -> None:
+
+        # e.g. Cloudflare accepts up to 30 files in each request
+        prefix = self.get_setting('cdn_purge_batch_prefix', required=True)
+        batch_size = self.get_setting_int('cdn_purge_batch_size') or 1
+        for i in range(0, len(basenames), batch_size):
+            files = [prefix + basename for basename in basenames[i:i + batch_size]]
+            try:
+                r = http_client.post(self.get_setting('cdn_purge_batch_uri', required=True),
+                                     json={'files': files},
+                                     headers=self._get_batch_headers())
+            except requests.exceptions.RequestException as e:
+                raise PluginError('Failed to purge metadata on CDN: %s' % str(e)) from e
+            if r.status_code != 200:
+                raise PluginError('Failed to purge metadata on CDN: %s' % r.text)
+            try:
+                response = r.json()
+            except ValueError as _:
+                continue
+            if isinstance(response, dict) and response.get('success') is False:
+                raise PluginError('Failed to purge metadata on CDN: %s' % r.text)
+
+    def files_modified(self, fns):
+
+        # is the file in the whitelist
+        globs = self.get_setting('cdn_purge_files', required=True).split(',')
+        basenames: List[str] = []
+        for fn in fns:
+            basename = os.path.basename(fn)
+            if not _basename_matches_globs(basename, globs):
+                print('%s not in %s' % (basename, ','.join(globs)))
+                continue
+            if basename not in basenames:
+                basenames.append(basename)
+        if not basenames:
+            return
+
+        # purge, using the batch form if the provider has one
+        if self.get_setting('cdn_purge_batch_uri'):
+            self._purge_basenames_batch(basenames)
+            return
+        for basename in basenames:
+            self._purge_basename(basename)
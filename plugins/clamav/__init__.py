@@ -7,9 +7,12 @@
 #
 # pylint: disable=no-self-use
 
-import os
+import mmap
+import time
 import subprocess
+from typing import Optional, Tuple
 
+from lvfs.clamd import clamd, ClamdError
 from lvfs.pluginloader import PluginBase, PluginError, PluginSettingBool
 from lvfs.tests.models import Test
 
@@ -18,6 +21,7 @@ class Plugin(PluginBase):
         PluginBase.__init__(self)
         self.name = 'ClamAV'
         self.summary = 'Check the firmware for trojans, viruses, malware and other malicious threats'
+        self._clamscan_version: Optional[Tuple[str, float]] = None
 
     def settings(self):
         s = []
@@ -34,56 +38,77 @@ class Plugin(PluginBase):
             test = Test(plugin_id=self.id, max_age=2592000) # one month
             fw.tests.append(test)
 
+    def _run_test_on_fw_daemon(self, test, fw):
+
+        # the version is cached by the client
+        try:
+            test.add_pass('Version', clamd.version())
+            with open(fw.absolute_path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    signature = clamd.scan(buf)
+        except (OSError, ValueError, ClamdError) as e:
+            test.add_fail('Failed to scan', str(e))
+            return
+
+        # parse results
+        if signature:
+            test.add_fail('Failed to scan', '{} FOUND'.format(signature))
+
+    def _get_clamscan_version(self) -> str:
+
+        # only changes when the package is updated, and the version and the
+        # timestamp are replaced together as the test threads share the plugin
+        now = time.monotonic()
+        clamscan_version = self._clamscan_version
+        if clamscan_version and now - clamscan_version[1] < 3600:
+            return clamscan_version[0]
+        ps = subprocess.Popen(['clamscan', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = ps.communicate()
+        if ps.returncode != 0:
+            raise PluginError(stderr.decode())
+        self._clamscan_version = (stdout.decode(), now)
+        return self._clamscan_version[0]
+
     def run_test_on_fw(self, test, fw):
 
-        # get ClamAV version
+        # use the long-lived daemon if available
         if self.get_setting_bool('clamav_use_daemon'):
-            argv = ['clamdscan', '--version']
-        else:
-            argv = ['clamscan', '--version']
+            self._run_test_on_fw_daemon(test, fw)
+            return
+
+        # get ClamAV version
         try:
-            ps = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if ps.wait() != 0:
-                test.add_fail('Failed to scan', ps.stderr.read().decode())
-                return
-            stdout, _ = ps.communicate()
-        except OSError as e:
-            test.add_fail('Failed to scan', e)
+            test.add_pass('Version', self._get_clamscan_version())
+        except (OSError, PluginError) as e:
+            test.add_fail('Failed to scan', str(e))
             return
-        test.add_pass('Version', stdout.decode())
 
         # scan cabinet archive
-        if self.get_setting_bool('clamav_use_daemon'):
-            argv = ['clamdscan',
-                    '--fdpass',
-                    '--no-summary',
-                    fw.absolute_path]
-        else:
-            argv = ['clamscan',
-                    '--infected',
-                    '--scan-mail=no',
-                    '--phishing-scan-urls=no',
-                    '--phishing-sigs=no',
-                    '--scan-swf=no',
-                    '--nocerts',
-                    '--no-summary',
-                    fw.absolute_path]
-            if self.get_setting_bool('clamav_detect_pua'):
-                argv.append('--detect-pua=yes')
+        argv = ['clamscan',
+                '--infected',
+                '--scan-mail=no',
+                '--phishing-scan-urls=no',
+                '--phishing-sigs=no',
+                '--scan-swf=no',
+                '--nocerts',
+                '--no-summary',
+                fw.absolute_path]
+        if self.get_setting_bool('clamav_detect_pua'):
+            argv.append('--detect-pua=yes')
         try:
             ps = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            rc = ps.wait()
+            stdout, stderr = ps.communicate()
+            rc = ps.returncode
             if rc == 2:
-                test.add_fail('Failed to scan', ps.stderr.read().decode())
+                test.add_fail('Failed to scan', stderr.decode())
                 return
-            stdout, _ = ps.communicate()
         except OSError as e:
             test.add_fail('Failed to scan', str(e))
             return
 
         # parse results
         if rc != 0:
-            for ln in stdout.split('\n'):
+            for ln in stdout.decode().split('\n'):
                 try:
                     _, status = ln.split(': ', 2)
                 except ValueError as e:
@@ -8,8 +8,10 @@
 # pylint: disable=no-self-use
 
 import os
+import bisect
 import sqlite3
-import datetime
+import threading
+from typing import Dict, List, Optional, Tuple
 
 from lvfs import db
 from lvfs.pluginloader import PluginBase, PluginSettingBool, PluginSettingText
@@ -23,6 +25,9 @@ class Plugin(PluginBase):
         self.name = 'Microcode MCEdb'
         self.summary = 'Check the microcode is not older than latest release'
         self.order_after = ['uefi-extract']
+        self._lock = threading.Lock()
+        self._mcedb_key: Optional[Tuple[str, int, int]] = None
+        self._mcedb: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
 
     def settings(self):
         s = []
@@ -47,24 +52,37 @@ class Plugin(PluginBase):
             test = Test(plugin_id=self.id, waivable=True)
             fw.tests.append(test)
 
+    def _load_mcedb(self, mcefn: str) -> Dict[Tuple[str, str], List[Tuple[str, str]]]:
+        """ Loads the whole database, unless it has not changed since last time """
+
+        st = os.stat(mcefn)
+        key = (mcefn, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if self._mcedb_key == key:
+                return self._mcedb
+            mcedb: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+            conn = sqlite3.connect(mcefn)
+            try:
+                c = conn.cursor()
+                c.execute('SELECT cpuid, platform, version, yyyymmdd FROM Intel')
+                for cpuid, platform, version, datestr in c.fetchall():
+                    if cpuid is None or platform is None or version is None or datestr is None:
+                        continue
+                    mcedb.setdefault((str(cpuid), str(platform)), []).append((str(version), str(datestr)))
+                c.close()
+            finally:
+                conn.close()
+            for versions in mcedb.values():
+                versions.sort()
+            self._mcedb = mcedb
+            self._mcedb_key = key
+            return mcedb
+
     def _run_test_on_shard(self, test, shard):
 
         # only Intel μcode supported at this time
-        if shard.guid != '3f0229ad-0a00-5269-90cf-0a45d8781b72':
-            return
-
-        # get required attributes
-        cpuid = shard.get_attr_value('cpuid')
-        if not cpuid:
-            return
-        platform = shard.get_attr_value('platform')
-        if not platform:
-            return
-        version = shard.get_attr_value('version')
-        if not version:
-            return
-        datestr = shard.get_attr_value('yyyymmdd')
-        if not datestr:
+        mc = shard.microcode
+        if not mc:
             return
 
         # don't expect vendors to include microcode that was released *after*
@@ -76,20 +94,19 @@ class Plugin(PluginBase):
         if not os.path.exists(mcefn):
             test.add_fail('cannot locate database: {}'.format(mcefn))
             return
-        conn = sqlite3.connect(mcefn)
-        c = conn.cursor()
-        c.execute('SELECT version, yyyymmdd FROM Intel WHERE cpuid=? AND '
-                  'platform=? AND version>? AND yyyymmdd>? ORDER BY version LIMIT 1',
-                  (cpuid, platform, version, datestr_upload))
-        res = c.fetchone()
-        if res:
-            (newest_version, newset_datestr,) = res
+        mcedb = self._load_mcedb(mcefn)
+
+        # the lowest newer version that was released after the upload
+        versions = mcedb.get((mc.cpuid, mc.platform), [])
+        for newest_version, newset_datestr in versions[bisect.bisect_right(versions, (mc.version,)):]:
+            if newest_version <= mc.version or newset_datestr <= datestr_upload:
+                continue
             print('CPUID:{:#x} Platform:{:#x} version {:#x} (released on {}) may be older '
                   'than latest released version {:#x} (released on {})'.\
-                  format(int(cpuid, 16),
-                         int(platform, 16),
-                         int(version, 16),
-                         datestr,
+                  format(int(mc.cpuid, 16),
+                         int(mc.platform, 16),
+                         int(mc.version, 16),
+                         mc.yyyymmdd,
                          int(newest_version, 16),
                          newset_datestr))
             claim = db.session.query(Claim)\
@@ -97,7 +114,7 @@ class Plugin(PluginBase):
                               .first()
             if claim:
                 shard.md.add_claim(claim)
-        c.close()
+            break
 
     def run_test_on_md(self, test, md):
         for shard in md.shards:
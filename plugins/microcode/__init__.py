@@ -7,11 +7,11 @@
 #
 # pylint: disable=no-self-use
 
-import datetime
-
 from lvfs.pluginloader import PluginBase, PluginSettingBool
 from lvfs.tests.models import Test
-from lvfs.components.models import ComponentShard, ComponentShardAttribute
+from lvfs.components.models import Component, ComponentShardMicrocode
+from lvfs.firmware.models import Firmware
+from lvfs.metadata.models import Remote
 from lvfs.util import _get_datestr_from_datetime
 from lvfs import db
 
@@ -51,78 +51,47 @@ class Plugin(PluginBase):
     def _run_test_on_shard(self, test, shard):
 
         # only Intel μcode supported at this time
-        if shard.guid != '3f0229ad-0a00-5269-90cf-0a45d8781b72':
-            return
-
-        # get required attributes
-        cpuid = shard.get_attr_value('cpuid')
-        if not cpuid:
-            return
-        platform = shard.get_attr_value('platform')
-        if not platform:
-            return
-        version = shard.get_attr_value('version')
-        if not version:
-            return
-        datestr = shard.get_attr_value('yyyymmdd')
-        if not datestr:
+        mc = shard.microcode
+        if not mc:
             return
 
         # don't expect vendors to include microcode that was released *after*
         # the file was uploaded to the LVFS
         datestr_upload = str(_get_datestr_from_datetime(shard.md.fw.timestamp))
 
-        # find any higher microcode version larger than this one known to the LVFS
-        stmt1 = db.session.query(ComponentShard.component_shard_id)\
-                          .join(ComponentShardAttribute)\
-                          .filter(ComponentShardAttribute.key == 'cpuid')\
-                          .filter(ComponentShardAttribute.value == cpuid)\
-                          .subquery()
-        stmt2 = db.session.query(ComponentShard.component_shard_id)\
-                          .join(ComponentShardAttribute)\
-                          .filter(ComponentShardAttribute.key == 'platform')\
-                          .filter(ComponentShardAttribute.value == platform)\
-                          .subquery()
-        stmt3 = db.session.query(ComponentShard.component_shard_id)\
-                          .join(ComponentShardAttribute)\
-                          .filter(ComponentShardAttribute.key == 'yyyymmdd')\
-                          .filter(ComponentShardAttribute.value < datestr_upload)\
-                          .subquery()
-        shards = db.session.query(ComponentShard)\
-                           .join(stmt1, ComponentShard.component_shard_id == stmt1.c.component_shard_id)\
-                           .join(stmt2, ComponentShard.component_shard_id == stmt2.c.component_shard_id)\
-                           .join(stmt3, ComponentShard.component_shard_id == stmt3.c.component_shard_id)\
-                           .join(ComponentShardAttribute)\
-                           .filter(ComponentShardAttribute.key == 'version')\
-                           .filter(ComponentShardAttribute.value > version)\
-                           .order_by(ComponentShardAttribute.value)\
-                           .all()
-        for shard_tmp in shards:
-            if shard_tmp.md.fw.remote.is_public:
-
-                # an update can be created for resolving vendor-specific or
-                # model-specific issues, so restrict results to the AppStream ID
-                if shard.md.appstream_id != shard_tmp.md.appstream_id:
-                    continue
-
-                # only count firmware older than the correct firmware
-                if shard.md < shard_tmp.md:
-                    continue
-
-                newest_version = shard_tmp.get_attr_value('version')
-                newset_datestr = shard_tmp.get_attr_value('yyyymmdd')
-                test.add_fail('Downgraded Intel CPU microcode detected',
-                              'CPUID:{:#x} Platform:{:#x} version {:#x} (released on {}) is older '
-                              'than latest released version {:#x} (released on {}) found in {} v{}'\
-                              .format(int(cpuid, 16),
-                                      int(platform, 16),
-                                      int(version, 16),
-                                      datestr,
-                                      int(newest_version, 16),
-                                      newset_datestr,
-                                      shard_tmp.md.name_with_category,
-                                      shard_tmp.md.version_display))
-                return
+        # find any higher microcode version larger than this one known to the LVFS;
+        # an update can be created for resolving vendor-specific or model-specific
+        # issues, so restrict results to the AppStream ID
+        mcs = db.session.query(ComponentShardMicrocode)\
+                        .join(Component)\
+                        .join(Firmware)\
+                        .join(Remote)\
+                        .filter(ComponentShardMicrocode.cpuid == mc.cpuid)\
+                        .filter(ComponentShardMicrocode.platform == mc.platform)\
+                        .filter(ComponentShardMicrocode.version > mc.version)\
+                        .filter(ComponentShardMicrocode.yyyymmdd < datestr_upload)\
+                        .filter(Component.appstream_id == shard.md.appstream_id)\
+                        .filter(Remote.is_public)\
+                        .order_by(ComponentShardMicrocode.version)\
+                        .all()
+        for mc_tmp in mcs:
+
+            # only count firmware older than the correct firmware
+            if shard.md < mc_tmp.md:
+                continue
+
+            test.add_fail('Downgraded Intel CPU microcode detected',
+                          'CPUID:{:#x} Platform:{:#x} version {:#x} (released on {}) is older '
+                          'than latest released version {:#x} (released on {}) found in {} v{}'\
+                          .format(int(mc.cpuid, 16),
+                                  int(mc.platform, 16),
+                                  int(mc.version, 16),
+                                  mc.yyyymmdd,
+                                  int(mc_tmp.version, 16),
+                                  mc_tmp.yyyymmdd,
+                                  mc_tmp.md.name_with_category,
+                                  mc_tmp.md.version_display))
+            return
 
     def run_test_on_md(self, test, md):
         for shard in md.shards:
@@ -8,8 +8,9 @@
 # pylint: disable=no-self-use,no-member,too-few-public-methods
 
 import os
+import json
 import datetime
-from typing import List
+from typing import Any, Dict, List, Optional
 
 from pyasn1.codec.der import decoder as der_decoder
 from pyasn1_modules import rfc2315
@@ -17,10 +18,13 @@ from pyasn1_modules import rfc2459
 
 import pefile
 
-from lvfs import db
+from lvfs import app, db
 from lvfs.pluginloader import PluginBase, PluginError, PluginSettingBool, PluginSettingInteger
 from lvfs.tests.models import Test
 from lvfs.components.models import ComponentShardCertificate
+from lvfs.util import _write_atomic
+
+PECHECK_CACHE_VERSION = 1
 
 def _build_rfc2459_description(value) -> str:
     descs: List[str] = []
@@ -86,6 +90,50 @@ def _extract_certs_from_authenticode_blob(buf: bytes) -> List[ComponentShardCert
         certs.append(_extract_authenticode_tbscerts(tbscert))
     return certs
 
+def _cert_to_dict(cert: ComponentShardCertificate) -> Dict[str, Any]:
+    return {'kind': cert.kind,
+            'serial_number': cert.serial_number,
+            'not_before': cert.not_before.strftime('%Y-%m-%dT%H:%M:%S') if cert.not_before else None,
+            'not_after': cert.not_after.strftime('%Y-%m-%dT%H:%M:%S') if cert.not_after else None,
+            'description': cert.description}
+
+def _cert_from_dict(item: Dict[str, Any]) -> ComponentShardCertificate:
+    cert = ComponentShardCertificate(kind=item['kind'],
+                                     serial_number=item['serial_number'],
+                                     description=item['description'])
+    if item['not_before']:
+        cert.not_before = datetime.datetime.strptime(item['not_before'], '%Y-%m-%dT%H:%M:%S')
+    if item['not_after']:
+        cert.not_after = datetime.datetime.strptime(item['not_after'], '%Y-%m-%dT%H:%M:%S')
+    return cert
+
+def _analyse_blob(blob: bytes) -> Dict[str, Any]:
+    """ Returns the parts of the PE file that are used, so that they can be cached """
+
+    # only the headers are parsed: the data directories are part of the
+    # optional header and the security directory address is a file offset
+    try:
+        pe = pefile.PE(data=blob, fast_load=True)
+        try:
+            security = pe.OPTIONAL_HEADER.DATA_DIRECTORY[pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_SECURITY']]
+        finally:
+            pe.close()
+    except pefile.PEFormatError as _:
+        # not a PE file, which is fine
+        return {}
+    if security.VirtualAddress == 0 or security.Size == 0:
+        return {}
+
+    # copy just the certificate table out of the shard
+    with memoryview(blob) as view:
+        signature = bytes(view[security.VirtualAddress + 8:security.VirtualAddress + security.Size])
+    if len(signature) != security.Size - 8:
+        return {'truncated': [len(signature), security.Size - 8]}
+
+    # get all the certificates and signer
+    certs = _extract_certs_from_authenticode_blob(signature)
+    return {'certs': [_cert_to_dict(cert) for cert in certs]}
+
 class Plugin(PluginBase):
     def __init__(self):
         PluginBase.__init__(self)
@@ -112,30 +160,47 @@ class Plugin(PluginBase):
             test = Test(plugin_id=self.id, waivable=True)
             fw.tests.append(test)
 
-    def _run_test_on_shard(self, test, shard):
+    @staticmethod
+    def _get_cache_fn(checksum: str) -> str:
+        return os.path.join(app.config['SHARD_DIR'], 'pecheck',
+                            '{}-{}'.format(PECHECK_CACHE_VERSION, pefile.__version__),
+                            checksum[:2], checksum + '.json')
 
-        try:
-            # parse PE header
-            pe = pefile.PE(data=shard.blob)
+    def _get_analysis(self, checksum: Optional[str], blob_cb) -> Dict[str, Any]:
 
-            # get optional directory entry
-            security = pe.OPTIONAL_HEADER.DATA_DIRECTORY[pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_SECURITY']]
-            if security.VirtualAddress == 0 or security.Size == 0:
-                return
+        # identical content was already analysed by the same version of pefile
+        fn: Optional[str] = None
+        if checksum:
+            fn = self._get_cache_fn(checksum)
+            try:
+                with open(fn, 'rb') as f:
+                    analysis = json.loads(f.read())
+                os.utime(fn)
+                return analysis
+            except (FileNotFoundError, ValueError) as _:
+                pass
+        blob = blob_cb()
+        if not blob:
+            return {}
+        analysis = _analyse_blob(blob)
+        if fn:
+            try:
+                _write_atomic(fn, json.dumps(analysis).encode())
+            except OSError as e:
+                print('failed to save {}: {}'.format(fn, str(e)))
+        return analysis
 
-            # format as a blob
-            signature = pe.write()[security.VirtualAddress + 8:security.VirtualAddress + security.Size]
-            if len(signature) != security.Size - 8:
-                test.add_fail(shard.name,
-                              'Unable to extract full signature, file is most likely truncated -- '\
-                              'Extracted: {} bytes, expected: {} bytes'.format(len(signature), security.Size - 8))
-                return
-        except pefile.PEFormatError as _:
-            # not a PE file, which is fine
-            return
+    def _run_test_on_shard(self, test, shard):
 
-        # get all the certificates and signer
-        certs = _extract_certs_from_authenticode_blob(signature)
+        analysis = self._get_analysis(shard.checksum, lambda: shard.blob)
+        if 'truncated' in analysis:
+            test.add_fail(shard.name,
+                          'Unable to extract full signature, file is most likely truncated -- '\
+                          'Extracted: {} bytes, expected: {} bytes'.format(*analysis['truncated']))
+            return
+        if 'certs' not in analysis:
+            return
+        certs = [_cert_from_dict(item) for item in analysis['certs']]
         if not certs:
             test.add_pass(shard.name, 'No certificates')
             return
@@ -166,8 +231,7 @@ class Plugin(PluginBase):
                 db.session.delete(cert)
         db.session.commit()
         for shard in md.shards:
-            if shard.blob:
-                self._run_test_on_shard(test, shard)
+            self._run_test_on_shard(test, shard)
 
 # run with PYTHONPATH=. ./env/bin/python3 plugins/pecheck/__init__.py
 if __name__ == '__main__':
@@ -187,8 +251,8 @@ if __name__ == '__main__':
         _md.protocol = Protocol(value='org.uefi.capsule')
         _shard = ComponentShard(name=os.path.basename(_argv))
         try:
-            with open(_argv, 'rb') as f:
-                _shard.set_blob(f.read())
+            with open(_argv, 'rb') as _f:
+                _shard.set_blob(_f.read())
         except IsADirectoryError as _:
             continue
         _md.shards.append(_shard)
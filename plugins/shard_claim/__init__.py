@@ -7,12 +7,9 @@
 #
 # pylint: disable=no-self-use,no-member,too-few-public-methods,unused-argument,singleton-comparison
 
-from typing import Dict
-
-from lvfs import db
 from lvfs.pluginloader import PluginBase
-from lvfs.claims.models import Claim
-from lvfs.components.models import ComponentShard, ComponentShardInfo, ComponentShardClaim, ComponentShardChecksum
+from lvfs.components.models import ComponentShard, ComponentShardChecksum
+from lvfs.shards.utils import shard_claims
 from lvfs.tests.models import Test
 
 class Plugin(PluginBase):
@@ -32,24 +29,13 @@ class Plugin(PluginBase):
 
     def run_test_on_md(self, test, md):
 
-        infos_by_guid: Dict[str, ComponentShardInfo] = {}
-        claims_by_csum: Dict[str, ComponentShardClaim] = {}
-
-        # find any infos that indicate a claim
-        for info in db.session.query(ComponentShardInfo)\
-                              .filter(ComponentShardInfo.claim_id != None):
-            infos_by_guid[info.guid] = info
-        for claim in db.session.query(ComponentShardClaim)\
-                               .filter(ComponentShardClaim.claim_id != None)\
-                               .filter(ComponentShardClaim.checksum != None):
-            claims_by_csum[claim.checksum] = claim
+        # pick up claims changed by any other process, once for all the shards
+        shard_claims.refresh()
 
         # run analysis on the component and any shards
         for shard in md.shards:
-            if shard.guid in infos_by_guid:
-                md.add_claim(infos_by_guid[shard.guid].claim)
-            if shard.checksum in claims_by_csum:
-                md.add_claim(claims_by_csum[shard.checksum].claim)
+            for claim in shard_claims.get_claims(shard):
+                md.add_claim(claim)
 
 # run with PYTHONPATH=. ./env/bin/python3 plugins/shard-claim/__init__.py
 if __name__ == '__main__':
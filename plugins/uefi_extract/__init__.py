@@ -11,17 +11,21 @@ import tempfile
 import glob
 import os
 import re
+import json
+import hashlib
+import lzma
 import subprocess
 import zlib
 import uuid
 import struct
 from collections import namedtuple
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple, Iterator, Any
 
-from lvfs import db
+from lvfs import app, db
 from lvfs.pluginloader import PluginBase, PluginError, PluginSettingBool, PluginSettingText, PluginSettingInteger
 from lvfs.tests.models import Test
-from lvfs.components.models import Component, ComponentShard, ComponentShardAttribute
+from lvfs.components.models import Component, ComponentShard, ComponentShardAttribute, ComponentShardBlob
+from lvfs.util import _write_atomic
 
 class PfsFile:
 
@@ -227,11 +231,116 @@ class PfatFile:
             self.shards.append(shard)
 
 
+class CompressedSectionScanner:
+    """ Finds compressed streams embedded at any offset in a blob
+
+    The blob is only searched once for each signature, every decompression
+    attempt reads the input in chunks from a memoryview and gives up as soon
+    as the output is larger than size_max, and any data consumed by a valid
+    stream is not searched again.
+    """
+
+    CHUNK_SIZE_FIRST = 0x1000   # most false positives fail in the first few bytes
+    CHUNK_SIZE = 0x10000
+
+    def __init__(self, size_min: int = 0, size_max: int = 0x4000000):
+        self.size_min = size_min
+        self.size_max = size_max
+
+    @staticmethod
+    def _check_zlib(view: memoryview, offset: int) -> bool:
+        # FCHECK makes the header a multiple of 31, and FDICT is not used
+        cmf, flg = view[offset], view[offset + 1]
+        return (cmf * 256 + flg) % 31 == 0 and not flg & 0x20
+
+    @staticmethod
+    def _check_gzip(view: memoryview, offset: int) -> bool:
+        # the reserved flag bits must be unset
+        return len(view) > offset + 3 and not view[offset + 3] & 0xE0
+
+    def _check_lzma(self, view: memoryview, offset: int) -> bool:
+        # the .lzma header used by EFI_LZMA_COMPRESSED sections has the
+        # dictionary size and the uncompressed size, so filter on those
+        if len(view) < offset + 13:
+            return False
+        dictsz, = struct.unpack_from('<I', view, offset + 1)
+        low = dictsz & -dictsz
+        if dictsz - low not in [0, low * 2]:
+            return False
+        size, = struct.unpack_from('<Q', view, offset + 5)
+        if size == 0xFFFFFFFFFFFFFFFF:
+            return True     # unknown, so has an end marker
+        return self.size_min < size < self.size_max
+
+    def _decompress(self, view: memoryview, offset: int, obj: Any) -> Tuple[Optional[bytes], int]:
+        """ Returns the decompressed data and the offset of the end of the stream """
+
+        chunks: List[bytes] = []
+        total = 0
+        pos = offset
+        chunk_size = self.CHUNK_SIZE_FIRST
+        try:
+            while not obj.eof:
+                chunk = view[pos:pos + chunk_size]
+                if not chunk:
+                    return None, offset     # truncated
+                pos += len(chunk)
+                chunk_size = self.CHUNK_SIZE
+                data = obj.decompress(chunk, self.size_max - total + 1)
+                total += len(data)
+                if total > self.size_max:
+                    return None, offset
+                chunks.append(data)
+        except (zlib.error, lzma.LZMAError, EOFError) as _:
+            return None, offset
+        return b''.join(chunks), pos - len(obj.unused_data)
+
+    def scan(self, blob: bytes) -> Iterator[Tuple[str, bytes]]:
+        """ Yields the kind and decompressed data of each stream """
+
+        signatures = [
+            (b'\x78\x01', 'Zlib', self._check_zlib, zlib.decompressobj),
+            (b'\x78\x5E', 'Zlib', self._check_zlib, zlib.decompressobj),
+            (b'\x78\x9C', 'Zlib', self._check_zlib, zlib.decompressobj),
+            (b'\x78\xDA', 'Zlib', self._check_zlib, zlib.decompressobj),
+            (b'\x1F\x8B\x08', 'Gzip', self._check_gzip,
+             lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+            (b'\x5D\x00\x00', 'LZMA', self._check_lzma,
+             lambda: lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)),
+        ]
+        with memoryview(blob) as view:
+
+            # the next match for each signature, only searching again when used
+            matches: Dict[int, int] = {idx: blob.find(sig) for idx, (sig, _, _, _) in enumerate(signatures)}
+            offset = 0
+            while True:
+                for idx, match in matches.items():
+                    if match != -1 and match < offset:
+                        matches[idx] = blob.find(signatures[idx][0], offset)
+                candidates = [(match, idx) for idx, match in matches.items() if match != -1]
+                if not candidates:
+                    break
+                match, idx = min(candidates)
+                _, kind, check, create = signatures[idx]
+                offset = match + 1
+                if not check(view, match):
+                    continue
+                data, end = self._decompress(view, match, create())
+                if data is None:
+                    continue
+
+                # never look inside a stream that was valid
+                offset = end
+                if self.size_min < len(data) < self.size_max:
+                    yield kind, data
+
+
 class Plugin(PluginBase):
     def __init__(self):
         PluginBase.__init__(self, 'uefi-extract')
         self.name = 'UEFI Extract'
         self.summary = 'Add firmware shards for UEFI capsules'
+        self._versions: Dict[str, Optional[str]] = {}
 
     def settings(self):
         s = []
@@ -412,8 +521,100 @@ class Plugin(PluginBase):
             shards.append(shard)
         return shards
 
+    def _get_uefi_extract_version(self) -> Optional[str]:
+
+        # the version is printed as part of the usage text
+        cmd = self.get_setting('uefi_extract_binary', required=True)
+        if cmd in self._versions:
+            return self._versions[cmd]
+        version = None
+        try:
+            # pylint: disable=unexpected-keyword-arg
+            p = subprocess.run([cmd],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               timeout=30,
+                               check=False)
+            m = re.search(r'UEFIExtract[ A-Za-z]* ([0-9][0-9A-Za-z._-]*)',
+                          p.stdout.decode(errors='replace'))
+            if m:
+                version = m.group(1)
+        except (OSError, subprocess.SubprocessError) as _:
+            pass
+        self._versions[cmd] = version
+        return version
+
+    @staticmethod
+    def _get_cache_fn(checksum: str, version: str) -> str:
+        return os.path.join(app.config['SHARD_DIR'], 'uefi-extract',
+                            version, checksum[:2], checksum + '.json')
+
+    def _load_cached_shards(self, fn: str) -> Optional[List[ComponentShard]]:
+
+        # the manifest only refers to the contents in the shard store
+        try:
+            with open(fn, 'rb') as f:
+                manifest = json.loads(f.read())
+        except (FileNotFoundError, ValueError) as _:
+            return None
+        checksums = [item['checksum'] for item in manifest['shards']]
+        shard_blobs: Dict[str, ComponentShardBlob] = {}
+        if checksums:
+            for shard_blob in db.session.query(ComponentShardBlob)\
+                                        .filter(ComponentShardBlob.checksum.in_(checksums)):
+                shard_blobs[shard_blob.checksum] = shard_blob
+
+        # any contents removed by the shard garbage collector make this a miss
+        shards: List[ComponentShard] = []
+        for item in manifest['shards']:
+            shard_blob = shard_blobs.get(item['checksum'])
+            if not shard_blob:
+                return None
+            blob = shard_blob.read()
+            if blob is None:
+                return None
+            shard = ComponentShard(plugin_id=self.id, name=item['name'], guid=item['guid'])
+            shard.set_blob(blob)
+            if shard.checksum != item['checksum']:
+                return None
+            for key, value in item['attributes']:
+                shard.attributes.append(ComponentShardAttribute(key=key, value=value))
+            shards.append(shard)
+
+        # the shard garbage collector prunes entries that have not been used
+        os.utime(fn)
+        return shards
+
+    @staticmethod
+    def _save_cached_shards(fn: str, shards: List[ComponentShard]) -> None:
+        manifest: Dict[str, List] = {'shards': []}
+        for shard in shards:
+            manifest['shards'].append({'name': shard.name,
+                                       'guid': shard.guid,
+                                       'checksum': shard.checksum,
+                                       'attributes': [[attr.key, attr.value] for attr in shard.attributes]})
+        _write_atomic(fn, json.dumps(manifest).encode())
+
     def _get_shards_for_blob(self, blob: bytes) -> List[ComponentShard]:
 
+        # the same payload is often shipped in many archives
+        fn_cache: Optional[str] = None
+        version = self._get_uefi_extract_version()
+        if version:
+            fn_cache = self._get_cache_fn(hashlib.sha256(blob).hexdigest(), version)
+            shards = self._load_cached_shards(fn_cache)
+            if shards is not None:
+                return shards
+        shards = self._run_uefi_extract(blob)
+        if fn_cache:
+            try:
+                self._save_cached_shards(fn_cache, shards)
+            except OSError as e:
+                print('failed to cache {}: {}'.format(fn_cache, str(e)))
+        return shards
+
+    def _run_uefi_extract(self, blob: bytes) -> List[ComponentShard]:
+
         # write blob to temp file
         cwd = tempfile.TemporaryDirectory(prefix='lvfs')
         src = tempfile.NamedTemporaryFile(mode='wb',
@@ -438,29 +639,10 @@ class Plugin(PluginBase):
         files = glob.glob(src.name + '.dump' + '/**/info.txt', recursive=True)
         return self._convert_files_to_shards(files)
 
-    def _find_zlib_sections(self, blob: bytes) -> List[bytes]:
-        offset = 0
-        sections: List[bytes] = []
-        while 1:
-            # find Zlib header for default compression
-            offset = blob.find(b'\x78\x9C', offset)
-            if offset == -1:
-                break
-
-            # decompress the buffer, which also checks if it's really Zlib or just
-            # two random bytes that happen to match for no good reason
-            try:
-                obj = zlib.decompressobj()
-                blob_decompressed = obj.decompress(blob[offset:])
-                offset = len(blob) - len(obj.unused_data)
-            except zlib.error as _:
-                offset += 2
-            else:
-                # only include blobs of a sane size
-                if len(blob_decompressed) > self.get_setting_int('uefi_extract_size_min') and \
-                   len(blob_decompressed) < self.get_setting_int('uefi_extract_size_max'):
-                    sections.append(blob_decompressed)
-        return sections
+    def _find_compressed_sections(self, blob: bytes) -> List[Tuple[str, bytes]]:
+        scanner = CompressedSectionScanner(size_min=self.get_setting_int('uefi_extract_size_min'),
+                                           size_max=self.get_setting_int('uefi_extract_size_max'))
+        return list(scanner.scan(blob))
 
     def _run_uefi_extract_on_md(self, test: Test, md: Component):
 
@@ -490,21 +672,21 @@ class Plugin(PluginBase):
         else:
             shards = self._get_shards_for_blob(md.blob)
             if not shards:
-                for blob in self._find_zlib_sections(md.blob):
+                for kind, blob in self._find_compressed_sections(md.blob):
                     try:
                         pfs = PfsFile(blob)
                         for shard in pfs.shards:
                             shards.append(shard)
                             shards.extend(self._get_shards_for_blob(shard.blob))
-                        test.add_pass('Found PFS in Zlib compressed blob')
+                        test.add_pass('Found PFS in {} compressed blob'.format(kind))
                     except RuntimeError as _:
                         shard = ComponentShard(plugin_id=self.id)
                         shard.set_blob(blob)
-                        shard.name = 'Zlib'
-                        shard.guid = '68b8cc0e-4664-5c7a-9ce3-8ed9b4ffbffb'
+                        shard.name = kind
+                        shard.guid = str(uuid.uuid5(uuid.NAMESPACE_DNS, kind))
                         shards.append(shard)
                         shards.extend(self._get_shards_for_blob(shard.blob))
-                        test.add_pass('Found Zlib compressed blob')
+                        test.add_pass('Found {} compressed blob'.format(kind))
             if not shards:
                 test.add_pass('No firmware volumes found in {}'.format(md.filename_contents))
                 return
@@ -516,6 +698,7 @@ class Plugin(PluginBase):
             if self.get_setting_bool('uefi_extract_write_shards'):
                 shard.save()
             md.shards.append(shard)
+            shard.ensure_microcode()
 
     def require_test_for_md(self, md):
         if not md.protocol:
@@ -9,8 +9,7 @@
 
 from typing import Dict
 
-import requests
-
+from lvfs.httpclient import http_client
 from lvfs.pluginloader import PluginBase, PluginError
 from lvfs.pluginloader import PluginSettingBool, PluginSettingText, PluginSettingTextList
 from lvfs.tests.models import Test
@@ -59,8 +58,8 @@ class Plugin(PluginBase):
             headers['User-Agent'] = self.get_setting('virustotal_user_agent', required=True)
             files = {'file': ('filepath', md.blob, 'application/octet-stream')}
             args = {'path': remote_path}
-            r = requests.post(self.get_setting('virustotal_uri', required=True),
-                              files=files, data=args, headers=headers)
+            r = http_client.post(self.get_setting('virustotal_uri', required=True),
+                                 files=files, data=args, headers=headers)
             if r.status_code != 200:
                 test.add_fail('Failed to upload', r.text)
                 return